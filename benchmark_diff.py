@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for diff.py, run against the committed expected results.
+
+Each benchmark compares the expected tree against itself, which is what a
+green `make all test` run looks like from diff.py's point of view.
+
+Usage:
+    python benchmark_diff.py fast-path
+    python benchmark_diff.py --expected cli_integration_tests/expected_results/CRISPResso_on_params fast-path
+    python benchmark_diff.py normalize
+    python benchmark_diff.py tables
+    python benchmark_diff.py pdf
+    python benchmark_diff.py images
+    python benchmark_diff.py render
+"""
+import argparse
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import diff
+
+
+DEFAULT_EXPECTED_DIR = Path(__file__).parent / 'cli_integration_tests' / 'expected_results'
+# The suffixes diff.diff() handles; the other TEXT_SUFFIXES have their own comparators
+PLAIN_TEXT_SUFFIXES = ('.txt', '.html', '.sam', '.vcf')
+
+
+def collect_files(root, suffixes):
+    """Return all files under *root* with one of *suffixes*, sorted by path."""
+    return sorted(
+        f for f in Path(root).glob('**/*')
+        if f.suffix in suffixes and diff.default_diff_rules().rule_for(f.name).severity != 'ignore'
+    )
+
+
+def time_call(func, *args, **kwargs):
+    """Run ``func(*args, **kwargs)`` and return the elapsed wall time in seconds."""
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_fast_path(args):
+    """Time diff() on every text file with and without the digest fast path."""
+    files = collect_files(args.expected, PLAIN_TEXT_SUFFIXES)
+    n_bytes = sum(f.stat().st_size for f in files)
+
+    slow = sum(time_call(diff.diff, f, f, check_digest=False) for f in files)
+    fast = sum(time_call(diff.diff, f, f) for f in files)
+
+    print('Files compared:            {0} ({1:.1f} MB)'.format(len(files), n_bytes / 1e6))
+    print('Normalize + unified_diff:  {0:.2f} s'.format(slow))
+    print('BLAKE2 digest fast path:   {0:.2f} s'.format(fast))
+    print('Saved:                     {0:.2f} s ({1:.1f}x faster)'.format(
+        slow - fast, slow / fast if fast else float('inf'),
+    ))
+
+
+def chained_substitute_line(line):
+    """The original normalizer: eight regex substitutions run one after another."""
+    line = diff.FLOAT_REGEXP.sub(diff.round_float, line)
+    line = diff.DATETIME_REGEXP.sub('2024-01-11 12:34:56', line)
+    line = diff.COMMAND_HTML_REGEXP.sub('<p>Command used: <command></p>', line)
+    line = diff.COMMAND_LOG_REGEXP.sub('CRISPResso <parameters>', line)
+    line = diff.C2_ENV_PATH_REGEXP.sub('@PG CRISPResso <parameters>', line)
+    line = diff.OUTPUT_REGEXP.sub('CRISPResso2_tests/cli_integration_tests/CRISPResso', line)
+    line = diff.SAM_HEADER_BOWTIE_VERSION_REGEXP.sub(r'@PG\tID:bowtie2\tPN:bowtie2\tVN:2.5.4\tCL:bowtie2-align-s <parameters>', line)
+    line = diff.SAM_HEADER_REGEXP.sub(r'@HD\tVN:1.0\tSO:unsorted', line)
+    return line
+
+
+def load_allele_table_lines(root):
+    """Read every line of the allele tables (plain and zipped) under *root*."""
+    lines = []
+    for f in sorted(Path(root).glob('**/Alleles_frequency_table*')):
+        if f.suffix == '.txt':
+            with open(f) as fh:
+                lines.extend(fh)
+        elif f.suffix == '.zip':
+            with zipfile.ZipFile(f) as zf:
+                for name in zf.namelist():
+                    with zf.open(name) as member:
+                        lines.extend(io.TextIOWrapper(member))
+    return lines
+
+
+def bench_normalize(args):
+    """Lines per second of the chained and single-pass normalizers on allele tables."""
+    lines = load_allele_table_lines(args.expected)
+    normalize = diff.get_line_normalizer('.txt')
+
+    def run(func):
+        start = time.perf_counter()
+        out = [func(line) for line in lines]
+        return time.perf_counter() - start, out
+
+    chained_time, chained_out = run(chained_substitute_line)
+    single_time, single_out = run(normalize)
+    mismatches = sum(a != b for a, b in zip(chained_out, single_out))
+
+    print('Allele table lines:        {0} ({1:.1f} MB)'.format(
+        len(lines), sum(len(line) for line in lines) / 1e6,
+    ))
+    print('Chained regex subs:        {0:,.0f} lines/s'.format(len(lines) / chained_time))
+    print('Single-pass normalizer:    {0:,.0f} lines/s ({1:.1f}x)'.format(
+        len(lines) / single_time, chained_time / single_time,
+    ))
+    print('Lines normalized differently: {0}'.format(mismatches))
+
+
+def per_cell_read_numeric_table(path):
+    """The original table parser: float() and int() tried on every cell."""
+    import numpy as np
+    with open(path) as fh:
+        rows = [line.rstrip('\r\n').split('\t') for line in fh]
+    n_cols = len(rows[0]) if rows else 0
+    if any(len(row) != n_cols for row in rows):
+        return None
+    values = np.full((len(rows), n_cols), np.nan)
+    numeric = np.zeros((len(rows), n_cols), dtype=bool)
+    integer = np.zeros((len(rows), n_cols), dtype=bool)
+    for i, row in enumerate(rows):
+        for j, cell in enumerate(row):
+            try:
+                values[i, j] = float(cell)
+            except ValueError:
+                continue
+            numeric[i, j] = True
+            integer[i, j] = diff._is_integer_cell(cell)
+    return rows, values, numeric, integer
+
+
+def bench_tables(args):
+    """Time parsing every numeric table cell by cell and with the vectorized parser."""
+    if not diff.NUMPY_AVAILABLE:
+        print('NumPy is not installed; skipping.')
+        return
+    import numpy as np
+    files = [
+        f for f in collect_files(args.expected, ('.txt',))
+        if diff.comparator_for(f.relative_to(args.expected).as_posix()) == 'table'
+    ]
+    per_cell = vectorized = 0.0
+    mismatches = 0
+    for f in files:
+        start = time.perf_counter()
+        table_per_cell = per_cell_read_numeric_table(f)
+        per_cell += time.perf_counter() - start
+        start = time.perf_counter()
+        table_vectorized = diff.read_numeric_table(f)
+        vectorized += time.perf_counter() - start
+        if table_per_cell is None or table_vectorized is None:
+            mismatches += table_per_cell is not table_vectorized
+        else:
+            mismatches += not (
+                np.array_equal(table_per_cell[1], table_vectorized[1], equal_nan=True)
+                and all((a == b).all() for a, b in zip(table_per_cell[2:], table_vectorized[2:]))
+            )
+
+    print('Tables parsed:             {0} ({1:.1f} MB)'.format(
+        len(files), sum(f.stat().st_size for f in files) / 1e6,
+    ))
+    print('float() per cell:          {0:.2f} s'.format(per_cell))
+    print('Vectorized parser:         {0:.2f} s ({1:.1f}x faster)'.format(
+        vectorized, per_cell / vectorized if vectorized else float('inf'),
+    ))
+    print('Tables parsed differently: {0}'.format(mismatches))
+
+
+def bench_pdf(args):
+    """Time text extraction from every PDF with the raw stream scan and the object-aware parser."""
+    files = collect_files(args.expected, diff.PDF_SUFFIXES)
+    raw = object_aware = 0.0
+    mismatches = 0
+    for f in files:
+        start = time.perf_counter()
+        texts_raw = diff.extract_pdf_text(f, object_aware=False)
+        raw += time.perf_counter() - start
+        start = time.perf_counter()
+        texts_object_aware = diff.extract_pdf_text(f)
+        object_aware += time.perf_counter() - start
+        mismatches += texts_raw != texts_object_aware
+
+    print('PDFs extracted:            {0}'.format(len(files)))
+    print('Raw stream scan:           {0:.2f} s'.format(raw))
+    print('Object-aware parser:       {0:.2f} s ({1:.1f}x faster)'.format(
+        object_aware, raw / object_aware if object_aware else float('inf'),
+    ))
+    print('PDFs extracted differently: {0}'.format(mismatches))
+
+
+def bench_images(args):
+    """Time diff_image on every PNG with and without the digest / dHash prefilter."""
+    if not diff.IMAGE_DEPS_AVAILABLE:
+        raise SystemExit('Pillow and NumPy are needed for the image benchmark.')
+    files = collect_files(args.expected, diff.IMAGE_SUFFIXES)
+
+    rmse = sum(time_call(diff.diff_image, f, f, prefilter=False) for f in files)
+    digest = sum(time_call(diff.diff_image, f, f) for f in files)
+    # The dHash path is what a re-rendered but visually identical actual
+    # PNG takes: hash the actual file, read the expected hash from the cache.
+    for f in files:
+        diff.load_image_signature(f)
+    dhash = sum(
+        time_call(lambda f: diff.signatures_match(diff.image_signature(f), diff.load_image_signature(f)), f)
+        for f in files
+    )
+
+    print('PNGs compared:             {0}'.format(len(files)))
+    print('Full RMSE comparison:      {0:.2f} s'.format(rmse))
+    print('Byte-digest prefilter:     {0:.2f} s ({1:.1f}x faster)'.format(
+        digest, rmse / digest if digest else float('inf'),
+    ))
+    print('dHash prefilter (cached):  {0:.2f} s ({1:.1f}x faster)'.format(
+        dhash, rmse / dhash if dhash else float('inf'),
+    ))
+
+
+def make_failure_set(files, every=20):
+    """Diff each file against a copy with every *every*-th line changed."""
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n, f in enumerate(files):
+            with open(f) as fh:
+                lines = fh.readlines()
+            for i in range(0, len(lines), every):
+                lines[i] = 'changed ' + lines[i]
+            changed = Path(tmp_dir) / '{0}{1}'.format(n, f.suffix)
+            changed.write_text(''.join(lines))
+            failures.append(diff.diff(changed, f, check_digest=False))
+    return failures
+
+
+def subprocess_print_diff(diff_results, devnull):
+    """The original print_diff: one temporary file and one ydiff pipeline per differing file."""
+    with tempfile.NamedTemporaryFile(mode='w') as fh:
+        fh.writelines(''.join(diff_results))
+        fh.flush()
+        subprocess.check_call(
+            'cat {0} | ydiff -s -w 0 --wrap -p cat'.format(fh.name), shell=True, stdout=devnull,
+        )
+
+
+def bench_render(args):
+    """Time rendering a large failure set with a ydiff subprocess per file vs in process."""
+    files = collect_files(args.expected, PLAIN_TEXT_SUFFIXES)[:args.limit]
+    failures = [lines for lines in make_failure_set(files) if lines]
+    n_lines = sum(len(lines) for lines in failures)
+
+    print('Differing files:           {0} ({1} diff lines)'.format(len(failures), n_lines))
+    with open(os.devnull, 'w') as devnull:
+        if shutil.which('ydiff'):
+            subprocess_time = sum(time_call(subprocess_print_diff, lines, devnull) for lines in failures)
+            print('ydiff subprocess per file: {0:.2f} s'.format(subprocess_time))
+        else:
+            subprocess_time = None
+            print('ydiff subprocess per file: skipped (ydiff is not on PATH)')
+        in_process_time = sum(
+            time_call(diff.print_diff, lines, side_by_side=True, out=devnull) for lines in failures
+        )
+    print('In process ({0}): {1:.2f} s'.format(
+        'ydiff library' if diff.YDIFF_INSTALLED else 'built-in renderer', in_process_time,
+    ))
+    if subprocess_time and in_process_time:
+        print('Speedup:                   {0:.1f}x'.format(subprocess_time / in_process_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.set_defaults(func=lambda _: parser.print_help())
+    parser.add_argument(
+        '--expected',
+        default=str(DEFAULT_EXPECTED_DIR),
+        help='Expected results tree to benchmark against. The default is'
+        ' `cli_integration_tests/expected_results`.',
+    )
+
+    subparsers = parser.add_subparsers()
+    parser_fast_path = subparsers.add_parser(
+        'fast-path', help='diff() with and without the identical-file digest check',
+    )
+    parser_fast_path.set_defaults(func=bench_fast_path)
+    parser_normalize = subparsers.add_parser(
+        'normalize', help='chained regex subs vs the single-pass line normalizer',
+    )
+    parser_normalize.set_defaults(func=bench_normalize)
+    parser_tables = subparsers.add_parser(
+        'tables', help='per-cell float() vs the vectorized numeric table parser',
+    )
+    parser_tables.set_defaults(func=bench_tables)
+    parser_pdf = subparsers.add_parser(
+        'pdf', help='raw stream scan vs object-aware PDF text extraction',
+    )
+    parser_pdf.set_defaults(func=bench_pdf)
+    parser_images = subparsers.add_parser(
+        'images', help='full RMSE vs the digest and perceptual-hash prefilters for PNGs',
+    )
+    parser_images.set_defaults(func=bench_images)
+    parser_render = subparsers.add_parser(
+        'render', help='per-file ydiff subprocess vs the in-process side-by-side renderer',
+    )
+    parser_render.add_argument(
+        '--limit', default=200, type=int, help='Number of text files to turn into failures.',
+    )
+    parser_render.set_defaults(func=bench_render)
+
+    args = parser.parse_args()
+    args.func(args)
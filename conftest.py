@@ -56,6 +56,47 @@ def pytest_addoption(parser):
         ' PDFs are diffed as text (drawing streams); PNGs are compared'
         ' using approximate RMSE (tolerant of rendering differences).',
     )
+    parser.addoption(
+        '--diff-jobs',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of processes used to compare output files against expected results.',
+    )
+    parser.addoption(
+        '--diff-incremental',
+        action='store_true',
+        default=False,
+        help='Only compare output files that changed since they last passed'
+        ' (verdicts are kept in .diffcache/incremental.json).',
+    )
+    parser.addoption(
+        '--diff-report-json',
+        action='store',
+        default=None,
+        help='Write one JSON line per compared output file (verdict, comparator, timing) to this path.',
+    )
+    parser.addoption(
+        '--diff-report-junit',
+        action='store',
+        default=None,
+        help='Write the per-file diff verdicts as a JUnit XML report to this path.',
+    )
+    parser.addoption(
+        '--diff-fail-fast',
+        action='store',
+        type=int,
+        default=None,
+        help='Stop comparing a test\'s output files after this many significant differences.',
+    )
+    parser.addoption(
+        '--diff-budget-seconds',
+        action='store',
+        type=float,
+        default=None,
+        help='Stop comparing a test\'s output files after this many seconds'
+        ' (files left unchecked fail the test).',
+    )
     parser.addoption(
         '--pro',
         action='store_true',
@@ -135,27 +176,70 @@ def diff_plots(request):
 
 
 @pytest.fixture(scope='session')
-def assert_no_diff(pro_installed, skip_html, diff_plots, cli_test_dir):
+def diff_jobs(request):
+    return request.config.getoption('--diff-jobs')
+
+
+@pytest.fixture(scope='session')
+def diff_incremental(request):
+    if request.config.getoption('--diff-incremental'):
+        return diff.IncrementalState()
+    return None
+
+
+@pytest.fixture(scope='session')
+def diff_budget(request):
+    """Return a factory for each test's DiffBudget, or None without --diff-fail-fast/--diff-budget-seconds."""
+    max_failures = request.config.getoption('--diff-fail-fast')
+    seconds = request.config.getoption('--diff-budget-seconds')
+    if not (max_failures or seconds):
+        return None
+    return lambda: diff.DiffBudget(max_failures, seconds)
+
+
+@pytest.fixture(scope='session')
+def diff_report(request):
+    json_path = request.config.getoption('--diff-report-json')
+    junit_path = request.config.getoption('--diff-report-junit')
+    if not (json_path or junit_path):
+        yield None
+        return
+    with diff.DiffReport(json_path, junit_path) as report:
+        yield report
+
+
+@pytest.fixture(scope='session')
+def assert_no_diff(pro_installed, skip_html, diff_plots, diff_jobs, diff_incremental, diff_report, diff_budget,
+                   cli_test_dir):
     expected_results = cli_test_dir / 'expected_results'
     expected_results_pro = cli_test_dir / 'expected_results_pro'
 
     def _assert(actual_dir):
         test_name = actual_dir.name
         has_diff = False
+        budget = diff_budget() if diff_budget else None
 
         # Data files — always compared against expected_results/
         expected_data = expected_results / test_name
         if not expected_data.exists():
             pytest.skip(f'Expected results not found: {expected_data}')
 
-        data_suffixes = DATA_SUFFIXES
+        data_suffixes = DATA_SUFFIXES + diff.default_diff_rules().extra_suffixes
         if diff_plots:
             data_suffixes = data_suffixes + diff.PDF_SUFFIXES
 
+        # Walk each tree once and share the index across all passes
+        actual_index = diff.ResultTreeIndex(actual_dir)
+        expected_index = diff.ResultTreeIndex(expected_data)
+
         has_diff |= diff.diff_dir(
-            str(actual_dir),
-            str(expected_data),
+            actual_index,
+            expected_index,
             suffixes=data_suffixes,
+            workers=diff_jobs,
+            incremental=diff_incremental,
+            report=diff_report,
+            budget=budget,
         )
 
         # HTML files
@@ -166,23 +250,35 @@ def assert_no_diff(pro_installed, skip_html, diff_plots, cli_test_dir):
                     pytest.skip(
                         f'Pro HTML expected results not found: {expected_html}'
                     )
+                expected_html = diff.ResultTreeIndex(expected_html)
             else:
-                expected_html = expected_data
+                expected_html = expected_index
             has_diff |= diff.diff_dir(
-                str(actual_dir),
-                str(expected_html),
+                actual_index,
+                expected_html,
                 suffixes=HTML_SUFFIXES,
+                workers=diff_jobs,
+                incremental=diff_incremental,
+                report=diff_report,
+                budget=budget,
             )
 
         # Approximate PNG image comparison
-        if diff_plots:
+        stop_reason = budget.stop_reason() if budget else None
+        if diff_plots and stop_reason:
+            print(f'Image comparison skipped: {stop_reason}')
+            has_diff = True
+        elif diff_plots:
             has_diff |= diff.diff_dir_images(
-                str(actual_dir),
-                str(expected_data),
+                actual_index,
+                expected_index,
+                workers=diff_jobs,
+                report=diff_report,
             )
 
         assert not has_diff, (
             f'Differences found for {test_name}'
+            + (f' ({stop_reason}, {budget.n_unchecked} file(s) not compared)' if stop_reason else '')
         )
 
     return _assert
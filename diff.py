@@ -1,21 +1,58 @@
 import argparse
+import gzip
+import hashlib
+import math
+import io
 import json
 import os
+import platform
 import re
+import sqlite3
+import statistics
+import struct
 import sys
 import subprocess
 import tempfile
+import threading
+import time
+import zipfile
 import zlib
-from datetime import timedelta
-from difflib import unified_diff
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher, unified_diff
+from fnmatch import fnmatchcase, translate as fnmatch_translate
+from functools import lru_cache, partial
+from itertools import islice, zip_longest
 from pathlib import Path
 from os.path import basename, join, dirname
-from shutil import copyfile
+from shutil import copyfile, copyfileobj, get_terminal_size, rmtree
+from xml.sax.saxutils import escape as xml_escape, quoteattr as xml_quoteattr
 
 try:
-    from PIL import Image, ImageFilter
     import numpy as np
-    IMAGE_DEPS_AVAILABLE = True
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import ydiff
+    YDIFF_INSTALLED = True
+except ImportError:
+    YDIFF_INSTALLED = False
+
+try:
+    from PIL import Image, ImageFilter, features as pil_features
+    IMAGE_DEPS_AVAILABLE = NUMPY_AVAILABLE
 except ImportError:
     IMAGE_DEPS_AVAILABLE = False
 
@@ -29,28 +66,202 @@ OUTPUT_REGEXP = re.compile(r'[\S]*/CRISPResso2[\S]*/cli_integration_tests/CRISPR
 PLOTLY_PATH_REGEXP = re.compile(r'/\S+/cli_integration_tests/')
 SAM_HEADER_BOWTIE_VERSION_REGEXP = re.compile(r'@PG\tID:bowtie2\tPN:bowtie2\tVN:.*')
 SAM_HEADER_REGEXP = re.compile(r'@HD\tVN:.*')
-IGNORE_FILES_REGEXP = re.compile(r'.*CRISPResso.*_RUNNING_LOG.txt')
-WARNING_FILE_REGEXP = re.compile(r'((CRISPResso2(Aggregate|Batch|Pooled|WGS|Compare)?)|fastp)_report.html')
+# samtools @PG lines: the version and the command line (with run-specific
+# output paths) vary between machines; ID/PN/PP are kept
+SAM_HEADER_SAMTOOLS_REGEXP = re.compile(r'\tVN:[^\t]*\tCL:samtools .*')
 
-IGNORE_SUFFIX = '_RUNNING_LOG.txt'
-TEXT_SUFFIXES = ('.txt', '.html', '.sam', '.vcf')
-DATA_SUFFIXES = ('.txt', '.sam', '.vcf')
+TEXT_SUFFIXES = ('.txt', '.html', '.sam', '.bam', '.vcf', '.zip', '.npz', '.json', '.gz')
+DATA_SUFFIXES = ('.txt', '.sam', '.bam', '.vcf', '.zip', '.npz', '.json', '.gz')
 HTML_SUFFIXES = ('.html',)
 PDF_SUFFIXES = ('.pdf',)
+ZIP_SUFFIXES = ('.zip',)
+NPZ_SUFFIXES = ('.npz',)
+JSON_SUFFIXES = ('.json',)
+ALIGNMENT_SUFFIXES = ('.sam', '.bam')
+GZIP_SUFFIXES = ('.gz',)
+FASTQ_SUFFIXES = ('.fastq', '.fq')
+
+# Per-file comparison rules (diff_rules.toml): glob patterns mapped to a
+# comparator, tolerances and a severity.  The file holds the ignored
+# (RUNNING_LOG) and warning-only (report.html) files.  The first matching
+# rule wins; a rule without a comparator, and every file no rule matches,
+# uses comparator_for, and a rule without a severity fails.
+DIFF_RULES_FILE = Path(__file__).parent / 'diff_rules.toml'
+DIFF_RULE_SEVERITIES = ('fail', 'warn', 'ignore')
+DIFF_RULE_COMPARATORS = ('pdf', 'zip', 'alignment', 'gzip', 'json', 'html', 'npz', 'alleles', 'table', 'text')
+DIFF_RULE_TOLERANCE_COMPARATORS = ('json', 'html', 'npz', 'alleles', 'table')
 
 # PDF stream detection patterns
 PDF_STREAM_REGEXP = re.compile(rb'stream\r?\n(.*?)endstream', re.DOTALL)
 PDF_FONT_KEYWORDS = ('GDEF', 'cmap', 'CIDInit')
+# Object-level parsing: xref table, object dictionaries, content streams
+PDF_STARTXREF_REGEXP = re.compile(rb'startxref\s+(\d+)\s+%%EOF\s*$')
+PDF_XREF_SUBSECTION_REGEXP = re.compile(rb'\s*(\d+)\s+(\d+)\s*?\r?\n')
+PDF_XREF_ENTRY_REGEXP = re.compile(rb'(\d{10}) (\d{5}) ([nf])')
+PDF_PAGE_REGEXP = re.compile(rb'/Type\s*/Page\b')
+PDF_FORM_REGEXP = re.compile(rb'/Subtype\s*/Form\b')
+PDF_CONTENTS_REGEXP = re.compile(rb'/Contents\s*(\[[^\]]*\]|\d+\s+\d+\s+R)')
+PDF_REF_REGEXP = re.compile(rb'(\d+)\s+\d+\s+R')
+PDF_LENGTH_REGEXP = re.compile(rb'/Length\s+(\d+)(\s+\d+\s+R)?')
+PDF_INTEGER_OBJECT_REGEXP = re.compile(rb'\d+\s+\d+\s+obj\s*(\d+)\s*endobj')
+# Text operators inside a content stream.  On Linux, matplotlib adds
+# inter-character kerning values that make TJ arrays wrap across lines:
+#   [ (\x00P) 17.43 (\x00r) 21.95
+#   (\x00edicted cleavage position) ]
+#   TJ
+PDF_TJ_ARRAY_REGEXP = re.compile(r'\[(.*?)\]\s*TJ', re.DOTALL)
+PDF_TJ_SINGLE_REGEXP = re.compile(r'\(((?:[^\\)]|\\.)*)\)\s*Tj')
+PDF_STRING_REGEXP = re.compile(r'\(((?:[^\\)]|\\.)*)\)')
 
 # PNG image comparison constants
 IMAGE_SUFFIXES = ('.png',)
 DEFAULT_IMAGE_THRESHOLD = 0.2  # RMSE threshold (0-1 scale); 0.10 = 10%
+# Structural comparison: windowed SSIM over the same blurred thumbnails.
+# Images differ when the mean dissimilarity (1 - SSIM) exceeds the threshold.
+IMAGE_METRICS = ('rmse', 'ssim')
+DEFAULT_IMAGE_METRIC = 'rmse'
+DEFAULT_SSIM_THRESHOLD = 0.1
+IMAGE_METRIC_THRESHOLDS = {'rmse': DEFAULT_IMAGE_THRESHOLD, 'ssim': DEFAULT_SSIM_THRESHOLD}
+SSIM_WINDOW = 7  # box filter size in thumbnail pixels
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_HEATMAP_GRID = (8, 8)  # regions (rows, columns) in the dissimilarity heatmap
 IMAGE_THUMBNAIL_SIZE = (256, 256)  # Downscale target for comparison
 IMAGE_BLUR_RADIUS = 1  # Gaussian blur to smooth anti-aliasing / font noise
+# Images are box-reduced by integer factors until within this factor of the
+# thumbnail size before the final LANCZOS resize (see Image.resize).
+IMAGE_REDUCING_GAP = 3.0
+# Perceptual-hash prefilter: a 64-bit dHash from a 9x8 grayscale reduction.
+# Pairs with equal hashes whose reductions are also within
+# IMAGE_HASH_MAX_RMSE skip the full RMSE comparison.
+IMAGE_HASH_SIZE = (9, 8)
+IMAGE_HASH_MAX_RMSE = 0.005
+# Plot comparison reports link downscaled copies of the PNGs (lossless WebP
+# when Pillow was built with it, PNG otherwise) instead of embedding them.
+PLOT_REPORT_THUMBNAIL_SIZE = (1000, 1000)
+PLOT_REPORT_WEBP_METHOD = 2  # 0 (fast) - 6 (small); lossless size barely changes
+
+# Files are hashed in chunks of this many bytes for the identical-file fast path
+DIGEST_CHUNK_SIZE = 1 << 20
+
+# On-disk cache of normalized expected-file contents
+DIFF_CACHE_DIR = Path(__file__).parent / '.diffcache'
+DIFF_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Bump when a normalization or extraction *function* changes behaviour;
+# changes to the regexes / rules themselves are picked up automatically.
+DIFF_CACHE_FORMAT = 2
+# Comparator settings that decide verdicts; their values are part of the
+# cache version, so --incremental rechecks every file when one changes.
+VERDICT_SETTINGS = (
+    'DEFAULT_JSON_ATOL', 'DEFAULT_JSON_RTOL', 'JSON_IGNORE_PATHS',
+    'DEFAULT_TABLE_ATOL', 'DEFAULT_TABLE_RTOL', 'NUMERIC_TABLE_REGEXP',
+    'ALLELE_TABLE_REGEXP', 'ALLELE_TABLE_KEY_COLUMNS', 'ALLELE_TABLE_COUNT_COLUMNS',
+    'DEFAULT_ARRAY_ATOL', 'DEFAULT_ARRAY_RTOL', 'PLOTLY_ARGUMENTS',
+)
+# Verdicts of the last run, for --incremental
+INCREMENTAL_STATE_FILE = DIFF_CACHE_DIR / 'incremental.json'
+# Files left unchecked by --fail-fast / --diff-budget-seconds listed before truncating
+DIFF_BUDGET_MAX_LISTED_FILES = 20
+# Running-time history (see RunningTimeHistory)
+PERF_HISTORY_DB = DIFF_CACHE_DIR / 'running_times.sqlite'
+PERF_HISTORY_WINDOW = 20  # most recent comparable runs behind the median / MAD
+PERF_HISTORY_MIN_RUNS = 5  # below this, fall back to the expected-result check
+PERF_HISTORY_MAX_DEVIATIONS = 3.5  # robust z-score above which a run is reported
+PERF_HISTORY_MIN_SPREAD = 0.05  # spread floor (fraction of the median) for near-constant histories
+MAD_SCALE = 1.4826  # scales the MAD to a standard deviation for normal data
+SPARKLINE_BLOCKS = '\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+# Files at least this large are diffed with the streaming comparator
+STREAM_DIFF_MIN_BYTES = 1024 * 1024
+STREAM_DIFF_WINDOW = 200  # lines read past the first divergence
+HUNK_HEADER_REGEXP = re.compile(r'@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@')
+
+# Numeric TSV outputs compared cell by cell with a tolerance instead of as text
+NUMERIC_TABLE_REGEXP = re.compile(
+    r'(quantification_of_editing_frequency|Effect_vector_|histogram'
+    r'|[Nn]ucleotide_(frequency|percentage)_(table|summary)'
+    r'|[Mm]odification_count_vectors)[^/]*\.txt$'
+)
+DEFAULT_TABLE_ATOL = 1e-3
+DEFAULT_TABLE_RTOL = 1e-5
+TABLE_DIFF_MAX_CELLS = 50  # differing cells listed before truncating
+
+# Allele frequency tables (plain and inside Alleles_frequency_table.zip) are
+# sorted by read count, so alleles with tied counts can swap rows between
+# runs.  They are joined on every column except the counts instead.
+ALLELE_TABLE_REGEXP = re.compile(r'Alleles_frequency_table[^/]*\.txt$')
+ALLELE_TABLE_KEY_COLUMNS = ('Aligned_Sequence', 'Reference_Sequence')
+ALLELE_TABLE_COUNT_COLUMNS = ('#Reads', '%Reads')
+ALLELE_DIFF_MAX_ROWS = 50  # differing alleles listed before truncating
+
+# NumPy archive comparison (.npz)
+DEFAULT_ARRAY_ATOL = 1e-8
+DEFAULT_ARRAY_RTOL = 1e-5
+ZIP_LOCAL_HEADER_SIZE = 30  # fixed part of a zip local file header
+
+# Structural JSON comparison.  Ignore paths are fnmatch patterns over
+# dotted key paths (list items are numbered, e.g. `results.refs.FANC.0`).
+JSON_IGNORE_PATHS = (
+    'running_info.version',
+    'running_info.command_used',
+    'running_info.args_string',
+    'running_info.start_time*',
+    'running_info.end_time*',
+    'running_info.running_time*',
+    'command',  # fastp_report.json
+    'summary.fastp_version',
+)
+DEFAULT_JSON_ATOL = 1e-3
+DEFAULT_JSON_RTOL = 1e-5
+JSON_DIFF_MAX_PATHS = 50  # differing paths listed before truncating
+JSON_CACHE_SIZE = 256  # parsed documents kept by load_json
+# Number lists at least this long are compared as one NumPy array
+JSON_VECTORIZE_MIN_LENGTH = 16
+
+# HTML reports: the JSON arguments of each Plotly.newPlot(...) call are
+# compared structurally (numbers with the JSON tolerances), the markup
+# around them line by line.
+PLOTLY_NEWPLOT_REGEXP = re.compile(r'Plotly\.newPlot\(\s*')
+PLOTLY_ARG_SEPARATOR_REGEXP = re.compile(r'\s*(,?)\s*')
+PLOTLY_ARGUMENTS = ('data', 'layout', 'config')  # after the div id
+PLOTLY_PLACEHOLDER = 'Plotly.newPlot(<figure {0}>)'
+
+# SAM/BAM record comparison
+SAM_FIELDS = ('QNAME', 'FLAG', 'RNAME', 'POS', 'MAPQ', 'CIGAR', 'RNEXT', 'PNEXT', 'TLEN', 'SEQ', 'QUAL')
+ALIGNMENT_DIFF_MAX_RECORDS = 50  # differing records listed before truncating
+BAM_MAGIC = b'BAM\1'
+BAM_RECORD_STRUCT = struct.Struct('<iiBBHHHiiii')
+BAM_CIGAR_OPS = 'MIDNSHP=X'
+BAM_SEQ_BASES = '=ACMGRSVTWYHKDBN'
+BAM_TAG_INTEGER_TYPES = {'c': 'b', 'C': 'B', 's': 'h', 'S': 'H', 'i': 'i', 'I': 'I'}
+BAM_ARRAY_TYPES = {'c': 'b', 'C': 'B', 's': 'h', 'S': 'H', 'i': 'i', 'I': 'I', 'f': 'f'}
+
+# Compressed FASTQ comparison
+FASTQ_DIFF_MAX_RECORDS = 20  # differing records listed before truncating
+MULTISET_HASH_MODULUS = 1 << 128
 
 # PDF diff truncation
 PDF_DIFF_MAX_LINES = 100
 
+# Side-by-side rendering of diffs on a terminal (see render_side_by_side)
+ANSI_ESCAPE_REGEXP = re.compile(r'(\033\[[0-9;]*m)')
+ANSI_RESET = '\033[0m'
+DIFF_COLORS = {
+    'header': '\033[36m',
+    'old_path': '\033[33m',
+    'new_path': '\033[33m',
+    'hunk': '\033[34m',
+    'old': '\033[31m',
+    'new': '\033[32m',
+    'old_text': '\033[7;31m',
+    'new_text': '\033[7;32m',
+    'line_number': '\033[33m',
+}
+DIFF_COLUMN_MARKERS = {'context': '   ', 'changed': ' | ', 'removed': ' < ', 'added': ' > '}
+DIFF_TAB_WIDTH = 8
+DIFF_MIN_COLUMN_WIDTH = 20
+DIFF_DEFAULT_TERMINAL_SIZE = (160, 24)
+
 # Axis tick labels: purely numeric strings (integers, decimals, negatives)
 # that matplotlib's AutoLocator generates in a platform-dependent way.
 # Filtered from PDF text comparison because tick intervals depend on font
@@ -58,29 +269,6 @@ PDF_DIFF_MAX_LINES = 100
 NUMERIC_TICK_REGEXP = re.compile(r'^-?\d[\d,]*\.?\d*$')
 
 
-def which(program):
-    def is_exe(fpath):
-        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
-
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return program
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
-
-    return None
-
-
-YDIFF_INSTALLED = which('ydiff')
-if not YDIFF_INSTALLED:
-    print('ydiff is not installed. Install it (`pip install ydiff`) for better diffs.')
-
-
 def round_float(f):
     """Round float to 3 decimal places
 
@@ -97,50 +285,2031 @@ def round_float(f):
     return str(round(float(f.group(0)), 3))
 
 
-def substitute_line(line):
+NormalizationRule = namedtuple('NormalizationRule', ['regexp', 'replacement', 'trigger', 'suffixes'])
+NormalizationRule.__doc__ = """A single normalization substitution applied by :class:`LineNormalizer`.
+
+regexp : re.Pattern
+    Pattern to replace.  Only ``group(0)`` is used by the replacement.
+replacement : str or callable
+    Literal replacement text, or a function of the match returning it.
+trigger : str
+    Literal substring that every match contains.  Lines without it skip
+    the rule entirely.
+suffixes : tuple or None
+    File suffixes the rule applies to, or ``None`` for all files.
+"""
+
+# Order matters when two rules can match at the same position: the first
+# listed wins, mirroring the order the substitutions used to be chained in.
+NORMALIZATION_RULES = (
+    NormalizationRule(COMMAND_HTML_REGEXP, '<p>Command used: <command></p>', 'Command used:', None),
+    NormalizationRule(COMMAND_LOG_REGEXP, 'CRISPResso <parameters>', 'Command used:', None),
+    NormalizationRule(C2_ENV_PATH_REGEXP, '@PG CRISPResso <parameters>', '@PG', ('.sam',)),
+    NormalizationRule(
+        SAM_HEADER_BOWTIE_VERSION_REGEXP,
+        '@PG\tID:bowtie2\tPN:bowtie2\tVN:2.5.4\tCL:bowtie2-align-s <parameters>',
+        '@PG',
+        ('.sam',),
+    ),
+    NormalizationRule(SAM_HEADER_REGEXP, '@HD\tVN:1.0\tSO:unsorted', '@HD', ('.sam',)),
+    NormalizationRule(SAM_HEADER_SAMTOOLS_REGEXP, '\tVN:<version>\tCL:samtools <parameters>', 'CL:samtools', ('.sam',)),
+    NormalizationRule(OUTPUT_REGEXP, 'CRISPResso2_tests/cli_integration_tests/CRISPResso', '/cli_integration_tests/CRISPResso', None),
+    NormalizationRule(DATETIME_REGEXP, '2024-01-11 12:34:56', ':', None),
+    NormalizationRule(FLOAT_REGEXP, round_float, '.', None),
+)
+
+
+class LineNormalizer(object):
+    """Apply normalization rules to a line in a single regex pass.
+
+    All rules that can match a line are compiled into one alternation
+    pattern, and a single callback dispatches each match to the rule
+    whose group matched.  Rules whose ``trigger`` substring is absent
+    from the line are left out of the pattern, so the common case (a
+    table row where only floats can match) scans the line once with just
+    the float rule.  The compiled pattern for each combination of rules
+    is cached.
+
+    Parameters
+    ----------
+    rules : sequence of NormalizationRule
+        Rules to apply, in priority order.
+    suffix : str or None
+        File suffix (e.g. ``'.txt'``).  Rules restricted to other
+        suffixes are dropped.  ``None`` keeps every rule.
+    """
+
+    def __init__(self, rules=NORMALIZATION_RULES, suffix=None):
+        self.rules = tuple(
+            rule for rule in rules
+            if suffix is None or rule.suffixes is None or suffix in rule.suffixes
+        )
+        self._subs = {}
+
+    def _compile(self, mask):
+        rules = [rule for rule, active in zip(self.rules, mask) if active]
+        group_rules = {}
+        alternatives = []
+        group = 1
+        for rule in rules:
+            group_rules[group] = rule.replacement
+            alternatives.append('({0})'.format(rule.regexp.pattern))
+            group += rule.regexp.groups + 1
+        pattern = re.compile('|'.join(alternatives))
+
+        def dispatch(match):
+            replacement = group_rules[match.lastindex]
+            if callable(replacement):
+                return replacement(match)
+            return replacement
+
+        sub = partial(pattern.sub, dispatch)
+        self._subs[mask] = sub
+        return sub
+
+    def __call__(self, line):
+        mask = tuple(rule.trigger in line for rule in self.rules)
+        if not any(mask):
+            return line
+        sub = self._subs.get(mask) or self._compile(mask)
+        return sub(line)
+
+
+_LINE_NORMALIZERS = {}
+
+
+def get_line_normalizer(suffix=None):
+    """Return the shared :class:`LineNormalizer` for a file suffix.
+
+    Parameters
+    ----------
+    suffix : str or None
+        File suffix, or ``None`` to apply every rule.
+
+    Returns
+    -------
+    LineNormalizer
+    """
+    if suffix not in _LINE_NORMALIZERS:
+        _LINE_NORMALIZERS[suffix] = LineNormalizer(NORMALIZATION_RULES, suffix)
+    return _LINE_NORMALIZERS[suffix]
+
+
+def substitute_line(line, suffix=None):
     """Substitute floats and datetimes in a line
 
     Parameters
     ----------
     line : str
         Line to substitute
+    suffix : str or None
+        Suffix of the file the line comes from.  Rules that only apply to
+        other file types (e.g. SAM headers) are skipped.  ``None`` applies
+        every rule.
+
+    Returns
+    -------
+    str
+        Line with floats and datetimes substituted
+    """
+    return get_line_normalizer(suffix)(line)
+
+
+def file_digest(path):
+    """Compute the BLAKE2b digest of a file's raw bytes.
+
+    The file is read in ``DIGEST_CHUNK_SIZE`` chunks so memory use does
+    not depend on the file size.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the file.
+
+    Returns
+    -------
+    str
+        Hex digest of the file contents.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def files_identical(file_a, file_b):
+    """Check whether two files have byte-identical contents.
+
+    Compares sizes first (a single ``stat``) and only hashes both files
+    when the sizes agree.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first file.
+    file_b : str or Path
+        Path to the second file.
+
+    Returns
+    -------
+    bool
+        True if both files contain exactly the same bytes.
+    """
+    if os.path.getsize(file_a) != os.path.getsize(file_b):
+        return False
+    return cached_file_digest(file_a) == cached_file_digest(file_b)
+
+
+_FILE_DIGESTS = {}
+
+
+def cached_file_digest(path):
+    """Return :func:`file_digest` for *path*, memoized on size and mtime.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the file.
+
+    Returns
+    -------
+    str
+        Hex digest of the file contents.
+    """
+    stat = os.stat(path)
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _FILE_DIGESTS:
+        _FILE_DIGESTS[key] = file_digest(path)
+    return _FILE_DIGESTS[key]
+
+
+def cache_version():
+    """Fingerprint the normalization rules, extraction patterns and tolerances.
+
+    Any change to a regex, replacement, trigger or suffix restriction in
+    this module, or to one of the ``VERDICT_SETTINGS``, yields a different
+    version, which moves the cache to a fresh directory and lets the old
+    entries be pruned, and discards the :class:`IncrementalState`.
+
+    Returns
+    -------
+    str
+        Short hex fingerprint.
+    """
+    parts = [str(DIFF_CACHE_FORMAT)]
+    for rule in NORMALIZATION_RULES:
+        replacement = rule.replacement
+        if callable(replacement):
+            replacement = replacement.__qualname__
+        parts.append(repr((rule.regexp.pattern, replacement, rule.trigger, rule.suffixes)))
+    parts.append(repr((PDF_STREAM_REGEXP.pattern, PDF_FONT_KEYWORDS)))
+    parts.append(repr((PDF_TJ_ARRAY_REGEXP.pattern, PDF_TJ_SINGLE_REGEXP.pattern, PDF_STRING_REGEXP.pattern)))
+    parts.append(repr(IMAGE_HASH_SIZE))
+    for name in VERDICT_SETTINGS:
+        value = globals()[name]
+        parts.append('{0}={1!r}'.format(name, getattr(value, 'pattern', value)))
+    return hashlib.blake2b('\n'.join(parts).encode(), digest_size=8).hexdigest()
+
+
+class NormalizedCache(object):
+    """Size-bounded on-disk LRU cache of normalized expected-file contents.
+
+    Entries are keyed by the digest of the raw file plus a namespace (the
+    kind of normalization applied) and live under ``<root>/<version>/``,
+    where *version* is :func:`cache_version`.  Reading an entry refreshes
+    its mtime; when the cache grows past *max_bytes* the least recently
+    used entries are deleted.  Directories left by other versions are
+    removed the first time this cache writes.
+
+    Writes go through a temporary file and ``os.replace`` so concurrent
+    worker processes never see partial entries.  Within a process the
+    size tracking and eviction are guarded by a lock, since image
+    signatures are stored from worker threads.
+
+    Parameters
+    ----------
+    root : str or Path
+        Cache directory.
+    max_bytes : int
+        Maximum total size of the cache entries.
+    version : str or None
+        Cache version, defaults to :func:`cache_version`.
+    """
+
+    def __init__(self, root=DIFF_CACHE_DIR, max_bytes=DIFF_CACHE_MAX_BYTES, version=None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.version = version or cache_version()
+        self.directory = self.root / self.version
+        self._size = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _entry(self, namespace, digest, extension):
+        return self.directory / '{0}-{1}{2}'.format(namespace, digest, extension)
+
+    def _read(self, path):
+        try:
+            with open(path) as fh:
+                data = fh.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def _write(self, path, data):
+        with self._lock:
+            if self._size is None:
+                self._prune_stale_versions()
+                self._size = sum(f.stat().st_size for f in self.directory.glob('*') if f.is_file())
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.directory), suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(data)
+        with self._lock:
+            os.replace(tmp_path, str(path))
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def _prune_stale_versions(self):
+        if not self.root.is_dir():
+            return
+        for child in self.root.iterdir():
+            if child.is_dir() and child.name != self.version:
+                rmtree(str(child), ignore_errors=True)
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in *max_bytes*."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for f in self.directory.glob('*'):
+            if f.suffix == '.tmp':  # being written by another thread
+                continue
+            try:
+                stat = f.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                f.unlink()
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def open_lines(self, namespace, digest):
+        """Open cached normalized lines for streaming, or return None on a miss."""
+        path = self._entry(namespace, digest, '.txt')
+        try:
+            handle = open(path)
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return handle
+
+    def get_lines(self, namespace, digest):
+        """Return cached normalized lines, or None on a miss."""
+        data = self._read(self._entry(namespace, digest, '.txt'))
+        if data is None:
+            return None
+        return data.splitlines(True)
+
+    def put_lines(self, namespace, digest, lines):
+        """Store normalized lines (each ending in a single newline)."""
+        self._write(self._entry(namespace, digest, '.txt'), ''.join(lines))
+
+    def get_json(self, namespace, digest):
+        """Return a cached JSON value, or None on a miss."""
+        data = self._read(self._entry(namespace, digest, '.json'))
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    def put_json(self, namespace, digest, value):
+        """Store a JSON-serializable value."""
+        self._write(self._entry(namespace, digest, '.json'), json.dumps(value))
+
+
+DIFF_CACHE = NormalizedCache()
+
+
+class IncrementalState(object):
+    """Per-file verdicts from previous runs, used by ``--incremental``.
+
+    For every compared actual file the state records the expected file it
+    was compared to, the digests of both, and whether they matched.  A
+    pair whose digests are unchanged since a passing comparison does not
+    need to be diffed again.  Failures are always rechecked, so their
+    diffs are printed on every run.  The state is discarded when
+    :func:`cache_version` changes.
+
+    Parameters
+    ----------
+    path : str or Path
+        The JSON state file.
+    """
+
+    def __init__(self, path=INCREMENTAL_STATE_FILE):
+        self.path = Path(path)
+        self.version = cache_version()
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        if state.get('version') != self.version:
+            return {}
+        return state.get('files', {})
+
+    @staticmethod
+    def _key(file_actual):
+        return str(Path(file_actual).resolve())
+
+    @staticmethod
+    def _fingerprint(file_actual, file_expected, rule):
+        return [
+            str(Path(file_expected).resolve()),
+            cached_file_digest(file_actual),
+            cached_file_digest(file_expected),
+            list(rule) if rule is not None else None,
+        ]
+
+    def is_cached_pass(self, file_actual, file_expected, rule=None):
+        """Return True if this pair passed before, under the same rule, and neither file has changed."""
+        entry = self.entries.get(self._key(file_actual))
+        return (
+            entry is not None
+            and entry['passed']
+            and entry['fingerprint'] == self._fingerprint(file_actual, file_expected, rule)
+        )
+
+    def record(self, file_actual, file_expected, passed, rule=None):
+        """Remember the verdict for a pair that was just compared."""
+        self.entries[self._key(file_actual)] = {
+            'fingerprint': self._fingerprint(file_actual, file_expected, rule),
+            'passed': passed,
+        }
+
+    def save(self):
+        """Write the state, merged over entries saved by concurrent runs."""
+        entries = self._load()
+        entries.update(self.entries)
+        self.entries = entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.path.parent), suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({'version': self.version, 'files': entries}, fh)
+        os.replace(tmp_path, str(self.path))
+
+
+class DiffReport(object):
+    """Machine-readable record of every comparison, written as it happens.
+
+    Each call to :meth:`record` appends one JSON object per line to
+    *json_path* (flushed immediately, so a crashed or cancelled run still
+    leaves every finished comparison on disk) and one ``<testcase>`` to
+    *junit_path*.  JUnit needs the totals in the ``<testsuite>`` tag, so
+    test cases are spooled to ``<junit_path>.partial`` and the final file
+    is assembled by :meth:`close`.
+
+    Parameters
+    ----------
+    json_path : str, Path or None
+        JSON Lines output.
+    junit_path : str, Path or None
+        JUnit XML output.
+    """
+
+    # Verdicts that count as JUnit failures; 'warning' and 'cached' pass.
+    FAILURE_MESSAGES = {
+        'fail': '{diff_lines} diff line(s)',
+        'new': 'New file not found in Expected',
+        'missing': 'Missing file from Actual',
+        'unchecked': 'Not compared: {reason}',
+    }
+
+    def __init__(self, json_path=None, junit_path=None):
+        self.json_file = open(json_path, 'w', buffering=1) if json_path else None
+        self.junit_path = Path(junit_path) if junit_path else None
+        self.junit_partial = None
+        if self.junit_path:
+            self.junit_partial = open(str(self.junit_path) + '.partial', 'w+')
+        self.n_tests = 0
+        self.n_failures = 0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, suite, path, comparator, verdict, seconds=None, diff_lines=0, **extra):
+        """Write one comparison.
+
+        Parameters
+        ----------
+        suite : str
+            Name of the compared tree (the actual directory's name).
+        path : str or Path
+            Path of the file relative to the tree.
+        comparator : str or None
+            Comparator that handled the pair (see :func:`comparator_for`),
+            ``'image'`` for PNGs, or None for other new and missing files.
+        verdict : str
+            ``'pass'``, ``'fail'``, ``'warning'``, ``'cached'``, ``'new'``,
+            ``'missing'`` or ``'unchecked'`` (left out by a
+            :class:`DiffBudget`, with the ``reason``).
+        seconds : float or None
+            Time spent comparing the pair.
+        diff_lines : int
+            Number of diff lines reported for the pair.
+        **extra
+            Further JSON-serializable fields, e.g. ``rmse``.
+        """
+        entry = dict(
+            suite=suite, path=str(path), comparator=comparator, verdict=verdict,
+            seconds=None if seconds is None else round(seconds, 6), diff_lines=diff_lines,
+        )
+        entry.update(extra)
+        if self.json_file:
+            self.json_file.write(json.dumps(entry) + '\n')
+        if self.junit_partial:
+            self._write_testcase(entry)
+
+    def _write_testcase(self, entry):
+        self.n_tests += 1
+        self.seconds += entry['seconds'] or 0.0
+        self.junit_partial.write('    <testcase classname={0} name={1} time="{2:.6f}">'.format(
+            xml_quoteattr(entry['suite']), xml_quoteattr(entry['path']), entry['seconds'] or 0.0,
+        ))
+        if entry['verdict'] in self.FAILURE_MESSAGES:
+            self.n_failures += 1
+            self.junit_partial.write('<failure type={0} message={1} />'.format(
+                xml_quoteattr(entry['verdict']),
+                xml_quoteattr(self.FAILURE_MESSAGES[entry['verdict']].format(**entry)),
+            ))
+        elif entry['verdict'] == 'cached':
+            self.junit_partial.write('<system-out>{0}</system-out>'.format(
+                xml_escape('unchanged since it last passed'),
+            ))
+        self.junit_partial.write('</testcase>\n')
+
+    def close(self):
+        """Flush the JSON Lines file and assemble the JUnit XML file."""
+        if self.json_file:
+            self.json_file.close()
+            self.json_file = None
+        if self.junit_partial:
+            self.junit_partial.seek(0)
+            with open(self.junit_path, 'w') as fh:
+                fh.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                fh.write('<testsuite name="diff" tests="{0}" failures="{1}" errors="0" time="{2:.6f}">\n'.format(
+                    self.n_tests, self.n_failures, self.seconds,
+                ))
+                copyfileobj(self.junit_partial, fh)
+                fh.write('</testsuite>\n')
+            self.junit_partial.close()
+            os.remove(self.junit_partial.name)
+            self.junit_partial = None
+
+
+class DiffBudget(object):
+    """When to stop comparing a broken run: fail-fast and a time budget.
+
+    One budget is shared by the :func:`diff_dir` passes of a test (data
+    files, then HTML), so once the data files have used it up the HTML
+    pass stops at once.  Files whose contents are left uncompared are
+    listed, recorded as ``'unchecked'`` in the :class:`DiffReport`, and
+    make the test fail.  New and missing files are always reported, since
+    finding them compares nothing.
+
+    Parameters
+    ----------
+    max_failures : int or None
+        Stop after this many files with severity ``fail`` differ, are
+        new or are missing.
+    seconds : float or None
+        Do not start new comparisons once this many seconds have passed
+        since the budget was created.
+    """
+
+    def __init__(self, max_failures=None, seconds=None):
+        self.max_failures = max_failures
+        self.seconds = seconds
+        self.deadline = None if seconds is None else time.perf_counter() + seconds
+        self.n_failures = 0
+        self.n_unchecked = 0
+
+    def record_failure(self):
+        """Count one significant difference (or new or missing file)."""
+        self.n_failures += 1
+
+    def stop_reason(self):
+        """Return why comparing should stop, or None while budget is left."""
+        if self.max_failures and self.n_failures >= self.max_failures:
+            return 'stopped after {0} significant difference(s) (fail-fast)'.format(self.n_failures)
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            return 'diff time budget of {0:g} s used up'.format(self.seconds)
+        return None
+
+    def skip(self, suite, file_rels, report=None):
+        """Report the files that are left unchecked; return True if there are any."""
+        if not file_rels:
+            return False
+        reason = self.stop_reason()
+        self.n_unchecked += len(file_rels)
+        print('\033[93mSTOPPED\033[0m {0}; {1} file(s) in {2} not compared:'.format(reason, len(file_rels), suite))
+        for file_rel in file_rels[:DIFF_BUDGET_MAX_LISTED_FILES]:
+            print('    {0}'.format(file_rel))
+        if len(file_rels) > DIFF_BUDGET_MAX_LISTED_FILES:
+            print('    ... and {0} more'.format(len(file_rels) - DIFF_BUDGET_MAX_LISTED_FILES))
+        if report is not None:
+            for file_rel in file_rels:
+                report.record(suite, file_rel, None, 'unchecked', reason=reason)
+        return True
+
+
+def normalize_lines(lines, suffix=None):
+    """Normalize an iterable of lines the way :func:`diff` compares them."""
+    normalize = get_line_normalizer(suffix)
+    return [normalize(line).strip() + '\n' for line in lines]
+
+
+def load_normalized_lines(path):
+    """Read and normalize a text file, using ``DIFF_CACHE`` when enabled.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the file (normally an expected result).
+
+    Returns
+    -------
+    list of str
+        Normalized lines, each ending in a newline.
+    """
+    suffix = Path(path).suffix
+    cache = DIFF_CACHE
+    if cache is None:
+        with open(path) as fh:
+            return normalize_lines(fh, suffix)
+    namespace = 'text' + suffix
+    digest = cached_file_digest(path)
+    lines = cache.get_lines(namespace, digest)
+    if lines is None:
+        with open(path) as fh:
+            lines = normalize_lines(fh, suffix)
+        cache.put_lines(namespace, digest, lines)
+    return lines
+
+
+@contextmanager
+def open_normalized_lines(path):
+    """Open a text file as a lazy iterator of normalized lines.
+
+    Streams the cached normalized copy from ``DIFF_CACHE`` when there is
+    one, otherwise normalizes the raw file line by line.  Nothing is
+    written to the cache, since a streaming reader may stop early.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the file (normally an expected result).
+
+    Yields
+    ------
+    iterator of str
+        Normalized lines, each ending in a newline.
+    """
+    suffix = Path(path).suffix
+    handle = None
+    if DIFF_CACHE is not None:
+        handle = DIFF_CACHE.open_lines('text' + suffix, cached_file_digest(path))
+    if handle is None:
+        handle = open(path)
+        normalize = get_line_normalizer(suffix)
+        lines = (normalize(line).strip() + '\n' for line in handle)
+    else:
+        lines = iter(handle)
+    try:
+        yield lines
+    finally:
+        handle.close()
+
+
+def _offset_hunk_header(line, offset):
+    match = HUNK_HEADER_REGEXP.match(line)
+    if not match:
+        return line
+    return '@@ -{0}{1} +{2}{3} @@{4}'.format(
+        int(match.group(1)) + offset, match.group(2) or '',
+        int(match.group(3)) + offset, match.group(4) or '',
+        line[match.end():],
+    )
+
+
+def stream_diff(lines_a, lines_b, context=3, window=STREAM_DIFF_WINDOW):
+    """Diff two line iterables in lockstep, stopping at the first divergence.
+
+    Lines are consumed one pair at a time and only the last *context*
+    matching lines are kept, so memory stays flat however long the
+    inputs are.  At the first differing line up to *window* further
+    lines are read from each side and a unified diff of just that region
+    is returned, with hunk headers numbered against the whole file.
+
+    After an insertion or deletion the two windows end at different
+    places in the file, so their last lines do not pair up.  Unless both
+    inputs ended inside the window, the region is cut after the last
+    lines the two windows share, which keeps that edge out of the diff.
+
+    Parameters
+    ----------
+    lines_a : iterable of str
+        Lines of the first file (actual).
+    lines_b : iterable of str
+        Lines of the second file (expected).
+    context : int
+        Number of context lines around the differing region.
+    window : int
+        Number of lines read past the first divergence on each side.
+
+    Returns
+    -------
+    list of str
+        Unified diff lines for the first differing region, followed by a
+        note when the comparison stopped before the end of either input.
+        Empty if the inputs are equal.
+    """
+    lines_a = iter(lines_a)
+    lines_b = iter(lines_b)
+    before = deque(maxlen=context)
+    line_number = 0
+    for line_a, line_b in zip_longest(lines_a, lines_b):
+        if line_a == line_b:
+            before.append(line_a)
+            line_number += 1
+            continue
+        region_a = list(before) + ([line_a] if line_a is not None else []) + list(islice(lines_a, window))
+        region_b = list(before) + ([line_b] if line_b is not None else []) + list(islice(lines_b, window))
+        more_a, more_b = next(lines_a, None) is not None, next(lines_b, None) is not None
+        if more_a or more_b:
+            # the last block is the (len_a, len_b, 0) sentinel
+            blocks = SequenceMatcher(None, region_a, region_b).get_matching_blocks()
+            start_a, start_b, size = blocks[-2] if len(blocks) > 1 else blocks[-1]
+            if start_a + size > len(before):
+                region_a, region_b = region_a[:start_a + size], region_b[:start_b + size]
+        offset = line_number - len(before)
+        diff_lines = [
+            _offset_hunk_header(line, offset)
+            for line in unified_diff(region_a, region_b, n=context)
+        ]
+        if more_a or more_b:
+            diff_lines.append(
+                '... (streaming diff: stopped after the first differing region at line {0})\n'.format(
+                    line_number + 1,
+                ),
+            )
+        return diff_lines
+    return []
+
+
+def diff(file_a, file_b, check_digest=True, stream=None):
+    """Diff two text files after normalizing each line.
+
+    The normalized *file_b* is read from ``DIFF_CACHE`` when possible.
+    Files of at least ``STREAM_DIFF_MIN_BYTES`` are compared with
+    :func:`stream_diff`, which reads both files in lockstep and reports
+    only the first differing region, so memory does not grow with file
+    size.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first file (actual).
+    file_b : str or Path
+        Path to the second file (expected).
+    check_digest : bool
+        Skip normalization and diffing when both files are
+        byte-identical.
+    stream : bool or None
+        Force (True) or disable (False) the streaming comparison.
+        ``None`` picks it based on file size.
+
+    Returns
+    -------
+    list of str
+        Unified diff lines, empty if the files match.
+    """
+    if check_digest and files_identical(file_a, file_b):
+        return []
+    suffix = Path(file_a).suffix
+    if stream is None:
+        stream = max(os.path.getsize(file_a), os.path.getsize(file_b)) >= STREAM_DIFF_MIN_BYTES
+    if stream:
+        normalize = get_line_normalizer(suffix)
+        with open(file_a) as fh_a, open_normalized_lines(file_b) as lines_b:
+            lines_a = (normalize(line).strip() + '\n' for line in fh_a)
+            return stream_diff(lines_a, lines_b)
+    with open(file_a) as fh_a:
+        lines_a = normalize_lines(fh_a, suffix)
+    lines_b = load_normalized_lines(file_b)
+    return list(unified_diff(lines_a, lines_b))
+
+
+def read_numeric_table(path):
+    """Parse a tab-separated table into cell strings and a float grid.
+
+    The cells below the header and right of the row labels are converted
+    to floats in one NumPy call, or a column at a time when some hold
+    text (``NA``); only the cells left over are parsed one by one.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the table.
+
+    Returns
+    -------
+    tuple (rows, values, numeric, integer) or None
+        *rows*: list of lists of cell strings.  *values*: 2-D float array
+        with NaN for non-numeric cells.  *numeric*: 2-D bool array marking
+        the cells that parsed as numbers.  *integer*: 2-D bool array
+        marking the cells written as integers (read counts).  None if the
+        rows are ragged.
+    """
+    with open(path) as fh:
+        rows = [line.rstrip('\r\n').split('\t') for line in fh]
+    n_cols = len(rows[0]) if rows else 0
+    if any(len(row) != n_cols for row in rows):
+        return None
+    cells = np.array(rows, dtype=str).reshape(len(rows), n_cols)
+    values = np.full(cells.shape, np.nan)
+    numeric = np.zeros(cells.shape, dtype=bool)
+
+    def parse(rows_slice, cols_slice):
+        try:
+            values[rows_slice, cols_slice] = cells[rows_slice, cols_slice].astype(float)
+        except ValueError:
+            return False
+        numeric[rows_slice, cols_slice] = True
+        return True
+
+    # The header and the row labels are text; the block below and right
+    # of them is normally all numbers and is converted in one call.
+    if not parse(slice(1, None), slice(1, None)):
+        for j in range(1, n_cols):
+            parse(slice(1, None), j)
+    parse(slice(1, None), 0)
+    for i, j in zip(*np.nonzero(~numeric)):
+        try:
+            values[i, j] = float(rows[i][j])
+        except ValueError:
+            continue
+        numeric[i, j] = True
+    integer = numeric & np.char.isdigit(np.char.lstrip(np.char.strip(cells), '+-'))
+    return rows, values, numeric, integer
+
+
+def diff_table(file_a, file_b, atol=DEFAULT_TABLE_ATOL, rtol=DEFAULT_TABLE_RTOL):
+    """Compare two numeric TSV tables cell by cell with a tolerance.
+
+    Decimal cells are compared with ``np.isclose`` (``|a - b| <= atol +
+    rtol * |b|``) over the whole grid at once, which avoids the false
+    failures that rounding both sides to 3 decimals gives at rounding
+    boundaries.  Cells written as integers on both sides (read counts)
+    must be equal: a tolerance would let a large count drift by a read or
+    more.  Non-numeric cells (headers, row labels) must match exactly.
+    Tables whose shapes differ fall back to :func:`diff`.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first table (actual).
+    file_b : str or Path
+        Path to the second table (expected).
+    atol : float
+        Absolute tolerance for the decimal cells.
+    rtol : float
+        Relative tolerance for the decimal cells.
+
+    Returns
+    -------
+    list of str
+        Diff-style lines with one hunk per differing cell (at most
+        ``TABLE_DIFF_MAX_CELLS``), empty if the tables match.
+    """
+    if files_identical(file_a, file_b):
+        return []
+    table_a = read_numeric_table(file_a)
+    table_b = read_numeric_table(file_b)
+    if table_a is None or table_b is None or table_a[1].shape != table_b[1].shape:
+        return diff(file_a, file_b, check_digest=False)
+    rows_a, values_a, numeric_a, integer_a = table_a
+    rows_b, values_b, numeric_b, integer_b = table_b
+
+    both_numeric = numeric_a & numeric_b
+    close = np.where(
+        integer_a & integer_b,
+        values_a == values_b,
+        np.isclose(values_a, values_b, atol=atol, rtol=rtol, equal_nan=True),
+    )
+    different = np.where(both_numeric, ~close, numeric_a != numeric_b)
+    for i, j in zip(*np.nonzero(~numeric_a & ~numeric_b)):
+        different[i, j] = rows_a[i][j] != rows_b[i][j]
+
+    cells = np.argwhere(different)
+    if not len(cells):
+        return []
+    diff_lines = [
+        '--- {0}\n'.format(file_a),
+        '+++ {0}\n'.format(file_b),
+    ]
+    for i, j in cells[:TABLE_DIFF_MAX_CELLS]:
+        diff_lines.extend([
+            '@@ row {0} ({1}), column {2} ({3}) @@\n'.format(i + 1, rows_b[i][0], j + 1, rows_b[0][j]),
+            '-{0}\n'.format(rows_a[i][j]),
+            '+{0}\n'.format(rows_b[i][j]),
+        ])
+    if len(cells) > TABLE_DIFF_MAX_CELLS:
+        diff_lines.append('... ({0} more differing cells omitted)\n'.format(len(cells) - TABLE_DIFF_MAX_CELLS))
+    diff_lines.append('{0} of {1} cells differ (atol={2}, rtol={3})\n'.format(
+        len(cells), different.size, atol, rtol,
+    ))
+    return diff_lines
+
+
+def _is_integer_cell(cell):
+    """Whether a table cell is written as an integer (``42``, not ``42.0``)."""
+    try:
+        int(cell)
+    except ValueError:
+        return False
+    return True
+
+
+def _counts_close(value_a, value_b, atol, rtol):
+    """``np.isclose`` for two table cells, as in :func:`diff_table`.
+
+    Integer cells (read counts) and non-numeric cells must be equal.
+    """
+    if value_a == value_b:
+        return True
+    if _is_integer_cell(value_a) and _is_integer_cell(value_b):
+        return int(value_a) == int(value_b)
+    try:
+        number_a, number_b = float(value_a), float(value_b)
+    except ValueError:
+        return False
+    return abs(number_a - number_b) <= atol + rtol * abs(number_b)
+
+
+def diff_allele_lines(lines_a, lines_b, atol=DEFAULT_TABLE_ATOL, rtol=DEFAULT_TABLE_RTOL):
+    """Compare two allele frequency tables row by allele, ignoring row order.
+
+    The expected rows are loaded into a dict keyed on every column except
+    ``ALLELE_TABLE_COUNT_COLUMNS`` (``Aligned_Sequence``,
+    ``Reference_Sequence`` and the columns derived from them), then the
+    actual rows are streamed past it: a hash join, linear in the number of
+    alleles where ``unified_diff`` on a reordered table is quadratic.
+    Read counts must be equal; percentages are compared with the
+    :func:`diff_table` tolerance.
+
+    Parameters
+    ----------
+    lines_a : iterable of str
+        Lines of the first table (actual), header first.
+    lines_b : iterable of str
+        Lines of the second table (expected), header first.
+    atol : float
+        Absolute tolerance for the percentage columns.
+    rtol : float
+        Relative tolerance for the percentage columns.
+
+    Returns
+    -------
+    list of str or None
+        Diff-style lines with one hunk per differing allele (at most
+        ``ALLELE_DIFF_MAX_ROWS``), without the ``---``/``+++`` header;
+        empty if the tables hold the same alleles.  None if the tables are
+        not keyed allele tables (different headers, ragged rows, duplicate
+        keys) and must be diffed line by line.
+    """
+    lines_a, lines_b = iter(lines_a), iter(lines_b)
+    header = next(lines_a, '').rstrip('\r\n').split('\t')
+    if next(lines_b, '').rstrip('\r\n').split('\t') != header:
+        return None
+    if not all(column in header for column in ALLELE_TABLE_KEY_COLUMNS + ALLELE_TABLE_COUNT_COLUMNS):
+        return None
+    count_columns = [header.index(column) for column in ALLELE_TABLE_COUNT_COLUMNS]
+    key_columns = [j for j in range(len(header)) if j not in count_columns]
+    aligned_column = header.index('Aligned_Sequence')
+
+    def keyed_rows(lines):
+        for row, line in enumerate(lines, 1):
+            cells = line.rstrip('\r\n').split('\t')
+            if len(cells) != len(header):
+                raise ValueError('ragged row {0}'.format(row))
+            yield tuple(cells[j] for j in key_columns), row, cells
+
+    expected = {}
+    n_expected = n_actual = 0
+    hunks = []
+    try:
+        for key, row, cells in keyed_rows(lines_b):
+            expected[key] = (row, cells)
+            n_expected += 1
+        if len(expected) != n_expected:
+            return None
+        for key, row, cells in keyed_rows(lines_a):
+            n_actual += 1
+            match = expected.pop(key, None)
+            if match is None:
+                hunks.append((
+                    '@@ row {0} ({1}) @@\n'.format(row, cells[aligned_column]),
+                    '-{0}\n'.format('\t'.join(cells)),
+                ))
+                continue
+            cells_b = match[1]
+            changed = [j for j in count_columns if not _counts_close(cells[j], cells_b[j], atol, rtol)]
+            if changed:
+                hunks.append(('@@ row {0} ({1}) @@\n'.format(row, cells[aligned_column]),) + tuple(
+                    line for j in changed for line in (
+                        '-{0}: {1}\n'.format(header[j], cells[j]),
+                        '+{0}: {1}\n'.format(header[j], cells_b[j]),
+                    )
+                ))
+    except ValueError:
+        return None
+    for row, cells_b in sorted(expected.values()):
+        hunks.append((
+            '@@ expected row {0} ({1}) @@\n'.format(row, cells_b[aligned_column]),
+            '+{0}\n'.format('\t'.join(cells_b)),
+        ))
+    if not hunks:
+        return []
+
+    diff_lines = [line for hunk in hunks[:ALLELE_DIFF_MAX_ROWS] for line in hunk]
+    if len(hunks) > ALLELE_DIFF_MAX_ROWS:
+        diff_lines.append('... ({0} more differing alleles omitted)\n'.format(len(hunks) - ALLELE_DIFF_MAX_ROWS))
+    diff_lines.append('{0} of {1} alleles differ (atol={2}, rtol={3})\n'.format(
+        len(hunks), n_actual + len(expected), atol, rtol,
+    ))
+    return diff_lines
+
+
+def diff_allele_table(file_a, file_b, atol=DEFAULT_TABLE_ATOL, rtol=DEFAULT_TABLE_RTOL):
+    """Compare two allele frequency tables with :func:`diff_allele_lines`.
+
+    Tables that cannot be keyed fall back to :func:`diff`.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first table (actual).
+    file_b : str or Path
+        Path to the second table (expected).
+    atol : float
+        Absolute tolerance for the percentage columns.
+    rtol : float
+        Relative tolerance for the percentage columns.
+
+    Returns
+    -------
+    list of str
+        Diff lines, empty if the tables hold the same alleles.
+    """
+    if files_identical(file_a, file_b):
+        return []
+    with open(file_a) as fh_a, open(file_b) as fh_b:
+        allele_diff = diff_allele_lines(fh_a, fh_b, atol, rtol)
+    if allele_diff is None:
+        return diff(file_a, file_b, check_digest=False)
+    if not allele_diff:
+        return []
+    return ['--- {0}\n'.format(file_a), '+++ {0}\n'.format(file_b)] + allele_diff
+
+
+def _label_diff(diff_lines, label_a, label_b):
+    """Replace the empty ``---``/``+++`` headers of a unified diff with labels."""
+    if len(diff_lines) >= 2 and diff_lines[0].startswith('---') and diff_lines[1].startswith('+++'):
+        diff_lines = diff_lines[2:]
+    return ['--- {0}\n'.format(label_a), '+++ {0}\n'.format(label_b)] + diff_lines
+
+
+def diff_zip(file_a, file_b):
+    """Compare two zip archives member by member without extracting them.
+
+    Member lists and CRC-32s are compared from the central directories
+    first.  Only members whose CRC or size differ are decompressed, as
+    streams, and run through the usual line normalization and diff
+    (:func:`stream_diff` for members of at least
+    ``STREAM_DIFF_MIN_BYTES``).  Allele frequency tables are joined on
+    their alleles with :func:`diff_allele_lines` instead.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first archive (actual).
+    file_b : str or Path
+        Path to the second archive (expected).
+
+    Returns
+    -------
+    list of str
+        Diff lines for every added, missing or differing member, empty if
+        the archives match.
+    """
+    if files_identical(file_a, file_b):
+        return []
+    diff_lines = []
+    with zipfile.ZipFile(file_a) as zip_a, zipfile.ZipFile(file_b) as zip_b:
+        members_a = {info.filename: info for info in zip_a.infolist() if not info.is_dir()}
+        members_b = {info.filename: info for info in zip_b.infolist() if not info.is_dir()}
+        for name in sorted(set(members_a) | set(members_b)):
+            label_a = '{0}/{1}'.format(file_a, name)
+            label_b = '{0}/{1}'.format(file_b, name)
+            if name not in members_b:
+                diff_lines.append('New member {0} not found in Expected\n'.format(label_a))
+                continue
+            if name not in members_a:
+                diff_lines.append('Missing member {0} from Actual\n'.format(label_b))
+                continue
+            info_a, info_b = members_a[name], members_b[name]
+            if info_a.CRC == info_b.CRC and info_a.file_size == info_b.file_size:
+                continue
+            member_diff = None
+            if ALLELE_TABLE_REGEXP.search(name):
+                with zip_a.open(info_a) as fh_a, zip_b.open(info_b) as fh_b:
+                    member_diff = diff_allele_lines(io.TextIOWrapper(fh_a), io.TextIOWrapper(fh_b))
+            if member_diff is None:
+                normalize = get_line_normalizer(Path(name).suffix)
+                with zip_a.open(info_a) as fh_a, zip_b.open(info_b) as fh_b:
+                    lines_a = (normalize(line).strip() + '\n' for line in io.TextIOWrapper(fh_a))
+                    lines_b = (normalize(line).strip() + '\n' for line in io.TextIOWrapper(fh_b))
+                    if max(info_a.file_size, info_b.file_size) >= STREAM_DIFF_MIN_BYTES:
+                        member_diff = stream_diff(lines_a, lines_b)
+                    else:
+                        member_diff = list(unified_diff(list(lines_a), list(lines_b)))
+            if member_diff:
+                diff_lines.extend(_label_diff(member_diff, label_a, label_b))
+    return diff_lines
+
+
+def load_npz_array(path, zip_file, info):
+    """Load one array from an ``.npz`` archive, memory-mapped if possible.
+
+    ``np.savez`` stores members uncompressed, so the ``.npy`` data sits
+    at a fixed offset in the archive and can be mapped with
+    ``np.memmap`` instead of being read.  Compressed members and object
+    arrays are read normally.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the archive.
+    zip_file : zipfile.ZipFile
+        The open archive.
+    info : zipfile.ZipInfo
+        The member to load.
+
+    Returns
+    -------
+    numpy.ndarray
+        The array (a read-only ``np.memmap`` when mapped).
+    """
+    if info.compress_type == zipfile.ZIP_STORED:
+        with open(path, 'rb') as fh:
+            fh.seek(info.header_offset)
+            header = fh.read(ZIP_LOCAL_HEADER_SIZE)
+            name_length = int.from_bytes(header[26:28], 'little')
+            extra_length = int.from_bytes(header[28:30], 'little')
+            fh.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length)
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+            offset = fh.tell()
+        if not dtype.hasobject and int(np.prod(shape)) > 0:
+            return np.memmap(
+                path, dtype=dtype, mode='r', shape=shape,
+                order='F' if fortran_order else 'C', offset=offset,
+            )
+    with zip_file.open(info) as fh:
+        return np.lib.format.read_array(fh, allow_pickle=False)
+
+
+def diff_arrays(array_a, array_b, atol=DEFAULT_ARRAY_ATOL, rtol=DEFAULT_ARRAY_RTOL):
+    """Summarize the differences between two arrays.
+
+    Parameters
+    ----------
+    array_a : numpy.ndarray
+        The actual array.
+    array_b : numpy.ndarray
+        The expected array.
+    atol : float
+        Absolute tolerance for numeric arrays.
+    rtol : float
+        Relative tolerance for numeric arrays.
+
+    Returns
+    -------
+    str or None
+        A one-line summary, or None if the arrays match.
+    """
+    if array_a.shape != array_b.shape:
+        return 'shape {0} != {1}'.format(array_a.shape, array_b.shape)
+    if array_a.dtype != array_b.dtype:
+        return 'dtype {0} != {1}'.format(array_a.dtype, array_b.dtype)
+    numeric = np.issubdtype(array_a.dtype, np.number) or array_a.dtype == np.bool_
+    if numeric:
+        if np.allclose(array_a, array_b, atol=atol, rtol=rtol, equal_nan=True):
+            return None
+        different = ~np.isclose(array_a, array_b, atol=atol, rtol=rtol, equal_nan=True)
+    else:
+        different = np.asarray(array_a != array_b)
+        if not different.any():
+            return None
+    first = tuple(int(i) for i in np.argwhere(different)[0])
+    summary = '{0} of {1} elements differ, first at index {2}'.format(
+        int(different.sum()), different.size, first,
+    )
+    if numeric:
+        errors = np.abs(array_a[different].astype(float) - array_b[different].astype(float))
+        summary += ', max abs error {0:g} (atol={1}, rtol={2})'.format(np.nanmax(errors), atol, rtol)
+    return summary
+
+
+def diff_npz(file_a, file_b, atol=DEFAULT_ARRAY_ATOL, rtol=DEFAULT_ARRAY_RTOL):
+    """Compare two ``.npz`` archives array by array.
+
+    Arrays are loaded one pair at a time with :func:`load_npz_array` and
+    checked for shape and dtype before their values are compared with
+    ``np.allclose``.  Members with matching CRC-32 and size are skipped
+    without loading.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first archive (actual).
+    file_b : str or Path
+        Path to the second archive (expected).
+    atol : float
+        Absolute tolerance.
+    rtol : float
+        Relative tolerance.
+
+    Returns
+    -------
+    list of str
+        One ``---``/``+++`` header and summary line per differing array,
+        empty if the archives match.
+    """
+    if files_identical(file_a, file_b):
+        return []
+    diff_lines = []
+    with zipfile.ZipFile(file_a) as zip_a, zipfile.ZipFile(file_b) as zip_b:
+        members_a = {info.filename: info for info in zip_a.infolist()}
+        members_b = {info.filename: info for info in zip_b.infolist()}
+        for name in sorted(set(members_a) | set(members_b)):
+            label_a = '{0}/{1}'.format(file_a, name)
+            label_b = '{0}/{1}'.format(file_b, name)
+            if name not in members_b:
+                diff_lines.append('New array {0} not found in Expected\n'.format(label_a))
+                continue
+            if name not in members_a:
+                diff_lines.append('Missing array {0} from Actual\n'.format(label_b))
+                continue
+            info_a, info_b = members_a[name], members_b[name]
+            if info_a.CRC == info_b.CRC and info_a.file_size == info_b.file_size:
+                continue
+            summary = diff_arrays(
+                load_npz_array(file_a, zip_a, info_a),
+                load_npz_array(file_b, zip_b, info_b),
+                atol=atol,
+                rtol=rtol,
+            )
+            if summary is not None:
+                diff_lines.extend([
+                    '--- {0}\n'.format(label_a),
+                    '+++ {0}\n'.format(label_b),
+                    '{0}\n'.format(summary),
+                ])
+    return diff_lines
+
+
+@lru_cache(maxsize=JSON_CACHE_SIZE)
+def _load_json(path, size, mtime_ns):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def load_json(path):
+    """Parse a JSON file, reusing the parsed document while it is unchanged.
+
+    Both :func:`diff_json` and :func:`diff_running_times` read the info
+    files, so documents are memoized on path, size and mtime.  Callers
+    must not modify the returned object.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the JSON file.
+
+    Returns
+    -------
+    object
+        The parsed document.
+    """
+    stat = os.stat(path)
+    return _load_json(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+def normalize_json_string(value):
+    """Strip absolute paths from a JSON string and normalize it like a line."""
+    return get_line_normalizer('.json')(PLOTLY_PATH_REGEXP.sub('', value))
+
+
+_MISSING = object()
+
+
+def _is_json_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _iter_number_list_differences(list_a, list_b, prefix, atol, rtol):
+    """Vectorized :func:`math.isclose` over two equal-length number lists."""
+    arr_a = np.asarray(list_a, dtype=np.float64)
+    arr_b = np.asarray(list_b, dtype=np.float64)
+    tolerance = np.maximum(rtol * np.maximum(np.abs(arr_a), np.abs(arr_b)), atol)
+    with np.errstate(invalid='ignore'):
+        close = (arr_a == arr_b) | (np.abs(arr_a - arr_b) <= tolerance)
+    for i in np.flatnonzero(~close):
+        yield prefix + str(i), list_a[i], list_b[i]
+
+
+def iter_json_differences(obj_a, obj_b, path, ignore_paths, atol, rtol):
+    """Yield ``(path, value_a, value_b)`` for every differing leaf.
+
+    A missing key or list item is reported with ``value_a`` or
+    ``value_b`` set to the ``_MISSING`` sentinel.  Long lists of numbers
+    (Plotly traces, per-position frequencies) are compared as arrays; an
+    ignore pattern is then only consulted for the list's first item.
+    """
+    if path and any(fnmatchcase(path, pattern) for pattern in ignore_paths):
+        return
+    prefix = path + '.' if path else ''
+    if isinstance(obj_a, dict) and isinstance(obj_b, dict):
+        for key in sorted(set(obj_a) | set(obj_b)):
+            yield from iter_json_differences(
+                obj_a.get(key, _MISSING), obj_b.get(key, _MISSING),
+                prefix + key, ignore_paths, atol, rtol,
+            )
+    elif isinstance(obj_a, list) and isinstance(obj_b, list):
+        if (
+            NUMPY_AVAILABLE
+            and len(obj_a) == len(obj_b) >= JSON_VECTORIZE_MIN_LENGTH
+            and not any(fnmatchcase(prefix + '0', pattern) for pattern in ignore_paths)
+            and all(map(_is_json_number, obj_a)) and all(map(_is_json_number, obj_b))
+        ):
+            yield from _iter_number_list_differences(obj_a, obj_b, prefix, atol, rtol)
+            return
+        for i, (item_a, item_b) in enumerate(zip_longest(obj_a, obj_b, fillvalue=_MISSING)):
+            yield from iter_json_differences(
+                item_a, item_b, prefix + str(i), ignore_paths, atol, rtol,
+            )
+    elif _is_json_number(obj_a) and _is_json_number(obj_b):
+        if not math.isclose(obj_a, obj_b, rel_tol=rtol, abs_tol=atol):
+            yield path, obj_a, obj_b
+    elif isinstance(obj_a, str) and isinstance(obj_b, str):
+        if obj_a != obj_b and normalize_json_string(obj_a) != normalize_json_string(obj_b):
+            yield path, obj_a, obj_b
+    elif obj_a != obj_b or type(obj_a) is not type(obj_b):
+        yield path, obj_a, obj_b
+
+
+def diff_json(file_a, file_b, ignore_paths=JSON_IGNORE_PATHS,
+              atol=DEFAULT_JSON_ATOL, rtol=DEFAULT_JSON_RTOL):
+    """Compare two JSON documents structurally.
+
+    Both documents are walked together.  Paths matching *ignore_paths*
+    (run times, command lines, versions) are skipped, numbers are
+    compared with ``math.isclose`` and strings are compared after
+    absolute paths are stripped and the usual line normalization.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first document (actual).
+    file_b : str or Path
+        Path to the second document (expected).
+    ignore_paths : tuple of str
+        fnmatch patterns of dotted key paths to skip.
+    atol : float
+        Absolute tolerance for numbers.
+    rtol : float
+        Relative tolerance for numbers.
+
+    Returns
+    -------
+    list of str
+        Diff-style lines with one hunk per differing path (at most
+        ``JSON_DIFF_MAX_PATHS``), empty if the documents match.  Files
+        that are not valid JSON (some ``*_status.json`` files hold plain
+        text) are compared with :func:`diff`.
+    """
+    if files_identical(file_a, file_b):
+        return []
+    try:
+        obj_a, obj_b = load_json(file_a), load_json(file_b)
+    except ValueError:
+        return diff(file_a, file_b, check_digest=False)
+    differences = list(iter_json_differences(obj_a, obj_b, '', ignore_paths, atol, rtol))
+    if not differences:
+        return []
+    diff_lines = [
+        '--- {0}\n'.format(file_a),
+        '+++ {0}\n'.format(file_b),
+    ]
+    for path, value_a, value_b in differences[:JSON_DIFF_MAX_PATHS]:
+        diff_lines.append('@@ {0} @@\n'.format(path or '<root>'))
+        if value_a is not _MISSING:
+            diff_lines.append('-{0}\n'.format(json.dumps(value_a)))
+        if value_b is not _MISSING:
+            diff_lines.append('+{0}\n'.format(json.dumps(value_b)))
+    if len(differences) > JSON_DIFF_MAX_PATHS:
+        diff_lines.append('... ({0} more differing paths omitted)\n'.format(
+            len(differences) - JSON_DIFF_MAX_PATHS,
+        ))
+    return diff_lines
+
+
+def extract_plotly_figures(text):
+    """Split an HTML report into its markup and its Plotly figures.
+
+    Every ``Plotly.newPlot(...)`` call whose arguments are all JSON is
+    decoded once with :meth:`json.JSONDecoder.raw_decode`.  Calls built
+    from JavaScript variables (fastp reports) are left in the markup.
+
+    Parameters
+    ----------
+    text : str
+        The HTML document.
+
+    Returns
+    -------
+    tuple (markup, figures)
+        *markup*: *text* with each decoded call replaced by
+        ``PLOTLY_PLACEHOLDER``.  *figures*: one ``(div_id, payload)``
+        pair per call, where *payload* maps ``PLOTLY_ARGUMENTS`` to the
+        decoded arguments.
+    """
+    decoder = json.JSONDecoder()
+    parts, figures = [], []
+    position = 0
+    for match in PLOTLY_NEWPLOT_REGEXP.finditer(text):
+        if match.start() < position:
+            continue
+        arguments = []
+        end = match.end()
+        try:
+            while True:
+                value, end = decoder.raw_decode(text, end)
+                arguments.append(value)
+                separator = PLOTLY_ARG_SEPARATOR_REGEXP.match(text, end)
+                end = separator.end()
+                if not separator.group(1):
+                    break
+        except ValueError:
+            continue
+        if len(arguments) < 2 or text[end:end + 1] != ')':
+            continue
+        parts.append(text[position:match.start()])
+        parts.append(PLOTLY_PLACEHOLDER.format(len(figures)))
+        figures.append((str(arguments[0]), dict(zip(PLOTLY_ARGUMENTS, arguments[1:]))))
+        position = end + 1
+    parts.append(text[position:])
+    return ''.join(parts), figures
+
+
+def diff_html(file_a, file_b, atol=DEFAULT_JSON_ATOL, rtol=DEFAULT_JSON_RTOL):
+    """Compare two HTML reports, with embedded Plotly figures compared as data.
+
+    The figures' ``data``/``layout``/``config`` are compared with
+    :func:`iter_json_differences` (numbers within *atol*/*rtol*, number
+    arrays vectorized), so one changed value is reported as one path
+    instead of a diff of a 200 KB line.  The markup around the figures is
+    normalized and diffed line by line.  Documents without figures are
+    compared with :func:`diff`.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first report (actual).
+    file_b : str or Path
+        Path to the second report (expected).
+    atol : float
+        Absolute tolerance for numbers in figures.
+    rtol : float
+        Relative tolerance for numbers in figures.
+
+    Returns
+    -------
+    list of str
+        The markup's unified diff followed by one hunk per differing
+        figure path (at most ``JSON_DIFF_MAX_PATHS``), empty if the
+        reports match.
+    """
+    if files_identical(file_a, file_b):
+        return []
+    with open(file_a) as fh:
+        markup_a, figures_a = extract_plotly_figures(fh.read())
+    with open(file_b) as fh:
+        markup_b, figures_b = extract_plotly_figures(fh.read())
+    if not figures_a and not figures_b:
+        return diff(file_a, file_b, check_digest=False)
+
+    diff_lines = list(unified_diff(
+        normalize_lines(markup_a.splitlines(True), '.html'),
+        normalize_lines(markup_b.splitlines(True), '.html'),
+    ))[2:]
+    differences = []
+    for n, (figure_a, figure_b) in enumerate(zip_longest(figures_a, figures_b, fillvalue=_MISSING)):
+        name = 'figure {0} ({1})'.format(n, (figure_a if figure_a is not _MISSING else figure_b)[0])
+        payload_a = figure_a[1] if figure_a is not _MISSING else _MISSING
+        payload_b = figure_b[1] if figure_b is not _MISSING else _MISSING
+        differences.extend(
+            (name, path, value_a, value_b)
+            for path, value_a, value_b in iter_json_differences(payload_a, payload_b, '', (), atol, rtol)
+        )
+    for name, path, value_a, value_b in differences[:JSON_DIFF_MAX_PATHS]:
+        diff_lines.append('@@ {0}: {1} @@\n'.format(name, path or '<figure>'))
+        if value_a is not _MISSING:
+            diff_lines.append('-{0}\n'.format(json.dumps(value_a)))
+        if value_b is not _MISSING:
+            diff_lines.append('+{0}\n'.format(json.dumps(value_b)))
+    if len(differences) > JSON_DIFF_MAX_PATHS:
+        diff_lines.append('... ({0} more differing figure paths omitted)\n'.format(
+            len(differences) - JSON_DIFF_MAX_PATHS,
+        ))
+    if not diff_lines:
+        return []
+    return ['--- {0}\n'.format(file_a), '+++ {0}\n'.format(file_b)] + diff_lines
+
+
+def _read_exactly(fh, size):
+    data = fh.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated BAM file: {0}'.format(fh.name))
+    return data
+
+
+def _format_bam_tags(data):
+    """Render the auxiliary data of a BAM record as SAM ``TAG:TYPE:VALUE`` strings."""
+    tags = []
+    offset = 0
+    while offset < len(data):
+        tag, value_type = data[offset:offset + 2].decode(), chr(data[offset + 2])
+        offset += 3
+        if value_type == 'A':
+            value = chr(data[offset])
+            offset += 1
+        elif value_type in BAM_TAG_INTEGER_TYPES:
+            fmt = '<' + BAM_TAG_INTEGER_TYPES[value_type]
+            value = str(struct.unpack_from(fmt, data, offset)[0])
+            offset += struct.calcsize(fmt)
+            value_type = 'i'
+        elif value_type == 'f':
+            value = '{0:g}'.format(struct.unpack_from('<f', data, offset)[0])
+            offset += 4
+        elif value_type in 'ZH':
+            end = data.index(b'\0', offset)
+            value = data[offset:end].decode()
+            offset = end + 1
+        elif value_type == 'B':
+            sub_type = chr(data[offset])
+            count = struct.unpack_from('<i', data, offset + 1)[0]
+            fmt = '<{0}{1}'.format(count, BAM_ARRAY_TYPES[sub_type])
+            values = struct.unpack_from(fmt, data, offset + 5)
+            offset += 5 + struct.calcsize(fmt)
+            value = ','.join([sub_type] + [
+                '{0:g}'.format(v) if sub_type == 'f' else str(v) for v in values
+            ])
+        else:
+            raise ValueError('Unknown BAM tag type {0!r} for tag {1}'.format(value_type, tag))
+        tags.append('{0}:{1}:{2}'.format(tag, value_type, value))
+    return tuple(tags)
+
+
+def read_bam(path):
+    """Read a BAM file as SAM header lines and SAM field tuples.
+
+    BGZF is a series of gzip members, so :mod:`gzip` decompresses it as
+    one stream and records are decoded one at a time with :mod:`struct`.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the BAM file.
+
+    Returns
+    -------
+    tuple (header, records)
+        *header*: list of SAM header lines.  *records*: generator of
+        tuples holding the 11 mandatory SAM fields followed by the tags.
+    """
+    fh = gzip.open(path, 'rb')
+    try:
+        if _read_exactly(fh, 4) != BAM_MAGIC:
+            raise ValueError('Not a BAM file: {0}'.format(path))
+        l_text = struct.unpack('<i', _read_exactly(fh, 4))[0]
+        header = _read_exactly(fh, l_text).rstrip(b'\0').decode().splitlines()
+        n_ref = struct.unpack('<i', _read_exactly(fh, 4))[0]
+        ref_names = []
+        for _ in range(n_ref):
+            l_name = struct.unpack('<i', _read_exactly(fh, 4))[0]
+            ref_names.append(_read_exactly(fh, l_name).rstrip(b'\0').decode())
+            _read_exactly(fh, 4)  # l_ref
+    except BaseException:
+        fh.close()
+        raise
+    return header, _iter_bam_records(fh, ref_names)
+
+
+def _iter_bam_records(fh, ref_names):
+    with fh:
+        while True:
+            block_size = fh.read(4)
+            if not block_size:
+                return
+            block = _read_exactly(fh, struct.unpack('<i', block_size)[0])
+            (ref_id, pos, l_read_name, mapq, _, n_cigar_op, flag, l_seq,
+             next_ref_id, next_pos, tlen) = BAM_RECORD_STRUCT.unpack_from(block)
+            offset = BAM_RECORD_STRUCT.size
+            read_name = block[offset:offset + l_read_name - 1].decode()
+            offset += l_read_name
+            cigar = ''.join(
+                '{0}{1}'.format(op >> 4, BAM_CIGAR_OPS[op & 0xf])
+                for op in struct.unpack_from('<{0}I'.format(n_cigar_op), block, offset)
+            ) or '*'
+            offset += 4 * n_cigar_op
+            packed = block[offset:offset + (l_seq + 1) // 2]
+            offset += (l_seq + 1) // 2
+            seq = ''.join(BAM_SEQ_BASES[b >> 4] + BAM_SEQ_BASES[b & 0xf] for b in packed)[:l_seq] or '*'
+            qual = block[offset:offset + l_seq]
+            offset += l_seq
+            qual = '*' if not l_seq or qual[0] == 0xff else bytes(q + 33 for q in qual).decode()
+            if next_ref_id < 0:
+                rnext = '*'
+            elif next_ref_id == ref_id:
+                rnext = '='
+            else:
+                rnext = ref_names[next_ref_id]
+            yield (
+                read_name, str(flag), ref_names[ref_id] if ref_id >= 0 else '*',
+                str(pos + 1), str(mapq), cigar, rnext, str(next_pos + 1), str(tlen),
+                seq, qual,
+            ) + _format_bam_tags(block[offset:])
+
+
+def read_sam(path):
+    """Read a SAM file as header lines and a generator of field tuples.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the SAM file.
+
+    Returns
+    -------
+    tuple (header, records)
+        Same as :func:`read_bam`.
+    """
+    fh = open(path)
+    header = []
+    line = fh.readline()
+    while line.startswith('@'):
+        header.append(line.rstrip('\r\n'))
+        line = fh.readline()
+
+    def records(line):
+        with fh:
+            while line:
+                yield tuple(line.rstrip('\r\n').split('\t'))
+                line = fh.readline()
+    return header, records(line)
+
+
+def read_alignments(path):
+    """Dispatch to :func:`read_bam` or :func:`read_sam` by suffix."""
+    if Path(path).suffix == '.bam':
+        return read_bam(path)
+    return read_sam(path)
+
+
+def _record_field_names(record):
+    return SAM_FIELDS + tuple(
+        'TAG {0}'.format(field[:2]) for field in record[len(SAM_FIELDS):]
+    )
+
+
+def diff_alignments(file_a, file_b):
+    """Compare two SAM or BAM files header first, then record by record.
+
+    Headers are run through the ``.sam`` line normalization (which rewrites
+    the ``@HD`` and ``@PG`` lines) and diffed as text.  Records are read
+    in lockstep and compared field by field, so memory use does not grow
+    with the file.  Fields that differ are compared again after line
+    normalization, which rounds floats in tags like the text diff does.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first alignment file (actual).
+    file_b : str or Path
+        Path to the second alignment file (expected).
+
+    Returns
+    -------
+    list of str
+        The header diff followed by one hunk per differing record (at most
+        ``ALIGNMENT_DIFF_MAX_RECORDS``) and a count, empty if the files
+        match.
+    """
+    if files_identical(file_a, file_b):
+        return []
+    normalize = get_line_normalizer('.sam')
+    header_a, records_a = read_alignments(file_a)
+    header_b, records_b = read_alignments(file_b)
+    diff_lines = list(unified_diff(
+        [normalize(line) + '\n' for line in header_a],
+        [normalize(line) + '\n' for line in header_b],
+        fromfile=str(file_a),
+        tofile=str(file_b),
+    ))
+    record_lines = []
+    n_records = n_different = 0
+    with closing(records_a), closing(records_b):
+        for record_a, record_b in zip_longest(records_a, records_b):
+            n_records += 1
+            if record_a == record_b:
+                continue
+            if record_a is None or record_b is None:
+                changes = [('-', '\t'.join(record_a))] if record_b is None else [('+', '\t'.join(record_b))]
+            else:
+                changes = []
+                names = _record_field_names(record_a if len(record_a) >= len(record_b) else record_b)
+                for name, field_a, field_b in zip_longest(names, record_a, record_b, fillvalue=''):
+                    if field_a != field_b and normalize(field_a) != normalize(field_b):
+                        changes.extend([('-', '{0}: {1}'.format(name, field_a)), ('+', '{0}: {1}'.format(name, field_b))])
+                if not changes:
+                    continue
+            n_different += 1
+            if n_different <= ALIGNMENT_DIFF_MAX_RECORDS:
+                qname = (record_a or record_b)[0]
+                record_lines.append('@@ record {0} ({1}) @@\n'.format(n_records, qname))
+                record_lines.extend('{0}{1}\n'.format(sign, text) for sign, text in changes)
+    if n_different:
+        if not diff_lines:
+            diff_lines = ['--- {0}\n'.format(file_a), '+++ {0}\n'.format(file_b)]
+        diff_lines.extend(record_lines)
+        if n_different > ALIGNMENT_DIFF_MAX_RECORDS:
+            diff_lines.append('... ({0} more differing records omitted)\n'.format(
+                n_different - ALIGNMENT_DIFF_MAX_RECORDS,
+            ))
+        diff_lines.append('{0} of {1} records differ\n'.format(n_different, n_records))
+    return diff_lines
+
+
+def iter_fastq_records(path):
+    """Yield the records of a gzipped FASTQ file as 4-tuples of lines.
+
+    The file is decompressed as a stream, so memory use does not depend on
+    its size.  An empty (zero-byte) file yields nothing.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the ``.fastq.gz`` file.
+
+    Yields
+    ------
+    tuple of str
+        The header, sequence, separator and quality lines of a record.
+    """
+    with gzip.open(path, 'rt') as fh:
+        while True:
+            record = tuple(line.rstrip('\r\n') for line in islice(fh, 4))
+            if not record:
+                return
+            yield record
+
+
+def record_hash(record):
+    """Return a 128-bit integer hash of a FASTQ record."""
+    return int.from_bytes(
+        hashlib.blake2b('\n'.join(record).encode(), digest_size=16).digest(), 'little',
+    )
+
+
+def diff_fastq(file_a, file_b, ordered=False):
+    """Compare two gzipped FASTQ files in one streaming pass.
+
+    Records are read in lockstep.  Alongside the positional comparison a
+    multiset hash (the sum of per-record BLAKE2b hashes modulo 2**128)
+    is kept for each side, so when *ordered* is False files holding the
+    same reads in a different order, as ``-p max`` produces, still
+    match.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first file (actual).
+    file_b : str or Path
+        Path to the second file (expected).
+    ordered : bool
+        Also require the reads to be in the same order.
+
+    Returns
+    -------
+    list of str
+        The first ``FASTQ_DIFF_MAX_RECORDS`` records that differ by
+        position and a summary, empty if the files match.
+    """
+    if files_identical(file_a, file_b):
+        return []
+    n_records = [0, 0]
+    multiset_hash = [0, 0]
+    n_positional = 0
+    record_lines = []
+    for record_a, record_b in zip_longest(iter_fastq_records(file_a), iter_fastq_records(file_b)):
+        for side, record in enumerate((record_a, record_b)):
+            if record is not None:
+                n_records[side] += 1
+                multiset_hash[side] = (multiset_hash[side] + record_hash(record)) % MULTISET_HASH_MODULUS
+        if record_a == record_b:
+            continue
+        n_positional += 1
+        if n_positional <= FASTQ_DIFF_MAX_RECORDS:
+            record_lines.append('@@ record {0} @@\n'.format(max(n_records)))
+            record_lines.extend('-{0}\n'.format(line) for line in record_a or ())
+            record_lines.extend('+{0}\n'.format(line) for line in record_b or ())
+    if not n_positional:
+        return []
+    same_reads = n_records[0] == n_records[1] and multiset_hash[0] == multiset_hash[1]
+    if same_reads and not ordered:
+        return []
+    diff_lines = ['--- {0}\n'.format(file_a), '+++ {0}\n'.format(file_b)] + record_lines
+    if n_positional > FASTQ_DIFF_MAX_RECORDS:
+        diff_lines.append('... ({0} more differing records omitted)\n'.format(
+            n_positional - FASTQ_DIFF_MAX_RECORDS,
+        ))
+    diff_lines.append('{0} of {1} records differ by position; {2}\n'.format(
+        n_positional, max(n_records),
+        'same reads in a different order' if same_reads
+        else 'read sets differ ({0} vs {1} records)'.format(*n_records),
+    ))
+    return diff_lines
+
+
+def diff_gzip(file_a, file_b):
+    """Compare two gzip files by their decompressed contents.
+
+    FASTQ files go to :func:`diff_fastq`.  Anything else is compared by
+    digesting the decompressed stream in ``DIGEST_CHUNK_SIZE`` chunks.
+
+    Parameters
+    ----------
+    file_a : str or Path
+        Path to the first file (actual).
+    file_b : str or Path
+        Path to the second file (expected).
+
+    Returns
+    -------
+    list of str
+        Diff lines, empty if the decompressed contents match.
+    """
+    if Path(file_a).with_suffix('').suffix in FASTQ_SUFFIXES:
+        return diff_fastq(file_a, file_b)
+    if files_identical(file_a, file_b):
+        return []
+    digests = []
+    for path in (file_a, file_b):
+        digest = hashlib.blake2b()
+        with gzip.open(path, 'rb') as fh:
+            for chunk in iter(partial(fh.read, DIGEST_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        digests.append(digest.digest())
+    if digests[0] == digests[1]:
+        return []
+    return ['Decompressed contents of {0} and {1} differ\n'.format(file_a, file_b)]
+
+
+def iter_pdf_streams(data):
+    """Yield every FlateDecode stream in a PDF, found by scanning the raw bytes.
+
+    This is the fallback for PDFs :func:`pdf_content_streams` cannot
+    parse: it decompresses every stream, including fonts and images.
+
+    Parameters
+    ----------
+    data : bytes
+        Contents of the PDF file.
+
+    Yields
+    ------
+    str
+        Each decompressed stream, decoded as latin-1.
+    """
+    for m in PDF_STREAM_REGEXP.finditer(data):
+        try:
+            yield zlib.decompress(m.group(1)).decode('latin-1')
+        except Exception:
+            continue
+
+
+def _pdf_object_header(data, offset):
+    """Return ``(dictionary bytes, stream start or None)`` for the object at *offset*."""
+    end = data.find(b'endobj', offset)
+    stream = data.find(b'stream', offset, end)
+    if stream < 0:
+        return data[offset:end], None
+    start = stream + len(b'stream')
+    if data[start:start + 2] == b'\r\n':
+        start += 2
+    elif data[start:start + 1] in (b'\n', b'\r'):
+        start += 1
+    return data[offset:stream], start
+
+
+def pdf_content_streams(data):
+    """Return the decompressed content streams of a PDF, in file order.
+
+    The xref table is read to locate objects, and only page
+    ``/Contents`` and Form XObjects are sliced out (using ``/Length``)
+    and decompressed.  Fonts, images and other streams are never
+    inflated.
+
+    Parameters
+    ----------
+    data : bytes
+        Contents of the PDF file.
 
     Returns
     -------
-    str
-        Line with floats and datetimes substituted
+    list of str or None
+        The decompressed streams decoded as latin-1, or None if the file
+        uses a layout this parser does not handle (xref streams,
+        incremental updates), in which case callers fall back to
+        :func:`iter_pdf_streams`.
     """
-    line = FLOAT_REGEXP.sub(round_float, line)
-    line = DATETIME_REGEXP.sub('2024-01-11 12:34:56', line)
-    line = COMMAND_HTML_REGEXP.sub('<p>Command used: <command></p>', line)
-    line = COMMAND_LOG_REGEXP.sub('CRISPResso <parameters>', line)
-    line = C2_ENV_PATH_REGEXP.sub('@PG CRISPResso <parameters>', line)
-    line = OUTPUT_REGEXP.sub('CRISPResso2_tests/cli_integration_tests/CRISPResso', line)
-    line = SAM_HEADER_BOWTIE_VERSION_REGEXP.sub(r'@PG\tID:bowtie2\tPN:bowtie2\tVN:2.5.4\tCL:bowtie2-align-s <parameters>', line)
-    line = SAM_HEADER_REGEXP.sub(r'@HD\tVN:1.0\tSO:unsorted', line)
-    return line
+    m = PDF_STARTXREF_REGEXP.search(data[-1024:])
+    if m is None:
+        return None
+    pos = int(m.group(1))
+    if data[pos:pos + 4] != b'xref':
+        return None
+    pos += 4
+    offsets = {}
+    while True:
+        subsection = PDF_XREF_SUBSECTION_REGEXP.match(data, pos)
+        if subsection is None:
+            break
+        first, count = int(subsection.group(1)), int(subsection.group(2))
+        pos = subsection.end()
+        for number in range(first, first + count):
+            entry = PDF_XREF_ENTRY_REGEXP.match(data, pos)
+            if entry is None:
+                return None
+            if entry.group(3) == b'n':
+                offsets[number] = int(entry.group(1))
+            pos += 20
+    trailer = data[pos:pos + 1024]
+    if not offsets or not trailer.lstrip().startswith(b'trailer') or b'/Prev' in trailer:
+        return None
+
+    headers = {number: _pdf_object_header(data, offset) for number, offset in offsets.items()}
+    selected = set()
+    for number, (header, stream_start) in headers.items():
+        if stream_start is None:
+            if PDF_PAGE_REGEXP.search(header):
+                contents = PDF_CONTENTS_REGEXP.search(header)
+                if contents:
+                    selected.update(int(ref) for ref in PDF_REF_REGEXP.findall(contents.group(1)))
+        elif PDF_FORM_REGEXP.search(header):
+            selected.add(number)
+
+    streams = []
+    for number in sorted(selected, key=lambda n: offsets.get(n, -1)):
+        if number not in headers:
+            continue
+        header, stream_start = headers[number]
+        length = PDF_LENGTH_REGEXP.search(header)
+        if stream_start is None or length is None or b'/FlateDecode' not in header:
+            continue
+        if length.group(2):
+            length_offset = offsets.get(int(length.group(1)))
+            length = PDF_INTEGER_OBJECT_REGEXP.match(data, length_offset) if length_offset is not None else None
+            if length is None:
+                return None
+        try:
+            stream = zlib.decompress(data[stream_start:stream_start + int(length.group(1))])
+        except zlib.error:
+            continue
+        streams.append(stream.decode('latin-1'))
+    return streams
 
 
-def diff(file_a, file_b):
-    with open(file_a) as fh_a, open(file_b) as fh_b:
-        lines_a = [substitute_line(line).strip() + '\n' for line in fh_a]
-        lines_b = [substitute_line(line).strip() + '\n' for line in fh_b]
-        return list(unified_diff(lines_a, lines_b))
+def _clean_pdf_string(raw):
+    return raw.replace('\x00', '').replace('\\(', '(').replace('\\)', ')').strip()
 
 
-def extract_pdf_text(path):
+def extract_pdf_text(path, object_aware=True):
     """Extract human-readable text strings from a matplotlib-generated PDF.
 
-    Decompresses FlateDecode streams, finds text rendering commands
-    (Tj and TJ operators), and extracts the text content.  Normalizes
-    the inter-character spacing that matplotlib uses (``H e l l o`` →
-    ``Hello``) so that different PDF encodings of the same text produce
-    identical output.
+    Decompresses the page content streams (see :func:`pdf_content_streams`),
+    finds text rendering commands (Tj and TJ operators), and extracts the
+    text content.  Normalizes the inter-character spacing that matplotlib
+    uses (``H e l l o`` → ``Hello``) so that different PDF encodings of
+    the same text produce identical output.
 
     Parameters
     ----------
     path : str or Path
         Path to the PDF file.
+    object_aware : bool
+        Parse the object structure and decompress only content streams.
+        If False, or if the PDF cannot be parsed, every stream is tried.
 
     Returns
     -------
@@ -149,47 +2318,51 @@ def extract_pdf_text(path):
     """
     with open(path, 'rb') as fh:
         data = fh.read()
+    streams = pdf_content_streams(data) if object_aware else None
+    if streams is None:
+        streams = iter_pdf_streams(data)
     texts = []
-    # Regex to match TJ/Tj operations that may span multiple lines.
-    # On Linux, matplotlib adds inter-character kerning values that make
-    # TJ arrays wrap across lines, e.g.:
-    #   [ (\x00P) 17.43 (\x00r) 21.95
-    #   (\x00edicted cleavage position) ]
-    #   TJ
-    # The \[...\]\s*TJ pattern captures the full array content.
-    tj_array_regexp = re.compile(r'\[(.*?)\]\s*TJ', re.DOTALL)
-    # Single-string Tj operator (always single-line)
-    tj_single_regexp = re.compile(r'\(((?:[^\\)]|\\.)*)\)\s*Tj')
-    for m in PDF_STREAM_REGEXP.finditer(data):
-        try:
-            decompressed = zlib.decompress(m.group(1))
-            stream = decompressed.decode('latin-1')
-        except Exception:
-            continue
+    for stream in streams:
         # Skip font / character-map streams
         if any(kw in stream for kw in PDF_FONT_KEYWORDS):
             continue
         # Extract text from TJ array operators (may span multiple lines)
-        for tj_match in tj_array_regexp.finditer(stream):
-            array_content = tj_match.group(1)
-            parts = re.findall(r'\(((?:[^\\)]|\\.)*)\)', array_content)
-            raw = ''.join(parts)
-            raw = raw.replace('\x00', '')
-            raw = raw.replace('\\(', '(').replace('\\)', ')')
-            text = raw.strip()
+        for tj_match in PDF_TJ_ARRAY_REGEXP.finditer(stream):
+            text = _clean_pdf_string(''.join(PDF_STRING_REGEXP.findall(tj_match.group(1))))
             if text:
                 texts.append(text)
         # Extract text from single-string Tj operators
-        for tj_match in tj_single_regexp.finditer(stream):
-            raw = tj_match.group(1)
-            raw = raw.replace('\x00', '')
-            raw = raw.replace('\\(', '(').replace('\\)', ')')
-            text = raw.strip()
+        for tj_match in PDF_TJ_SINGLE_REGEXP.finditer(stream):
+            text = _clean_pdf_string(tj_match.group(1))
             if text:
                 texts.append(text)
     return texts
 
 
+def load_pdf_text(path):
+    """Return :func:`extract_pdf_text` for *path*, using ``DIFF_CACHE`` when enabled.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the PDF (normally an expected result).
+
+    Returns
+    -------
+    list of str
+        Ordered list of text strings found in the PDF.
+    """
+    cache = DIFF_CACHE
+    if cache is None:
+        return extract_pdf_text(path)
+    digest = cached_file_digest(path)
+    texts = cache.get_json('pdf', digest)
+    if texts is None:
+        texts = extract_pdf_text(path)
+        cache.put_json('pdf', digest, texts)
+    return texts
+
+
 def diff_pdf(file_a, file_b):
     """Diff two PDF files by comparing their text content.
 
@@ -219,8 +2392,10 @@ def diff_pdf(file_a, file_b):
         comparison — non-empty when numeric axis ticks differ across
         platforms.  Callers should warn but not fail on this.
     """
+    if files_identical(file_a, file_b):
+        return [], []
     texts_a = extract_pdf_text(file_a)
-    texts_b = extract_pdf_text(file_b)
+    texts_b = load_pdf_text(file_b)
 
     # Full diff (includes numeric axis tick labels)
     full_diff = list(unified_diff(
@@ -291,7 +2466,148 @@ def truncate_diff_lines(lines, max_lines=PDF_DIFF_MAX_LINES):
     ]
 
 
-def diff_image(file_a, file_b, threshold=DEFAULT_IMAGE_THRESHOLD):
+def image_signature(path):
+    """Compute the perceptual signature of an image for the prefilter.
+
+    The grayscale image is shrunk with ``Image.reduce`` (a fast integer box
+    filter) before the final resize to ``IMAGE_HASH_SIZE``, so little work
+    is done at full resolution.  PNG has no reduced-resolution decode (``draft``
+    only applies to JPEG), so the file itself is still fully decoded.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the image.
+
+    Returns
+    -------
+    dict
+        Keys: 'dhash' (64-bit difference hash as a hex string), 'pixels'
+        (the 9x8 grayscale reduction, row-major list of ints) and 'size'.
+    """
+    width, height = IMAGE_HASH_SIZE
+    with Image.open(path) as img:
+        size = list(img.size)
+        img = img.convert('L')
+        factor = min(img.width // (width * 4), img.height // (height * 4))
+        if factor > 1:
+            img = img.reduce(factor)
+        small = img.resize(IMAGE_HASH_SIZE, Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return {
+        'dhash': np.packbits(bits).tobytes().hex(),
+        'pixels': pixels.ravel().tolist(),
+        'size': size,
+    }
+
+
+def load_image_signature(path):
+    """Return :func:`image_signature` for *path*, using ``DIFF_CACHE`` when enabled.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the image (normally an expected result).
+
+    Returns
+    -------
+    dict
+        See :func:`image_signature`.
+    """
+    cache = DIFF_CACHE
+    if cache is None:
+        return image_signature(path)
+    digest = cached_file_digest(path)
+    signature = cache.get_json('dhash', digest)
+    if signature is None:
+        signature = image_signature(path)
+        cache.put_json('dhash', digest, signature)
+    return signature
+
+
+def signatures_match(signature_a, signature_b):
+    """Return True if two image signatures are close enough to skip the RMSE check."""
+    if signature_a['dhash'] != signature_b['dhash'] or signature_a['size'] != signature_b['size']:
+        return False
+    pixels_a = np.asarray(signature_a['pixels'], dtype=np.float64)
+    pixels_b = np.asarray(signature_b['pixels'], dtype=np.float64)
+    return np.sqrt(np.mean((pixels_a - pixels_b) ** 2)) / 255.0 <= IMAGE_HASH_MAX_RMSE
+
+
+def _thumbnail_size(size, bound):
+    """Return *size* scaled down (never up) to fit in *bound*, keeping its aspect ratio."""
+    scale = min(bound[0] / size[0], bound[1] / size[1], 1.0)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def _box_filter(arr, size):
+    """Mean over every *size* x *size* window of *arr* ('valid' mode), via an integral image."""
+    integral = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1))
+    integral[1:, 1:] = arr.cumsum(axis=0).cumsum(axis=1)
+    sums = (
+        integral[size:, size:] - integral[:-size, size:]
+        - integral[size:, :-size] + integral[:-size, :-size]
+    )
+    return sums / (size * size)
+
+
+def ssim_map(arr_a, arr_b, window=SSIM_WINDOW):
+    """Compute the windowed structural similarity of two grayscale arrays.
+
+    Local means, variances and the covariance come from box filters over
+    integral images, so the whole map is a handful of vectorized array
+    operations.
+
+    Parameters
+    ----------
+    arr_a : numpy.ndarray
+        First image, 2-D float array on a 0-255 scale.
+    arr_b : numpy.ndarray
+        Second image, same shape as *arr_a*.
+    window : int
+        Side of the square window; clipped to the image size.
+
+    Returns
+    -------
+    numpy.ndarray
+        SSIM of each window position, in [-1, 1] (1 = identical).
+    """
+    window = max(1, min(window, *arr_a.shape))
+    mu_a = _box_filter(arr_a, window)
+    mu_b = _box_filter(arr_b, window)
+    var_a = _box_filter(arr_a * arr_a, window) - mu_a * mu_a
+    var_b = _box_filter(arr_b * arr_b, window) - mu_b * mu_b
+    cov = _box_filter(arr_a * arr_b, window) - mu_a * mu_b
+    return (
+        (2 * mu_a * mu_b + SSIM_C1) * (2 * cov + SSIM_C2)
+        / ((mu_a * mu_a + mu_b * mu_b + SSIM_C1) * (var_a + var_b + SSIM_C2))
+    )
+
+
+def region_heatmap(values, grid=SSIM_HEATMAP_GRID):
+    """Average *values* over a coarse grid of regions.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        2-D array, e.g. the per-window dissimilarity ``1 - ssim_map``.
+    grid : tuple of int
+        Number of region rows and columns; clipped to the array shape.
+
+    Returns
+    -------
+    list of list of float
+        Mean of *values* in each region, row-major.
+    """
+    rows = np.linspace(0, values.shape[0], min(grid[0], values.shape[0]) + 1).astype(int)
+    cols = np.linspace(0, values.shape[1], min(grid[1], values.shape[1]) + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(values, rows[:-1], axis=0), cols[:-1], axis=1)
+    counts = np.outer(np.diff(rows), np.diff(cols))
+    return (sums / counts).round(4).tolist()
+
+
+def diff_image(file_a, file_b, threshold=None, prefilter=True, metric=DEFAULT_IMAGE_METRIC):
     """Compare two images using downscaled grayscale RMSE.
 
     Downscales both images to a common thumbnail size and converts to
@@ -299,21 +2615,40 @@ def diff_image(file_a, file_b, threshold=DEFAULT_IMAGE_THRESHOLD):
     across platforms/matplotlib versions. Computes RMSE normalized to
     [0, 1] as the primary similarity metric.
 
+    Most plots are unchanged, so two cheap checks run first: byte-identical
+    files, then matching perceptual signatures (see
+    :func:`signatures_match`; the expected side's is cached).  Either one
+    reports the pair as identical (RMSE 0) without the full comparison.
+
     Parameters
     ----------
     file_a : str or Path
         Path to the first image (actual).
     file_b : str or Path
         Path to the second image (expected).
-    threshold : float
-        RMSE threshold above which images are considered different.
+    threshold : float or None
+        Threshold on the selected *metric* above which images are
+        considered different.  None uses ``IMAGE_METRIC_THRESHOLDS``.
+    prefilter : bool
+        Run the digest and perceptual-hash checks before the RMSE.
+    metric : str
+        ``'rmse'`` (global RMSE) or ``'ssim'`` (mean dissimilarity,
+        ``1 - SSIM``, from :func:`ssim_map`, which reacts to moved or
+        resized structures that leave the RMSE unchanged).
 
     Returns
     -------
     dict
         Keys: 'is_different' (bool), 'rmse' (float), 'diff_percent' (float),
-        'error' (str or None), 'size_a' (tuple), 'size_b' (tuple).
+        'error' (str or None), 'size_a' (tuple), 'size_b' (tuple),
+        'prefilter' ('digest', 'dhash' or None: which check matched),
+        'metric' (str), and for ``'ssim'``: 'ssim' (float) and
+        'ssim_heatmap' (:func:`region_heatmap` of ``1 - SSIM``, or None).
     """
+    if metric not in IMAGE_METRICS:
+        raise ValueError('Unknown image metric {0!r}; expected one of {1}'.format(metric, IMAGE_METRICS))
+    if threshold is None:
+        threshold = IMAGE_METRIC_THRESHOLDS[metric]
     result = {
         'is_different': True,
         'rmse': 1.0,
@@ -321,7 +2656,11 @@ def diff_image(file_a, file_b, threshold=DEFAULT_IMAGE_THRESHOLD):
         'error': None,
         'size_a': None,
         'size_b': None,
+        'prefilter': None,
+        'metric': metric,
     }
+    if metric == 'ssim':
+        result.update(ssim=0.0, ssim_heatmap=None)
 
     try:
         img_a = Image.open(file_a)
@@ -333,19 +2672,36 @@ def diff_image(file_a, file_b, threshold=DEFAULT_IMAGE_THRESHOLD):
     result['size_a'] = img_a.size
     result['size_b'] = img_b.size
 
-    # Normalize to the same dimensions so that slight size differences
-    # (from font metrics / DPI across matplotlib versions) don't cause
-    # pixel-level misalignment after thumbnailing.
+    if prefilter:
+        if files_identical(file_a, file_b):
+            result['prefilter'] = 'digest'
+        else:
+            try:
+                if signatures_match(image_signature(file_a), load_image_signature(file_b)):
+                    result['prefilter'] = 'dhash'
+            except Exception:
+                pass
+        if result['prefilter']:
+            result.update(is_different=False, rmse=0.0, diff_percent=0.0)
+            if metric == 'ssim':
+                result['ssim'] = 1.0
+            return result
+
+    # Resize both straight to the thumbnail of their common (largest)
+    # dimensions, so that slight size differences (from font metrics / DPI
+    # across matplotlib versions) don't cause pixel-level misalignment.
+    # draft() lets formats that support it (JPEG) decode at reduced
+    # resolution; reducing_gap box-reduces before the LANCZOS pass, so no
+    # full-resolution resampling is done.
     common_full = (
         max(img_a.width, img_b.width),
         max(img_a.height, img_b.height),
     )
-    img_a = img_a.convert('L').resize(common_full, Image.LANCZOS)
-    img_b = img_b.convert('L').resize(common_full, Image.LANCZOS)
-
-    # Downscale to thumbnail
-    img_a.thumbnail(IMAGE_THUMBNAIL_SIZE, Image.LANCZOS)
-    img_b.thumbnail(IMAGE_THUMBNAIL_SIZE, Image.LANCZOS)
+    thumbnail_size = _thumbnail_size(common_full, IMAGE_THUMBNAIL_SIZE)
+    img_a.draft('L', thumbnail_size)
+    img_b.draft('L', thumbnail_size)
+    img_a = img_a.convert('L').resize(thumbnail_size, Image.LANCZOS, reducing_gap=IMAGE_REDUCING_GAP)
+    img_b = img_b.convert('L').resize(thumbnail_size, Image.LANCZOS, reducing_gap=IMAGE_REDUCING_GAP)
 
     # Light Gaussian blur to smooth out anti-aliasing and font-rendering
     # noise that differs across platforms / matplotlib versions.
@@ -363,7 +2719,13 @@ def diff_image(file_a, file_b, threshold=DEFAULT_IMAGE_THRESHOLD):
 
     result['rmse'] = float(rmse)
     result['diff_percent'] = diff_percent
-    result['is_different'] = rmse > threshold
+    if metric == 'ssim':
+        dissimilarity = 1.0 - ssim_map(arr_a, arr_b)
+        result['ssim'] = float(1.0 - dissimilarity.mean())
+        result['ssim_heatmap'] = region_heatmap(dissimilarity)
+        result['is_different'] = 1.0 - result['ssim'] > threshold
+    else:
+        result['is_different'] = rmse > threshold
 
     return result
 
@@ -377,6 +2739,12 @@ def print_image_diff(file_a, file_b, result):
         diff_pct=result['diff_percent'],
         file=file_a,
     ))
+    if result.get('ssim_heatmap'):
+        heatmap = np.asarray(result['ssim_heatmap'])
+        row, col = np.unravel_index(heatmap.argmax(), heatmap.shape)
+        print('           SSIM={0:.4f}; most changed region: row {1}/{3}, column {2}/{4} (1-SSIM={5:.4f})'.format(
+            result['ssim'], row + 1, col + 1, heatmap.shape[0], heatmap.shape[1], heatmap[row, col],
+        ))
     if result['size_a'] != result['size_b']:
         print('           Size mismatch: actual={0} expected={1}'.format(
             result['size_a'], result['size_b'],
@@ -385,8 +2753,105 @@ def print_image_diff(file_a, file_b, result):
         print('           Error: {0}'.format(result['error']))
 
 
-def diff_dir_images(actual, expected, threshold=DEFAULT_IMAGE_THRESHOLD,
-                    suffixes=IMAGE_SUFFIXES, prompt_to_update=False):
+IndexedFile = namedtuple('IndexedFile', ['path', 'suffix', 'size', 'mtime_ns'])
+
+
+class ResultTreeIndex(object):
+    """Every file under a result directory, found with a single walk.
+
+    Each comparison pass (data files, HTML, images, the plot report)
+    used to glob the whole tree again.  An index is built once and can
+    be passed anywhere a directory path is accepted: it implements
+    ``__fspath__`` and ``__str__``, so ``Path(index)``, ``join(index, ...)``
+    and format strings see the root directory.
+
+    Parameters
+    ----------
+    root : str or Path
+        The directory to index.
+
+    Attributes
+    ----------
+    root : Path
+        The indexed directory.
+    entries : dict
+        Maps each file's path relative to *root* to an
+        :class:`IndexedFile` (path, suffix, size, mtime_ns).
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.entries = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            rel_dir = Path(dirpath).relative_to(self.root)
+            for filename in filenames:
+                path = Path(dirpath) / filename
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                self.entries[rel_dir / filename] = IndexedFile(
+                    path, path.suffix, stat.st_size, stat.st_mtime_ns,
+                )
+
+    def __fspath__(self):
+        return str(self.root)
+
+    def __str__(self):
+        return str(self.root)
+
+    def __repr__(self):
+        return 'ResultTreeIndex({0!r}, {1} files)'.format(str(self.root), len(self.entries))
+
+    def files(self, suffixes):
+        """Return ``{relative path: path}`` for the files with one of *suffixes*."""
+        return {
+            rel: entry.path for rel, entry in self.entries.items()
+            if entry.suffix in suffixes
+        }
+
+
+def index_result_tree(root):
+    """Return *root* if it is already a :class:`ResultTreeIndex`, else index it."""
+    if isinstance(root, ResultTreeIndex):
+        return root
+    return ResultTreeIndex(root)
+
+
+def iter_image_comparisons(file_pairs, threshold=None, workers=None, metric=DEFAULT_IMAGE_METRIC):
+    """Run :func:`diff_image` over *file_pairs*, optionally on a thread pool.
+
+    Parameters
+    ----------
+    file_pairs : list of tuple
+        ``(actual, expected)`` image paths.
+    threshold : float or None
+        Threshold passed to :func:`diff_image`.
+    workers : int or None
+        Number of threads.  ``None`` or ``1`` compares serially.
+    metric : str
+        Image metric passed to :func:`diff_image`.
+
+    Returns
+    -------
+    iterator of dict
+        The :func:`diff_image` results, in the order of *file_pairs*,
+        each with the time the comparison took under 'seconds'.
+    """
+    def compare(file_a, file_b):
+        result, seconds = timed_call(diff_image, file_a, file_b, threshold=threshold, metric=metric)
+        result['seconds'] = seconds
+        return result
+
+    if not workers or workers <= 1 or len(file_pairs) < 2:
+        return (compare(file_a, file_b) for file_a, file_b in file_pairs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return iter(list(executor.map(compare, *zip(*file_pairs))))
+
+
+def diff_dir_images(actual, expected, threshold=None,
+                    suffixes=IMAGE_SUFFIXES, prompt_to_update=False, workers=None,
+                    metric=DEFAULT_IMAGE_METRIC, report=None):
     """Compare all PNG images in two directories using RMSE.
 
     This is a fallback for when matplotlib versions change and PDF
@@ -396,16 +2861,25 @@ def diff_dir_images(actual, expected, threshold=DEFAULT_IMAGE_THRESHOLD,
 
     Parameters
     ----------
-    actual : str
-        Path to directory with actual results.
-    expected : str
-        Path to directory with expected results.
-    threshold : float
-        RMSE threshold for flagging differences.
+    actual : str or ResultTreeIndex
+        Path to directory with actual results, or an index of it.
+    expected : str or ResultTreeIndex
+        Path to directory with expected results, or an index of it.
+    threshold : float or None
+        Threshold on *metric* for flagging differences.  None uses the
+        metric's default from ``IMAGE_METRIC_THRESHOLDS``.
     suffixes : tuple
         Image file extensions to compare.
     prompt_to_update : bool
         Whether to prompt user to update differing images.
+    workers : int or None
+        Number of threads used to compare images (Pillow releases the GIL
+        while decoding and resampling).  ``None`` or ``1`` compares
+        serially.  Results are printed in sorted path order either way.
+    metric : str
+        ``'rmse'`` or ``'ssim'``; see :func:`diff_image`.
+    report : DiffReport or None
+        If given, record every compared, new and missing image.
 
     Returns
     -------
@@ -417,16 +2891,10 @@ def diff_dir_images(actual, expected, threshold=DEFAULT_IMAGE_THRESHOLD,
         print('Install with: pip install Pillow numpy')
         return False
 
-    files_actual = {
-        f.relative_to(actual): f
-        for f in Path(actual).glob('**/*')
-        if f.suffix in suffixes
-    }
-    files_expected = {
-        f.relative_to(expected): f
-        for f in Path(expected).glob('**/*')
-        if f.suffix in suffixes
-    }
+    actual = index_result_tree(actual)
+    expected = index_result_tree(expected)
+    files_actual = actual.files(suffixes)
+    files_expected = expected.files(suffixes)
 
     if not files_actual and not files_expected:
         return False
@@ -435,10 +2903,27 @@ def diff_dir_images(actual, expected, threshold=DEFAULT_IMAGE_THRESHOLD,
     n_compared = 0
     n_different = 0
 
+    if threshold is None:
+        threshold = IMAGE_METRIC_THRESHOLDS[metric]
+    matched = [file_rel for file_rel in sorted(files_actual) if file_rel in files_expected]
+    results = dict(zip(matched, iter_image_comparisons(
+        [(files_actual[file_rel], files_expected[file_rel]) for file_rel in matched],
+        threshold,
+        workers=workers,
+        metric=metric,
+    )))
+
     for file_rel, file_path_actual in sorted(files_actual.items()):
         if file_rel in files_expected:
             n_compared += 1
-            result = diff_image(file_path_actual, files_expected[file_rel], threshold)
+            result = results[file_rel]
+            if report is not None:
+                report.record(
+                    actual.root.name, file_rel, 'image',
+                    'fail' if result['is_different'] else 'pass', result['seconds'],
+                    rmse=result['rmse'], ssim=result.get('ssim'), prefilter=result['prefilter'],
+                    error=result['error'],
+                )
             if result['rmse'] > 0.001:  # Skip completely identical images
                 if result['is_different']:
                     n_different += 1
@@ -453,6 +2938,8 @@ def diff_dir_images(actual, expected, threshold=DEFAULT_IMAGE_THRESHOLD,
             print('New image in Actual ({0}) not found in Expected ({1})'.format(
                 file_rel, expected,
             ))
+            if report is not None:
+                report.record(actual.root.name, file_rel, 'image', 'new')
             diff_exists = True
             if prompt_to_update:
                 update_file(str(file_path_actual), str(join(expected, file_rel)))
@@ -460,49 +2947,266 @@ def diff_dir_images(actual, expected, threshold=DEFAULT_IMAGE_THRESHOLD,
     for file_rel in sorted(files_expected.keys()):
         if file_rel not in files_actual:
             print('Missing image {0} from Actual ({1})'.format(file_rel, actual))
+            if report is not None:
+                report.record(actual.root.name, file_rel, 'image', 'missing')
             diff_exists = True
             if prompt_to_update:
                 remove_file(str(join(expected, file_rel)))
 
     # Summary
     if n_compared > 0:
-        print('\nImage comparison summary: {compared} compared, {different} significantly different (threshold={threshold})'.format(
+        print('\nImage comparison summary: {compared} compared, {different} significantly different ({metric} threshold={threshold})'.format(
             compared=n_compared,
             different=n_different,
+            metric=metric,
             threshold=threshold,
         ))
 
     return diff_exists
 
 
+def write_plot_thumbnail(source, dest_stem):
+    """Write a downscaled copy of the PNG *source* for the plot report.
+
+    Parameters
+    ----------
+    source : str or Path
+        Full-size PNG.
+    dest_stem : Path
+        Output path without a suffix; ``.webp`` or ``.png`` is appended.
+
+    Returns
+    -------
+    Path
+        The file written.  Without Pillow the PNG is copied unchanged.
+    """
+    if not IMAGE_DEPS_AVAILABLE:
+        dest = dest_stem.with_name(dest_stem.name + '.png')
+        copyfile(source, dest)
+        return dest
+    with Image.open(source) as img:
+        img.draft('RGB', PLOT_REPORT_THUMBNAIL_SIZE)
+        img = img.convert('RGBA')
+    img.thumbnail(PLOT_REPORT_THUMBNAIL_SIZE, Image.LANCZOS, reducing_gap=IMAGE_REDUCING_GAP)
+    if pil_features.check('webp'):
+        dest = dest_stem.with_name(dest_stem.name + '.webp')
+        img.save(dest, 'WEBP', lossless=True, method=PLOT_REPORT_WEBP_METHOD)
+    else:
+        dest = dest_stem.with_name(dest_stem.name + '.png')
+        img.save(dest, 'PNG')
+    return dest
+
+
+def _plot_image_html(thumbnail, source, css_class=''):
+    """An ``<img>`` for *thumbnail* (relative to the report) linking to the full-size *source*."""
+    return '<a href="{href}"><img src="{src}" loading="lazy"{cls} /></a>'.format(
+        href=Path(source).resolve().as_uri(),
+        src=thumbnail.as_posix(),
+        cls=' class="{0}"'.format(css_class) if css_class else '',
+    )
+
+
+def _plot_section_html(comp, actual_thumbnail, expected_thumbnail):
+    """Render one plot's comparison; the overlay reuses the two panel thumbnails."""
+    if actual_thumbnail:
+        actual_img = _plot_image_html(actual_thumbnail, comp['actual_png'])
+    else:
+        actual_img = '<div class="missing">Not found</div>'
+    if expected_thumbnail:
+        expected_img = _plot_image_html(expected_thumbnail, comp['expected_png'])
+    else:
+        expected_img = '<div class="missing">Not found</div>'
+
+    # Stats
+    stats = ''
+    if comp['image_result']:
+        r = comp['image_result']
+        stats = 'RMSE={rmse:.4f} &middot; {pct:.1f}% pixels differ'.format(
+            rmse=r['rmse'], pct=r['diff_percent'],
+        )
+        if r['size_a'] != r['size_b']:
+            stats += ' &middot; size mismatch: {0} vs {1}'.format(r['size_a'], r['size_b'])
+
+    # PDF text diff
+    diff_html = ''
+    if comp['pdf_diff']:
+        diff_lines = []
+        for line in comp['pdf_diff']:
+            escaped = line.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').rstrip('\n')
+            if escaped.startswith('+') and not escaped.startswith('+++'):
+                diff_lines.append('<span class="added">{0}</span>'.format(escaped))
+            elif escaped.startswith('-') and not escaped.startswith('---'):
+                diff_lines.append('<span class="removed">{0}</span>'.format(escaped))
+            elif escaped.startswith('@@'):
+                diff_lines.append('<span class="hunk">{0}</span>'.format(escaped))
+            else:
+                diff_lines.append(escaped)
+        if comp.get('pdf_tick_warning'):
+            header = '<div class="tick-warning">⚠ Axis tick labels differ (platform-dependent auto-ticking — not a failure)</div>'
+        else:
+            header = ''
+        diff_html = '{header}<div class="diff-block">{diff}</div>'.format(
+            header=header, diff='\n'.join(diff_lines),
+        )
+
+    # Diff overlay (only when both images exist).  It points at the same
+    # thumbnail files as the panels, so the browser loads each image once.
+    overlay_html = ''
+    if actual_thumbnail and expected_thumbnail:
+        overlay_html = """
+                <div class="image-panel overlay-panel" style="display:none">
+                    <h3>Diff overlay</h3>
+                    <div class="overlay-container">
+                        <img src="{actual}" loading="lazy" />
+                        <img src="{expected}" loading="lazy" class="overlay-img" />
+                    </div>
+                </div>""".format(actual=actual_thumbnail.as_posix(), expected=expected_thumbnail.as_posix())
+
+    return """
+        <div class="comparison">
+            <h2>{name} {toggle}</h2>
+            <div class="images">
+                <div class="image-panel">
+                    <h3>Actual</h3>
+                    {actual}
+                </div>
+                <div class="image-panel">
+                    <h3>Expected</h3>
+                    {expected}
+                </div>
+                {overlay}
+            </div>
+            {stats}
+            {diff}
+        </div>""".format(
+        name=comp['name'],
+        toggle='<button class="toggle-overlay" onclick="toggleOverlay(this)">Show diff</button>'
+               if overlay_html else '',
+        actual=actual_img,
+        expected=expected_img,
+        overlay=overlay_html,
+        stats='<div class="stats">{0}</div>'.format(stats) if stats else '',
+        diff=diff_html,
+    )
+
+
+def write_plot_comparison_report(comparisons, output_dir, title, summary):
+    """Write a plot comparison report into *output_dir*.
+
+    Thumbnails go to ``output_dir/images`` and ``index.html`` is written
+    one section at a time, so neither the images nor the whole page are
+    ever held in memory.
+
+    Parameters
+    ----------
+    comparisons : list of dict
+        Keys: 'name', 'actual_png' / 'expected_png' (path or None),
+        'pdf_diff' (list of str), 'pdf_tick_warning' (bool),
+        'image_result' (dict from :func:`diff_image` or None).
+    output_dir : Path
+        Report directory; created if needed.
+    title : str
+        Page title.
+    summary : str
+        Line shown under the title.
+
+    Returns
+    -------
+    Path
+        Path to ``index.html``.
+    """
+    image_dir = Path(output_dir) / 'images'
+    image_dir.mkdir(parents=True, exist_ok=True)
+    output_path = Path(output_dir) / 'index.html'
+    with open(output_path, 'w') as f:
+        f.write("""<!DOCTYPE html>
+<html><head>
+<title>{title}</title>
+<style>
+    body {{ font-family: system-ui, -apple-system, sans-serif; margin: 20px; background: #f5f5f5; }}
+    h1 {{ color: #333; }}
+    .summary {{ color: #666; margin-bottom: 24px; }}
+    .comparison {{ background: white; margin: 20px 0; padding: 20px; border-radius: 8px;
+                   box-shadow: 0 1px 3px rgba(0,0,0,0.12); }}
+    .comparison h2 {{ margin-top: 0; color: #333; font-size: 16px; font-family: monospace;
+                      word-break: break-all; }}
+    .images {{ display: flex; gap: 20px; }}
+    .image-panel {{ flex: 1; min-width: 0; }}
+    .image-panel img {{ max-width: 100%; border: 1px solid #ddd; border-radius: 4px; }}
+    .image-panel h3 {{ margin: 0 0 8px; color: #666; font-size: 14px; }}
+    .diff-block {{ background: #1e1e1e; color: #d4d4d4; padding: 12px; border-radius: 4px;
+                   margin-top: 16px; font-family: monospace; font-size: 13px;
+                   white-space: pre-wrap; overflow-x: auto; line-height: 1.5; }}
+    .diff-block .added {{ color: #4ec9b0; }}
+    .diff-block .removed {{ color: #f44747; }}
+    .diff-block .hunk {{ color: #569cd6; }}
+    .stats {{ color: #888; font-size: 13px; margin-top: 12px; }}
+    .missing {{ color: #f44747; font-style: italic; padding: 40px; text-align: center;
+                border: 2px dashed #f44747; border-radius: 4px; }}
+    .tick-warning {{ color: #b58900; font-size: 13px; margin: 12px 0 4px; font-style: italic; }}
+    .toggle-overlay {{ font-size: 12px; padding: 2px 10px; margin-left: 12px;
+                       cursor: pointer; border: 1px solid #ccc; border-radius: 4px;
+                       background: #f5f5f5; vertical-align: middle; }}
+    .toggle-overlay:hover {{ background: #e8e8e8; }}
+    .overlay-container {{ position: relative; }}
+    .overlay-container img:first-child {{ max-width: 100%; border: 1px solid #ddd; border-radius: 4px; }}
+    .overlay-img {{ position: absolute; top: 0; left: 0; max-width: 100%;
+                    mix-blend-mode: difference; }}
+</style>
+<script>
+function toggleOverlay(btn) {{
+    var comp = btn.closest('.comparison');
+    var panel = comp.querySelector('.overlay-panel');
+    var visible = panel.style.display !== 'none';
+    panel.style.display = visible ? 'none' : '';
+    btn.textContent = visible ? 'Show diff' : 'Hide diff';
+}}
+</script>
+</head><body>
+    <h1>{title}</h1>
+    <p class="summary">{summary}</p>
+""".format(title=title, summary=summary))
+        for n, comp in enumerate(comparisons):
+            thumbnails = {}
+            for side in ('actual', 'expected'):
+                source = comp[side + '_png']
+                thumbnails[side] = write_plot_thumbnail(
+                    source, image_dir / '{0:04d}_{1}'.format(n, side),
+                ).relative_to(output_dir) if source else None
+            f.write(_plot_section_html(comp, thumbnails['actual'], thumbnails['expected']))
+        f.write('\n</body></html>')
+    return output_path
+
+
 def generate_plot_comparison_html(actual_dir, expected_dir):
-    """Generate an HTML page comparing plots with differences side-by-side.
+    """Generate an HTML report comparing plots with differences side-by-side.
 
     For each plot that has a PDF text diff or any PNG pixel difference,
     shows actual and expected PNGs side-by-side with the text diff below.
+    The report is a directory holding ``index.html`` and downscaled
+    copies of the plots; see :func:`write_plot_comparison_report`.
 
     Parameters
     ----------
-    actual_dir : str or Path
-        Directory with actual results.
-    expected_dir : str or Path
-        Directory with expected results.
+    actual_dir : str, Path or ResultTreeIndex
+        Directory with actual results, or an index of it.
+    expected_dir : str, Path or ResultTreeIndex
+        Directory with expected results, or an index of it.
 
     Returns
     -------
     str or None
-        Path to the generated HTML file, or None if no differences found.
+        Path to the report's ``index.html``, or None if no differences found.
     """
-    import base64
-    import platform
+    actual_index = index_result_tree(actual_dir)
+    expected_index = index_result_tree(expected_dir)
+    actual_dir = actual_index.root
+    expected_dir = expected_index.root
 
-    actual_dir = Path(actual_dir)
-    expected_dir = Path(expected_dir)
-
-    actual_pngs = {f.relative_to(actual_dir): f for f in actual_dir.glob('**/*.png')}
-    expected_pngs = {f.relative_to(expected_dir): f for f in expected_dir.glob('**/*.png')}
-    actual_pdfs = {f.relative_to(actual_dir): f for f in actual_dir.glob('**/*.pdf')}
-    expected_pdfs = {f.relative_to(expected_dir): f for f in expected_dir.glob('**/*.pdf')}
+    actual_pngs = actual_index.files(('.png',))
+    expected_pngs = expected_index.files(('.png',))
+    actual_pdfs = actual_index.files(('.pdf',))
+    expected_pdfs = expected_index.files(('.pdf',))
 
     # Collect all unique plot stems (filename without extension).
     # Use string manipulation because Path.with_suffix breaks on
@@ -551,166 +3255,27 @@ def generate_plot_comparison_html(actual_dir, expected_dir):
         if not significant and not pdf_tick_warning:
             continue
 
-        def encode_png(path):
-            with open(path, 'rb') as f:
-                return base64.b64encode(f.read()).decode()
-
         comparisons.append({
             'name': str(stem),
-            'actual_png': encode_png(actual_pngs[png_rel]) if png_rel in actual_pngs else None,
-            'expected_png': encode_png(expected_pngs[png_rel]) if png_rel in expected_pngs else None,
+            'actual_png': actual_pngs.get(png_rel),
+            'expected_png': expected_pngs.get(png_rel),
             'pdf_diff': pdf_diff_lines,
             'pdf_tick_warning': pdf_tick_warning,
-            'image_result': image_result,
-        })
-
-    if not comparisons:
-        return None
-
-    # Build HTML
-    test_name = actual_dir.name
-    sections = []
-    for comp in comparisons:
-        # Images
-        if comp['actual_png']:
-            actual_img = '<img src="data:image/png;base64,{0}" />'.format(comp['actual_png'])
-        else:
-            actual_img = '<div class="missing">Not found</div>'
-        if comp['expected_png']:
-            expected_img = '<img src="data:image/png;base64,{0}" />'.format(comp['expected_png'])
-        else:
-            expected_img = '<div class="missing">Not found</div>'
-
-        # Stats
-        stats = ''
-        if comp['image_result']:
-            r = comp['image_result']
-            stats = 'RMSE={rmse:.4f} &middot; {pct:.1f}% pixels differ'.format(
-                rmse=r['rmse'], pct=r['diff_percent'],
-            )
-            if r['size_a'] != r['size_b']:
-                stats += ' &middot; size mismatch: {0} vs {1}'.format(r['size_a'], r['size_b'])
-
-        # PDF text diff
-        diff_html = ''
-        if comp['pdf_diff']:
-            diff_lines = []
-            for line in comp['pdf_diff']:
-                escaped = line.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').rstrip('\n')
-                if escaped.startswith('+') and not escaped.startswith('+++'):
-                    diff_lines.append('<span class="added">{0}</span>'.format(escaped))
-                elif escaped.startswith('-') and not escaped.startswith('---'):
-                    diff_lines.append('<span class="removed">{0}</span>'.format(escaped))
-                elif escaped.startswith('@@'):
-                    diff_lines.append('<span class="hunk">{0}</span>'.format(escaped))
-                else:
-                    diff_lines.append(escaped)
-            if comp.get('pdf_tick_warning'):
-                header = '<div class="tick-warning">⚠ Axis tick labels differ (platform-dependent auto-ticking — not a failure)</div>'
-            else:
-                header = ''
-            diff_html = '{header}<div class="diff-block">{diff}</div>'.format(
-                header=header, diff='\n'.join(diff_lines),
-            )
-
-        # Diff overlay (only when both images exist)
-        overlay_html = ''
-        if comp['actual_png'] and comp['expected_png']:
-            overlay_html = """
-                <div class="image-panel overlay-panel" style="display:none">
-                    <h3>Diff overlay</h3>
-                    <div class="overlay-container">
-                        <img src="data:image/png;base64,{actual_b64}" />
-                        <img src="data:image/png;base64,{expected_b64}" class="overlay-img" />
-                    </div>
-                </div>""".format(actual_b64=comp['actual_png'], expected_b64=comp['expected_png'])
-
-        sections.append("""
-        <div class="comparison">
-            <h2>{name} {toggle}</h2>
-            <div class="images">
-                <div class="image-panel">
-                    <h3>Actual</h3>
-                    {actual}
-                </div>
-                <div class="image-panel">
-                    <h3>Expected</h3>
-                    {expected}
-                </div>
-                {overlay}
-            </div>
-            {stats}
-            {diff}
-        </div>""".format(
-            name=comp['name'],
-            toggle='<button class="toggle-overlay" onclick="toggleOverlay(this)">Show diff</button>'
-                   if overlay_html else '',
-            actual=actual_img,
-            expected=expected_img,
-            overlay=overlay_html,
-            stats='<div class="stats">{0}</div>'.format(stats) if stats else '',
-            diff=diff_html,
-        ))
+            'image_result': image_result,
+        })
 
-    html = """<!DOCTYPE html>
-<html><head>
-<title>Plot Comparison: {test_name}</title>
-<style>
-    body {{ font-family: system-ui, -apple-system, sans-serif; margin: 20px; background: #f5f5f5; }}
-    h1 {{ color: #333; }}
-    .summary {{ color: #666; margin-bottom: 24px; }}
-    .comparison {{ background: white; margin: 20px 0; padding: 20px; border-radius: 8px;
-                   box-shadow: 0 1px 3px rgba(0,0,0,0.12); }}
-    .comparison h2 {{ margin-top: 0; color: #333; font-size: 16px; font-family: monospace;
-                      word-break: break-all; }}
-    .images {{ display: flex; gap: 20px; }}
-    .image-panel {{ flex: 1; min-width: 0; }}
-    .image-panel img {{ max-width: 100%; border: 1px solid #ddd; border-radius: 4px; }}
-    .image-panel h3 {{ margin: 0 0 8px; color: #666; font-size: 14px; }}
-    .diff-block {{ background: #1e1e1e; color: #d4d4d4; padding: 12px; border-radius: 4px;
-                   margin-top: 16px; font-family: monospace; font-size: 13px;
-                   white-space: pre-wrap; overflow-x: auto; line-height: 1.5; }}
-    .diff-block .added {{ color: #4ec9b0; }}
-    .diff-block .removed {{ color: #f44747; }}
-    .diff-block .hunk {{ color: #569cd6; }}
-    .stats {{ color: #888; font-size: 13px; margin-top: 12px; }}
-    .missing {{ color: #f44747; font-style: italic; padding: 40px; text-align: center;
-                border: 2px dashed #f44747; border-radius: 4px; }}
-    .tick-warning {{ color: #b58900; font-size: 13px; margin: 12px 0 4px; font-style: italic; }}
-    .toggle-overlay {{ font-size: 12px; padding: 2px 10px; margin-left: 12px;
-                       cursor: pointer; border: 1px solid #ccc; border-radius: 4px;
-                       background: #f5f5f5; vertical-align: middle; }}
-    .toggle-overlay:hover {{ background: #e8e8e8; }}
-    .overlay-container {{ position: relative; }}
-    .overlay-container img:first-child {{ max-width: 100%; border: 1px solid #ddd; border-radius: 4px; }}
-    .overlay-img {{ position: absolute; top: 0; left: 0; max-width: 100%;
-                    mix-blend-mode: difference; }}
-</style>
-<script>
-function toggleOverlay(btn) {{
-    var comp = btn.closest('.comparison');
-    var panel = comp.querySelector('.overlay-panel');
-    var visible = panel.style.display !== 'none';
-    panel.style.display = visible ? 'none' : '';
-    btn.textContent = visible ? 'Show diff' : 'Hide diff';
-}}
-</script>
-</head><body>
-    <h1>Plot Comparison: {test_name}</h1>
-    <p class="summary">{n} plot(s) with differences &middot; {actual_dir} vs {expected_dir}</p>
-    {sections}
-</body></html>""".format(
-        test_name=test_name,
-        n=len(comparisons),
-        actual_dir=actual_dir,
-        expected_dir=expected_dir,
-        sections='\n'.join(sections),
-    )
-
-    output_dir = Path(tempfile.mkdtemp())
-    output_path = output_dir / 'plot_comparison_{0}.html'.format(test_name)
-    with open(output_path, 'w') as f:
-        f.write(html)
+    if not comparisons:
+        return None
+
+    test_name = actual_dir.name
+    output_path = write_plot_comparison_report(
+        comparisons,
+        Path(tempfile.mkdtemp()) / 'plot_comparison_{0}'.format(test_name),
+        title='Plot Comparison: {0}'.format(test_name),
+        summary='{n} plot(s) with differences &middot; {actual_dir} vs {expected_dir}'.format(
+            n=len(comparisons), actual_dir=actual_dir, expected_dir=expected_dir,
+        ),
+    )
 
     print('\nPlot comparison: {0}'.format(output_path))
 
@@ -723,15 +3288,249 @@ function toggleOverlay(btn) {{
     return str(output_path)
 
 
-def print_diff(diff_results):
-    if YDIFF_INSTALLED:
-        with tempfile.NamedTemporaryFile(mode='w') as fh:
-            fh.writelines(''.join(diff_results))
-            fh.flush()
-            subprocess.check_call(f'cat {fh.name} | ydiff -s -w 0 --wrap -p cat', shell=True)
+def _tint(text, kind, color):
+    """Wrap *text* in the ANSI color for *kind* when *color* is set."""
+    if not color or not text:
+        return text
+    return DIFF_COLORS[kind] + text + ANSI_RESET
+
+
+def _pair_hunk_lines(lines):
+    """Lay out one hunk as side-by-side rows.
+
+    Yields
+    ------
+    tuple (old, new, changed)
+        Context lines appear on both sides.  A run of removed lines and
+        the run of added lines after it are paired row by row; the
+        shorter side is padded with None.
+    """
+    removed, added = [], []
+    for line in lines:
+        sign, text = line[:1], line[1:].rstrip('\n').expandtabs(DIFF_TAB_WIDTH)
+        if sign == '-':
+            if added:
+                yield from ((old, new, True) for old, new in zip_longest(removed, added))
+                removed, added = [], []
+            removed.append(text)
+        elif sign == '+':
+            added.append(text)
+        else:
+            yield from ((old, new, True) for old, new in zip_longest(removed, added))
+            removed, added = [], []
+            yield text, text, False
+    yield from ((old, new, True) for old, new in zip_longest(removed, added))
+
+
+def _highlight_changes(old, new):
+    """Color a changed pair, reversing the span between their common prefix and suffix.
+
+    Trimming the common ends is linear in the line length, unlike a
+    character-level SequenceMatcher, which is quadratic on the long,
+    repetitive sequences in allele tables.
+    """
+    if old is None:
+        return None, _tint(new, 'new', True)
+    if new is None:
+        return _tint(old, 'old', True), None
+    prefix = len(os.path.commonprefix((old, new)))
+    suffix = len(os.path.commonprefix((old[prefix:][::-1], new[prefix:][::-1])))
+    return tuple(
+        _tint(text[:prefix], kind, True)
+        + _tint(text[prefix:len(text) - suffix], kind + '_text', True)
+        + _tint(text[len(text) - suffix:], kind, True)
+        for text, kind in ((old, 'old'), (new, 'new'))
+    )
+
+
+def _wrap_columns(text, width):
+    """Split *text* into rows of at most *width* visible characters.
+
+    ANSI color codes take no space, and a color that spans a row break
+    is closed at the end of the row and reopened on the next.
+
+    Returns
+    -------
+    list of tuple (str, int)
+        Each row and its visible length.
+    """
+    rows, row, visible, active = [], [], 0, None
+    for token in ANSI_ESCAPE_REGEXP.split(text):
+        if ANSI_ESCAPE_REGEXP.fullmatch(token):
+            row.append(token)
+            active = None if token == ANSI_RESET else token
+            continue
+        while token:
+            take = token[:width - visible]
+            row.append(take)
+            visible += len(take)
+            token = token[len(take):]
+            if visible == width:
+                rows.append((''.join(row) + (ANSI_RESET if active else ''), visible))
+                row, visible = [active] if active else [], 0
+    if visible or not rows:
+        rows.append((''.join(row), visible))
+    return rows
+
+
+def _render_hunk(lines, numbers, width, color):
+    """Render the lines of one hunk as side-by-side rows (see :func:`render_side_by_side`)."""
+    rows = list(_pair_hunk_lines(lines))
+    if numbers is None:
+        number_width = 0
     else:
-        for line in diff_results:
-            print(line, end='')
+        number_width = len(str(max(numbers) + len(rows)))
+    column = max(
+        DIFF_MIN_COLUMN_WIDTH,
+        (width - len(DIFF_COLUMN_MARKERS['context'])) // 2 - (number_width + 1 if number_width else 0),
+    )
+    out = []
+    for old, new, changed in rows:
+        if not changed:
+            marker = DIFF_COLUMN_MARKERS['context']
+        elif old is None:
+            marker = DIFF_COLUMN_MARKERS['added']
+        elif new is None:
+            marker = DIFF_COLUMN_MARKERS['removed']
+        else:
+            marker = DIFF_COLUMN_MARKERS['changed']
+        if changed and color:
+            old_text, new_text = _highlight_changes(old, new)
+        else:
+            old_text, new_text = old, new
+        cells = []
+        for side, text in enumerate((old_text, new_text)):
+            label = ''
+            if text is not None and numbers is not None:
+                label = str(numbers[side])
+                numbers[side] += 1
+            cells.append((label, _wrap_columns(text or '', column)))
+        for n_row in range(max(len(cells[0][1]), len(cells[1][1]))):
+            halves = []
+            for label, wrapped in cells:
+                text, visible = wrapped[n_row] if n_row < len(wrapped) else ('', 0)
+                if number_width:
+                    number = _tint((label if n_row == 0 else '').rjust(number_width), 'line_number', color)
+                    text = number + ' ' + text
+                halves.append(text + ' ' * (column - visible))
+            out.append((halves[0] + marker + halves[1]).rstrip() + '\n')
+    return out
+
+
+def render_side_by_side(diff_results, width=None, color=True):
+    """Render a comparator's diff lines with Actual and Expected side by side.
+
+    Hunks (``@@`` headers followed by `` ``/``-``/``+`` lines) are laid out
+    in two columns with line numbers, when the hunk header has them, and
+    a sdiff-style marker between the columns (``|`` changed, ``<``
+    removed, ``>`` added).  Long lines wrap within their column.  All
+    other lines, such as ``---``/``+++`` file headers or summaries like
+    "3 of 10 records differ", are passed through.
+
+    Parameters
+    ----------
+    diff_results : list of str
+        Lines from :func:`compare_files`.
+    width : int or None
+        Total output width; None uses the terminal width.
+    color : bool
+        Color removed/added lines and reverse the spans that changed.
+
+    Returns
+    -------
+    list of str
+        Output lines, each ending in a newline.
+    """
+    if width is None:
+        width = get_terminal_size(DIFF_DEFAULT_TERMINAL_SIZE).columns
+    out = []
+    hunk = None  # lines of the current hunk
+    numbers = remaining = None
+    for line in diff_results:
+        if hunk is not None:
+            sign = line[:1]
+            if remaining is not None:
+                in_hunk = remaining != [0, 0] and sign in ' -+'
+            else:
+                in_hunk = sign in ' -+' and not line.startswith(('--- ', '+++ '))
+            if in_hunk:
+                hunk.append(line)
+                if remaining is not None:
+                    remaining[0] -= sign in ' -'
+                    remaining[1] -= sign in ' +'
+                continue
+            out.extend(_render_hunk(hunk, numbers, width, color))
+            hunk = None
+        if line.startswith('@@'):
+            match = HUNK_HEADER_REGEXP.match(line)
+            if match:
+                old_start, old_length, new_start, new_length = match.groups()
+                numbers = [int(old_start), int(new_start)]
+                remaining = [int((old_length or ',1')[1:]), int((new_length or ',1')[1:])]
+            else:
+                numbers = remaining = None
+            hunk = []
+            out.append(_tint(line.rstrip('\n'), 'hunk', color) + '\n')
+        elif line.startswith('--- '):
+            out.append(_tint(line.rstrip('\n'), 'old_path', color) + '\n')
+        elif line.startswith('+++ '):
+            out.append(_tint(line.rstrip('\n'), 'new_path', color) + '\n')
+        else:
+            out.append(_tint(line.rstrip('\n'), 'header', color) + '\n')
+    if hunk:
+        out.extend(_render_hunk(hunk, numbers, width, color))
+    return out
+
+
+def render_with_ydiff(diff_results):
+    """Render *diff_results* side by side with the ydiff library.
+
+    Raises
+    ------
+    Exception
+        Whatever ydiff raises for lines it cannot parse (e.g. hunks
+        without line ranges); :func:`print_diff` then falls back to
+        :func:`render_side_by_side`.
+    """
+    marker = ydiff.DiffMarker(side_by_side=True, width=0, wrap=True)
+    parser = ydiff.DiffParser(line.encode('utf-8') for line in diff_results)
+    return [line for parsed in parser.parse() for line in marker.markup(parsed)]
+
+
+def print_diff(diff_results, side_by_side=None, out=None):
+    """Print the diff lines of one file pair.
+
+    On a terminal the diff is shown side by side and colored, using the
+    ydiff library when it is installed and :func:`render_side_by_side`
+    otherwise.  Elsewhere (CI logs, pipes) the lines are written as-is,
+    like ``ydiff --color=auto``.  Either way everything is rendered in
+    process and written to *out* in one call.
+
+    Parameters
+    ----------
+    diff_results : list of str
+        Lines from :func:`compare_files`.
+    side_by_side : bool or None
+        Force or suppress the side-by-side view; None decides by whether
+        *out* is a terminal.
+    out : file object or None
+        Stream to write to; the default is ``sys.stdout``.
+    """
+    out = sys.stdout if out is None else out
+    if side_by_side is None:
+        side_by_side = out.isatty()
+    if not side_by_side:
+        out.write(''.join(diff_results))
+        return
+    rendered = None
+    if YDIFF_INSTALLED:
+        try:
+            rendered = render_with_ydiff(diff_results)
+        except Exception:
+            rendered = None
+    if rendered is None:
+        rendered = render_side_by_side(diff_results, color=True)
+    out.write(''.join(rendered))
 
 
 def find_dir_matches(file_path_a, files_b, matches):
@@ -759,65 +3558,663 @@ def remove_file(file_path):
     os.remove(file_path)
 
 
-def diff_dir(actual, expected, suffixes=TEXT_SUFFIXES, prompt_to_update=False):
-    files_actual = {f.relative_to(actual): f for f in Path(actual).glob('**/*') if f.suffix in suffixes}
-    files_expected = {f.relative_to(expected): f for f in Path(expected).glob('**/*') if f.suffix in suffixes}
+def comparator_for(file_actual):
+    """Name the comparator :func:`compare_files` uses for *file_actual*.
+
+    Returns
+    -------
+    str
+        One of ``'pdf'``, ``'zip'``, ``'alignment'``, ``'gzip'``,
+        ``'json'``, ``'html'``, ``'npz'``, ``'alleles'``, ``'table'`` or
+        ``'text'``.
+    """
+    suffix = Path(file_actual).suffix
+    if suffix in PDF_SUFFIXES:
+        return 'pdf'
+    if suffix in ZIP_SUFFIXES:
+        return 'zip'
+    if suffix in ALIGNMENT_SUFFIXES:
+        return 'alignment'
+    if suffix in GZIP_SUFFIXES:
+        return 'gzip'
+    if suffix in JSON_SUFFIXES:
+        return 'json'
+    if suffix in HTML_SUFFIXES:
+        return 'html'
+    if suffix in NPZ_SUFFIXES:
+        return 'npz'
+    if ALLELE_TABLE_REGEXP.search(Path(file_actual).name):
+        return 'alleles'
+    if NUMPY_AVAILABLE and NUMERIC_TABLE_REGEXP.search(Path(file_actual).name):
+        return 'table'
+    return 'text'
+
+
+def compare_files(file_actual, file_expected, rule=None):
+    """Compare a single actual/expected file pair.
+
+    This is the unit of work that :func:`diff_dir` hands to its worker
+    pool, so it must stay a module-level function (picklable) and must
+    not print or prompt.
+
+    Parameters
+    ----------
+    file_actual : str or Path
+        Path to the actual file.
+    file_expected : str or Path
+        Path to the expected file.
+    rule : DiffRule or None
+        The comparator and tolerances to use (see :class:`DiffRules`).
+        ``None`` uses :func:`comparator_for` and the comparator's default
+        tolerances.
+
+    Returns
+    -------
+    tuple (diff_results, tick_diff)
+        *diff_results*: diff lines that count as a difference (empty if
+        the files match).  *tick_diff*: truncated diff lines for PDFs
+        whose only differences are numeric axis ticks (warning only).
+    """
+    comparator = rule.comparator if rule is not None and rule.comparator else comparator_for(file_actual)
+    tolerances = {}
+    if rule is not None:
+        tolerances = {
+            name: value for name, value in (('atol', rule.atol), ('rtol', rule.rtol)) if value is not None
+        }
+    if comparator == 'pdf':
+        sig_diff, tick_diff = diff_pdf(file_actual, file_expected)
+        if sig_diff:
+            return truncate_diff_lines(sig_diff), []
+        return [], truncate_diff_lines(tick_diff)
+    if comparator == 'zip':
+        return diff_zip(file_actual, file_expected), []
+    if comparator == 'alignment':
+        return diff_alignments(file_actual, file_expected), []
+    if comparator == 'gzip':
+        return diff_gzip(file_actual, file_expected), []
+    if comparator == 'json':
+        return diff_json(file_actual, file_expected, **tolerances), []
+    if comparator == 'html':
+        return diff_html(file_actual, file_expected, **tolerances), []
+    if comparator == 'npz':
+        if NUMPY_AVAILABLE:
+            return diff_npz(file_actual, file_expected, **tolerances), []
+        if files_identical(file_actual, file_expected):
+            return [], []
+        return ['Binary files {0} and {1} differ\n'.format(file_actual, file_expected)], []
+    if comparator == 'alleles':
+        return diff_allele_table(file_actual, file_expected, **tolerances), []
+    if comparator == 'table' and NUMPY_AVAILABLE:
+        return diff_table(file_actual, file_expected, **tolerances), []
+    return diff(file_actual, file_expected), []
+
+
+GLOB_TOKEN_REGEXP = re.compile(r'(\*|\?|\[!?\]?[^\]]*\])')
+
+
+def _file_name_glob_regexp(pattern):
+    """Translate a file name glob into a regex whose wildcards stop at ``/``.
+
+    ``fnmatch.translate`` lets ``*`` match ``/``, so ``Alleles*.txt`` would
+    also match ``Alleles_out/mapping_statistics.txt``.
+    """
+    parts = []
+    for n, token in enumerate(GLOB_TOKEN_REGEXP.split(pattern)):
+        if n % 2 == 0:
+            parts.append(re.escape(token))
+        elif token == '*':
+            parts.append('[^/]*')
+        elif token == '?':
+            parts.append('[^/]')
+        else:
+            negate = token.startswith('[!')
+            body = re.sub(r'([\\\[\]&~|^])', r'\\\1', token[2 if negate else 1:-1])
+            parts.append('[^/{0}]'.format(body) if negate else '[{0}]'.format(body))
+    return '(?:.*/)?{0}\\Z'.format(''.join(parts))
+
+
+DiffRule = namedtuple('DiffRule', ['pattern', 'comparator', 'severity', 'atol', 'rtol'], defaults=(None,) * 4)
+
+
+class DiffRules(object):
+    """Per-file comparison rules compiled into a path -> rule dispatch table.
+
+    The glob patterns are translated once into a single regular expression
+    with one alternative per rule, in rule order, so the first matching
+    rule is found with one match.  Every resolved path is memoized, so
+    :func:`diff_dir` asking again for the verdict, the report and the
+    new/missing passes is a dict lookup, and the suffix tests behind
+    :func:`comparator_for` run once per file.
+
+    Patterns containing a ``/`` match the path relative to the result
+    directory; other patterns match the file name in any directory.
+
+    Parameters
+    ----------
+    rules : iterable of DiffRule
+        The rules, first match wins.
+
+    Raises
+    ------
+    ValueError
+        If a rule has no pattern, an unknown comparator or severity, or
+        tolerances for a comparator that does not take them.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = tuple(rules)
+        for n, rule in enumerate(self.rules, 1):
+            if not rule.pattern:
+                raise ValueError('Rule {0} has no pattern'.format(n))
+            if rule.comparator is not None and rule.comparator not in DIFF_RULE_COMPARATORS:
+                raise ValueError('Rule {0} ({1}): unknown comparator {2!r}, expected one of {3}'.format(
+                    n, rule.pattern, rule.comparator, ', '.join(DIFF_RULE_COMPARATORS),
+                ))
+            if rule.severity is not None and rule.severity not in DIFF_RULE_SEVERITIES:
+                raise ValueError('Rule {0} ({1}): unknown severity {2!r}, expected one of {3}'.format(
+                    n, rule.pattern, rule.severity, ', '.join(DIFF_RULE_SEVERITIES),
+                ))
+            has_tolerance = rule.atol is not None or rule.rtol is not None
+            if has_tolerance and rule.comparator not in DIFF_RULE_TOLERANCE_COMPARATORS:
+                raise ValueError('Rule {0} ({1}): tolerances need one of the comparators {2}'.format(
+                    n, rule.pattern, ', '.join(DIFF_RULE_TOLERANCE_COMPARATORS),
+                ))
+        self._regexp = re.compile('|'.join(
+            '(?P<rule{0}>{1})'.format(n, fnmatch_translate(rule.pattern) if '/' in rule.pattern
+                                      else _file_name_glob_regexp(rule.pattern))
+            for n, rule in enumerate(self.rules)
+        )) if self.rules else None
+        self._table = {}
+
+    def __repr__(self):
+        return 'DiffRules({0} rules, {1} paths resolved)'.format(len(self.rules), len(self._table))
+
+    @property
+    def extra_suffixes(self):
+        """Suffixes named by rule patterns that no built-in comparison collects.
+
+        Callers add these to the data suffixes they pass to
+        :func:`diff_dir`, so a rule for a new output type (``*.tsv``) is
+        enough to have it compared.
+        """
+        known = TEXT_SUFFIXES + PDF_SUFFIXES + IMAGE_SUFFIXES
+        suffixes = []
+        for rule in self.rules:
+            if rule.severity == 'ignore':
+                continue
+            suffix = Path(rule.pattern).suffix
+            if suffix and suffix not in known and suffix not in suffixes and not re.search(r'[*?\[]', suffix):
+                suffixes.append(suffix)
+        return tuple(suffixes)
+
+    def _match(self, rel_path):
+        match = self._regexp.match(rel_path) if self._regexp is not None else None
+        if match is None:
+            return DiffRule(None)
+        return self.rules[int(match.lastgroup[4:])]
+
+    def rule_for(self, rel_path):
+        """Resolve the rule for a file, with the built-in defaults filled in.
+
+        Parameters
+        ----------
+        rel_path : str or Path
+            The file's path relative to the result directory.
+
+        Returns
+        -------
+        DiffRule
+            The first matching rule (``pattern`` is None if none
+            matched), with ``comparator`` and ``severity`` always set:
+            the comparator from :func:`comparator_for`, the severity
+            ``'fail'``.
+        """
+        try:
+            return self._table[rel_path]
+        except KeyError:
+            pass
+        posix_path = Path(rel_path).as_posix()
+        rule = self._match(posix_path)
+        if rule.comparator is None:
+            rule = rule._replace(comparator=comparator_for(posix_path))
+        if rule.severity is None:
+            rule = rule._replace(severity='fail')
+        self._table[rel_path] = rule
+        return rule
+
+
+def load_diff_rules(path=DIFF_RULES_FILE):
+    """Read comparison rules from a TOML file.
+
+    The file holds an array of ``[[rule]]`` tables with a ``pattern`` and
+    any of ``comparator``, ``severity``, ``atol`` and ``rtol``.  A missing
+    file gives no rules.
+
+    Parameters
+    ----------
+    path : str or Path
+        The rules file.
+
+    Returns
+    -------
+    DiffRules
+        The compiled rules.
+
+    Raises
+    ------
+    ImportError
+        If the file exists but there is no TOML parser (Python < 3.11
+        without ``tomli``): it holds the ignored and warning-only files,
+        so skipping it would change the verdicts.
+    ValueError
+        If the file is not valid TOML or a rule is invalid.
+    """
+    path = Path(path)
+    if not path.exists():
+        return DiffRules()
+    if tomllib is None:
+        raise ImportError('Reading {0} needs Python 3.11+ or tomli (pip install tomli)'.format(path))
+    with open(path, 'rb') as fh:
+        try:
+            document = tomllib.load(fh)
+        except tomllib.TOMLDecodeError as e:
+            raise ValueError('{0}: {1}'.format(path, e))
+    rules = []
+    for n, table in enumerate(document.get('rule', []), 1):
+        unknown = set(table) - set(DiffRule._fields)
+        if unknown:
+            raise ValueError('{0}: rule {1} has unknown keys {2}'.format(path, n, ', '.join(sorted(unknown))))
+        rules.append(DiffRule(**table))
+    try:
+        return DiffRules(rules)
+    except ValueError as e:
+        raise ValueError('{0}: {1}'.format(path, e))
+
+
+@lru_cache(maxsize=None)
+def default_diff_rules():
+    """The rules from ``DIFF_RULES_FILE``, loaded and compiled once."""
+    return load_diff_rules(DIFF_RULES_FILE)
+
+
+def timed_call(func, *args, **kwargs):
+    """Return ``(func(*args, **kwargs), elapsed wall time in seconds)``."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _timed_compare_files(file_actual, file_expected, rule=None):
+    """:func:`compare_files` plus its timing, flattened for the worker pool."""
+    (diff_results, tick_diff), seconds = timed_call(compare_files, file_actual, file_expected, rule)
+    return diff_results, tick_diff, seconds
+
+
+def _init_worker(diff_cache):
+    """Carry the parent's cache setting into pool workers (needed under spawn)."""
+    global DIFF_CACHE
+    DIFF_CACHE = diff_cache
+
+
+def iter_file_comparisons(file_pairs, workers=None, rules=None):
+    """Compare file pairs, optionally in a process pool.
+
+    Parameters
+    ----------
+    file_pairs : list of tuple
+        ``(file_actual, file_expected)`` pairs to compare.
+    workers : int or None
+        Number of worker processes.  ``None``, ``0`` or ``1`` compares
+        the files serially in the current process.
+    rules : list of DiffRule or None
+        The resolved rule for each pair, passed to :func:`compare_files`.
+
+    Yields
+    ------
+    tuple (diff_results, tick_diff, seconds)
+        The :func:`compare_files` result for each pair and the time it
+        took, in the same order as *file_pairs* regardless of which
+        worker finishes first.
+    """
+    if rules is None:
+        rules = [None] * len(file_pairs)
+    if not workers or workers <= 1 or len(file_pairs) < 2:
+        for (file_actual, file_expected), rule in zip(file_pairs, rules):
+            yield _timed_compare_files(file_actual, file_expected, rule)
+        return
+    files_a = [pair[0] for pair in file_pairs]
+    files_b = [pair[1] for pair in file_pairs]
+    chunksize = max(1, len(file_pairs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(DIFF_CACHE,)) as executor:
+        try:
+            yield from executor.map(_timed_compare_files, files_a, files_b, rules, chunksize=chunksize)
+        finally:
+            # Closed early by a DiffBudget: drop the comparisons not started yet
+            executor.shutdown(cancel_futures=True)
+
+
+def diff_dir(actual, expected, suffixes=TEXT_SUFFIXES, prompt_to_update=False, workers=None,
+             incremental=None, report=None, rules=None, budget=None):
+    """Compare all files with the given suffixes in two directories.
+
+    Files are compared in sorted relative-path order, so the output is
+    deterministic even when *workers* > 1 farms the comparisons out to a
+    process pool.
+
+    Parameters
+    ----------
+    actual : str or ResultTreeIndex
+        Path to directory with actual results, or an index of it.
+    expected : str or ResultTreeIndex
+        Path to directory with expected results, or an index of it.
+    suffixes : tuple
+        File extensions to compare.
+    prompt_to_update : bool
+        Whether to prompt user to update differing files.
+    workers : int or None
+        Number of processes used to compare files.  ``None`` or ``1``
+        compares serially.
+    incremental : IncrementalState or None
+        If given, skip pairs that passed on a previous run and have not
+        changed since, then record and save the new verdicts.
+    report : DiffReport or None
+        If given, record every compared, cached, new and missing file.
+    rules : DiffRules or None
+        Comparator, tolerances and severity per file.  The default is
+        :func:`default_diff_rules` (``diff_rules.toml``).
+    budget : DiffBudget or None
+        If given, stop comparing file contents once it is used up and
+        list the files left unchecked (which counts as a difference).
+        New and missing files are reported regardless.
+
+    Returns
+    -------
+    bool
+        True if any file with severity ``fail`` differs, is new, or is
+        missing, or if *budget* left files unchecked.
+    """
+    if rules is None:
+        rules = default_diff_rules()
+    actual = index_result_tree(actual)
+    expected = index_result_tree(expected)
+    files_actual = actual.files(suffixes)
+    files_expected = expected.files(suffixes)
     diff_exists = False
-    for file_basename_actual, file_path_actual in files_actual.items():
-        if IGNORE_FILES_REGEXP.match(basename(file_basename_actual)):
-            continue
-        if file_basename_actual in files_expected:
-            if file_path_actual.suffix in PDF_SUFFIXES:
-                sig_diff, tick_diff = diff_pdf(file_path_actual, files_expected[file_basename_actual])
-                if sig_diff:
-                    diff_results = truncate_diff_lines(sig_diff)
-                elif tick_diff:
-                    diff_results = None  # don't fail
-                    print('\033[93mWARNING\033[0m Axis tick labels differ (platform-dependent): {0}'.format(
-                        file_path_actual,
-                    ))
-                    print_diff(truncate_diff_lines(tick_diff))
-                else:
-                    diff_results = None
-            else:
-                diff_results = diff(file_path_actual, files_expected[file_basename_actual])
+    unchecked = []
+
+    matched = [
+        file_rel for file_rel in sorted(files_actual)
+        if file_rel in files_expected and rules.rule_for(file_rel).severity != 'ignore'
+    ]
+    if incremental is not None:
+        cached = {
+            file_rel for file_rel in matched
+            if incremental.is_cached_pass(files_actual[file_rel], files_expected[file_rel], rules.rule_for(file_rel))
+        }
+        if cached:
+            print('{0} file(s) unchanged since they last passed, not compared again (cached passes)'.format(
+                len(cached),
+            ))
+        matched = [file_rel for file_rel in matched if file_rel not in cached]
+        if report is not None:
+            for file_rel in sorted(cached):
+                report.record(actual.root.name, file_rel, rules.rule_for(file_rel).comparator, 'cached')
+    comparisons = iter_file_comparisons(
+        [(files_actual[file_rel], files_expected[file_rel]) for file_rel in matched],
+        workers=workers,
+        rules=[rules.rule_for(file_rel) for file_rel in matched],
+    )
+    for n, file_rel in enumerate(matched):
+        if budget is not None and budget.stop_reason():
+            unchecked.extend(matched[n:])
+            comparisons.close()
+            break
+        diff_results, tick_diff, seconds = next(comparisons)
+        file_path_actual = files_actual[file_rel]
+        file_path_expected = files_expected[file_rel]
+        rule = rules.rule_for(file_rel)
+        if report is not None:
             if diff_results:
-                print('Comparing {0} to {1}'.format(
-                    file_path_actual, files_expected[file_basename_actual],
-                ))
-                print_diff(diff_results)
-                if not WARNING_FILE_REGEXP.search(str(file_path_actual)):
-                    diff_exists |= True
-                if prompt_to_update:
-                    update_file(file_path_actual, files_expected[file_basename_actual])
-        else:
+                verdict = 'warning' if rule.severity == 'warn' else 'fail'
+            else:
+                verdict = 'warning' if tick_diff else 'pass'
+            report.record(
+                actual.root.name, file_rel, rule.comparator, verdict, seconds,
+                diff_lines=len(diff_results) or len(tick_diff),
+            )
+        if tick_diff:
+            print('\033[93mWARNING\033[0m Axis tick labels differ (platform-dependent): {0}'.format(
+                file_path_actual,
+            ))
+            print_diff(tick_diff)
+        if incremental is not None:
+            incremental.record(file_path_actual, file_path_expected, not (diff_results or tick_diff), rule)
+        if diff_results:
+            print('Comparing {0} to {1}'.format(file_path_actual, file_path_expected))
+            print_diff(diff_results)
+            if rule.severity == 'fail':
+                diff_exists |= True
+                if budget is not None:
+                    budget.record_failure()
+            if prompt_to_update:
+                update_file(file_path_actual, file_path_expected)
+    if incremental is not None:
+        incremental.save()
+
+    for file_basename_actual in sorted(files_actual):
+        rule = rules.rule_for(file_basename_actual)
+        if rule.severity == 'ignore':
+            continue
+        if file_basename_actual not in files_expected:
+            file_path_actual = files_actual[file_basename_actual]
             print('New file in Actual ({0}) not found in Expected ({1})'.format(file_basename_actual, expected))
-            if not WARNING_FILE_REGEXP.search(str(file_path_actual)):
+            if report is not None:
+                report.record(actual.root.name, file_basename_actual, None, 'new' if rule.severity == 'fail' else 'warning')
+            if rule.severity == 'fail':
                 diff_exists |= True
+                if budget is not None:
+                    budget.record_failure()
             if prompt_to_update:
                 update_file(file_path_actual, join(expected, file_basename_actual))
 
-    for file_basename_expected in files_expected.keys():
-        fname = basename(file_basename_expected)
-        if IGNORE_FILES_REGEXP.match(fname) or fname.endswith(IGNORE_SUFFIX):
+    for file_basename_expected in sorted(files_expected):
+        rule = rules.rule_for(file_basename_expected)
+        if rule.severity == 'ignore':
             continue
         if file_basename_expected not in files_actual:
             print('Missing file {0} from Actual ({1})'.format(file_basename_expected, actual))
-            if not WARNING_FILE_REGEXP.search(str(file_basename_expected)):
+            if report is not None:
+                report.record(actual.root.name, file_basename_expected, None, 'missing' if rule.severity == 'fail' else 'warning')
+            if rule.severity == 'fail':
                 diff_exists |= True
+                if budget is not None:
+                    budget.record_failure()
             if prompt_to_update:
                 remove_file(join(expected, file_basename_expected))
 
+    if budget is not None and budget.skip(actual.root.name, unchecked, report):
+        diff_exists = True
     return diff_exists
 
 
+RunningTimeCheck = namedtuple('RunningTimeCheck', ['n_runs', 'median', 'mad', 'deviations'])
+
+
+def crispresso_revision(info, crispresso2_dir=None):
+    """Identify the CRISPResso2 build that produced a result.
+
+    Parameters
+    ----------
+    info : dict
+        The run's info JSON.
+    crispresso2_dir : str or None
+        CRISPResso2 checkout; the default is ``$CRISPRESSO2_DIR``.
+
+    Returns
+    -------
+    str
+        The checkout's short git revision, or the version recorded in
+        *info* when there is no checkout to ask.
+    """
+    crispresso2_dir = crispresso2_dir or os.environ.get('CRISPRESSO2_DIR')
+    if crispresso2_dir:
+        try:
+            return subprocess.run(
+                ['git', '-C', crispresso2_dir, 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    return str(info.get('running_info', {}).get('version', 'unknown'))
+
+
+def sparkline(values):
+    """Draw *values* as a row of block characters scaled to their range."""
+    low, high = min(values), max(values)
+    top = len(SPARKLINE_BLOCKS) - 1
+    return ''.join(
+        SPARKLINE_BLOCKS[round((value - low) / (high - low) * top) if high > low else 0]
+        for value in values
+    )
+
+
+class RunningTimeHistory(object):
+    """Per-test running times from previous runs, kept in SQLite.
+
+    Each run is stored with the test id, the CRISPResso2 revision, the
+    host and its core count.  A new running time is compared with the
+    median and MAD (median absolute deviation) of the last
+    ``PERF_HISTORY_WINDOW`` runs of the same test on the same host and
+    core count, which is far less noisy on shared CI runners than a
+    single committed number.  Runs are keyed by their start time, so
+    comparing the same results twice records them once.
+
+    Parameters
+    ----------
+    path : str or Path
+        The SQLite database.
+    """
+
+    def __init__(self, path=PERF_HISTORY_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS running_times ('
+            ' test_id TEXT NOT NULL, revision TEXT NOT NULL, host TEXT NOT NULL,'
+            ' cores INTEGER NOT NULL, started TEXT NOT NULL, seconds REAL NOT NULL,'
+            ' PRIMARY KEY (test_id, host, started))'
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, test_id, seconds, started, revision, host=None, cores=None):
+        """Store one run; a run already stored (same test, host and start) is kept as is."""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO running_times VALUES (?, ?, ?, ?, ?, ?)',
+                (test_id, revision, host or platform.node(), cores or os.cpu_count(), started, seconds),
+            )
+
+    def runs(self, test_id, host=None, cores=None, before=None, limit=PERF_HISTORY_WINDOW):
+        """Return the last *limit* ``(started, revision, seconds)`` rows, oldest first.
+
+        Only runs of *test_id* on *host* with *cores* cores (default: this
+        machine) that started before *before* (default: any) are included.
+        """
+        rows = self.connection.execute(
+            'SELECT started, revision, seconds FROM running_times'
+            ' WHERE test_id = ? AND host = ? AND cores = ? AND started < ?'
+            ' ORDER BY started DESC LIMIT ?',
+            (test_id, host or platform.node(), cores or os.cpu_count(), before or '\uffff', limit),
+        ).fetchall()
+        return rows[::-1]
+
+    def check(self, test_id, seconds, started, host=None, cores=None):
+        """Compare a running time with the runs before it.
+
+        Returns
+        -------
+        RunningTimeCheck or None
+            The number of runs compared against, their median and MAD,
+            and how many scaled MADs *seconds* is from the median
+            (positive is slower).  None when there are fewer than
+            ``PERF_HISTORY_MIN_RUNS`` earlier runs.
+        """
+        times = [row[2] for row in self.runs(test_id, host, cores, before=started)]
+        if len(times) < PERF_HISTORY_MIN_RUNS:
+            return None
+        median = statistics.median(times)
+        mad = statistics.median(abs(time - median) for time in times)
+        spread = max(MAD_SCALE * mad, PERF_HISTORY_MIN_SPREAD * median)
+        return RunningTimeCheck(len(times), median, mad, (seconds - median) / spread)
+
+    def report(self, limit=PERF_HISTORY_WINDOW):
+        """Summarize every test's recent running times, one trend line per test and machine.
+
+        Returns
+        -------
+        list of str
+        """
+        lines = []
+        groups = self.connection.execute(
+            'SELECT DISTINCT test_id, host, cores FROM running_times ORDER BY test_id, host, cores'
+        ).fetchall()
+        for test_id, host, cores in groups:
+            runs = self.runs(test_id, host, cores, limit=limit)
+            times = [row[2] for row in runs]
+            median = statistics.median(times)
+            mad = statistics.median(abs(time - median) for time in times)
+            spread = max(MAD_SCALE * mad, PERF_HISTORY_MIN_SPREAD * median)
+            lines.append(
+                '{test_id} ({host}, {cores} cores): {spark} {n} run(s), median {median:.1f} s,'
+                ' MAD {mad:.1f} s, last {last:.1f} s ({deviations:+.1f} MAD) at {revision}'.format(
+                    test_id=test_id, host=host, cores=cores, spark=sparkline(times), n=len(times),
+                    median=median, mad=mad, last=times[-1], deviations=(times[-1] - median) / spread,
+                    revision=runs[-1][1],
+                )
+            )
+        return lines
+
+
 def diff_running_times(
     actual,
     expected,
     percent_time_delta,
     info_file,
     keys=('running_info', 'running_time', 'value'),
+    history=None,
 ):
+    """Report whether the actual running time is out of line.
+
+    With a *history*, the actual run is recorded and compared with the
+    median and MAD of earlier runs of the same test on this machine (see
+    :class:`RunningTimeHistory`).  Without one, or until there are
+    ``PERF_HISTORY_MIN_RUNS`` earlier runs, it is compared with the
+    expected result's running time using *percent_time_delta*.
+
+    Parameters
+    ----------
+    actual : str or Path
+        Directory with the actual results; its name is the test id.
+    expected : str or Path
+        Directory with the expected results.
+    percent_time_delta : float
+        Fraction by which the actual and expected times may differ.
+    info_file : str
+        Name of the info JSON in both directories.
+    keys : tuple of str
+        Path to the running time inside the info JSON.
+    history : RunningTimeHistory or None
+        Running-time history to record into and compare against.
+    """
     def get_timedelta(obj):
         current_obj = obj
         for key in keys:
@@ -836,9 +4233,28 @@ def diff_running_times(
         )
 
     path_a, path_b = Path(actual) / info_file, Path(expected) / info_file
+    if history is not None and path_a.exists():
+        info_a = load_json(path_a)
+        seconds = get_timedelta(info_a).total_seconds()
+        started = info_a.get(keys[0], {}).get('start_time', {}).get('value')
+        if started is None:
+            started = str(datetime.fromtimestamp(path_a.stat().st_mtime))
+        test_id = Path(actual).name
+        check = history.check(test_id, seconds, started)
+        history.record(test_id, seconds, started, crispresso_revision(info_a))
+        if check is not None:
+            if abs(check.deviations) > PERF_HISTORY_MAX_DEVIATIONS:
+                print(
+                    'Actual running time {0:.1f} s is {1:.1f} MADs {2} than the median of'
+                    ' the last {3} runs ({4:.1f} s).'.format(
+                        seconds, abs(check.deviations),
+                        'faster' if check.deviations < 0 else 'slower',
+                        check.n_runs, check.median,
+                    ),
+                )
+            return
     if path_a.exists() and path_b.exists():
-        with open(path_a) as fh_a, open(path_b) as fh_b:
-            info_a, info_b = json.load(fh_a), json.load(fh_b)
+        info_a, info_b = load_json(path_a), load_json(path_b)
         timedelta_a, timedelta_b = get_timedelta(info_a), get_timedelta(info_b)
         percent_different = (timedelta_a - timedelta_b) / (
             (timedelta_a + timedelta_b) / 2
@@ -855,7 +4271,7 @@ def diff_running_times(
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('actual', help='Directory of text files to compare (labeled "Actual").')
+    parser.add_argument('actual', nargs='?', help='Directory of text files to compare (labeled "Actual").')
     parser.add_argument('--expected', help='Other directory of text files to compare (labeled "Expected").')
     parser.add_argument(
         '--expected_prefix',
@@ -870,7 +4286,10 @@ if __name__ == '__main__':
         help='The threshold expressed in a decimal with which to warn that the'
         ' running time is different. For example, if 0.1 is provided then a'
         ' warning will be shown only when the running time is +/- 10%% different'
-        ' than what is expected. The default is `0.1`.',
+        ' than what is expected. Only used until the running-time history'
+        ' (--perf-db) has {0} earlier runs of the test. The default is `0.1`.'.format(
+            PERF_HISTORY_MIN_RUNS,
+        ),
     )
     parser.add_argument(
         '--time_info_file',
@@ -879,6 +4298,22 @@ if __name__ == '__main__':
         ' It is assumed that the file is in the root of `actual` and `expected`.'
         'The default is `CRISPResso2_info.json`.',
     )
+    parser.add_argument(
+        '--perf-history',
+        action='store_true',
+        help='Print a trend line of the recent running times of every test'
+        ' recorded in the running-time history and exit.',
+    )
+    parser.add_argument(
+        '--perf-db',
+        default=None,
+        help='Record the running time in this SQLite database (normally `{0}`)'
+        ' and compare it with the median and MAD of the earlier runs of the'
+        ' same test on this machine. Without this option nothing is recorded.'
+        ' --perf-history reads it, by default from `{0}`.'.format(
+            PERF_HISTORY_DB.relative_to(DIFF_CACHE_DIR.parent),
+        ),
+    )
     parser.add_argument(
         '--skip_html',
         default=False,
@@ -895,36 +4330,137 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         '--image_threshold',
-        default=DEFAULT_IMAGE_THRESHOLD,
+        default=None,
+        type=float,
+        help='Threshold (0-1) for PNG image comparison. Images scoring above'
+        ' this on the --image_metric are flagged as significantly different.'
+        ' The default is `{0}` for rmse and `{1}` for ssim.'.format(
+            DEFAULT_IMAGE_THRESHOLD, DEFAULT_SSIM_THRESHOLD,
+        ),
+    )
+    parser.add_argument(
+        '--image_metric',
+        default=DEFAULT_IMAGE_METRIC,
+        choices=IMAGE_METRICS,
+        help='Metric for PNG image comparison: global `rmse`, or `ssim`'
+        ' (windowed structural dissimilarity, 1 - SSIM), which also reports'
+        ' the most changed region. The default is `{0}`.'.format(DEFAULT_IMAGE_METRIC),
+    )
+    parser.add_argument(
+        '--no-cache',
+        default=False,
+        action='store_true',
+        help='Do not read or write the on-disk cache of normalized expected'
+        ' files (`{0}`).'.format(DIFF_CACHE_DIR.name),
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        default=1,
+        type=int,
+        help='Number of processes to use when comparing files (and threads'
+        ' when comparing images with --diff-plots). Output is still printed'
+        ' in sorted path order. The default is `1`.',
+    )
+
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Only compare files that changed since they last passed. Verdicts'
+        ' are kept in `.diffcache/incremental.json`; unchanged files that'
+        ' passed before are reported as cached passes.',
+    )
+
+    parser.add_argument(
+        '--report-json',
+        default=None,
+        help='Write one JSON object per compared file (path, comparator,'
+        ' verdict, timing, diff line count, RMSE for images) to this file'
+        ' as the comparisons finish.',
+    )
+    parser.add_argument(
+        '--report-junit',
+        default=None,
+        help='Write the per-file verdicts as a JUnit XML report to this file.',
+    )
+    parser.add_argument(
+        '--fail-fast',
+        nargs='?',
+        const=1,
+        default=None,
+        type=int,
+        metavar='N',
+        help='Stop comparing after N significant differences (new, missing or'
+        ' differing files that are not warnings) and list the files left'
+        ' unchecked. `--fail-fast` alone stops at the first.',
+    )
+    parser.add_argument(
+        '--diff-budget-seconds',
+        default=None,
         type=float,
-        help='RMSE threshold (0-1) for PNG image comparison. Images with'
-        ' RMSE above this are flagged as significantly different.'
-        ' The default is `{0}`.'.format(DEFAULT_IMAGE_THRESHOLD),
+        help='Stop starting new comparisons after this many seconds and list'
+        ' the files left unchecked, which counts as a difference.',
+    )
+    parser.add_argument(
+        '--rules',
+        default=str(DIFF_RULES_FILE),
+        help='TOML file of per-file comparison rules (glob pattern, comparator,'
+        ' tolerances, fail/warn/ignore severity). The default is'
+        ' `{0}`.'.format(DIFF_RULES_FILE.name),
     )
 
     args = parser.parse_args()
 
+    if args.perf_history:
+        with RunningTimeHistory(args.perf_db or PERF_HISTORY_DB) as history:
+            print('\n'.join(history.report()) or 'No running times recorded yet.')
+        sys.exit(0)
+    if args.actual is None:
+        parser.error('the following arguments are required: actual')
+
+    if args.no_cache:
+        DIFF_CACHE = None
+    incremental = IncrementalState() if args.incremental else None
+    rules = load_diff_rules(args.rules)
+    budget = None
+    if args.fail_fast or args.diff_budget_seconds:
+        budget = DiffBudget(args.fail_fast, args.diff_budget_seconds)
+
     if args.expected is None:
         expected = join(args.expected_prefix, args.actual)
     else:
         expected = args.expected
 
-    diff_running_times(
-        args.actual, expected, args.percent_time_delta, args.time_info_file,
-    )
-    diff_suffixes = ('.txt', '.html', '.sam', '.vcf')
+    if args.perf_db is None:
+        diff_running_times(args.actual, expected, args.percent_time_delta, args.time_info_file)
+    else:
+        with RunningTimeHistory(args.perf_db) as history:
+            diff_running_times(
+                args.actual, expected, args.percent_time_delta, args.time_info_file, history=history,
+            )
+    diff_suffixes = TEXT_SUFFIXES + rules.extra_suffixes
     if args.skip_html:
-        diff_suffixes = ('.txt', '.sam', '.vcf')
+        diff_suffixes = DATA_SUFFIXES + rules.extra_suffixes
     if args.diff_plots:
         diff_suffixes = diff_suffixes + PDF_SUFFIXES
 
-    has_diff = diff_dir(args.actual, expected, suffixes=diff_suffixes)
-
-    if args.diff_plots:
-        has_image_diff = diff_dir_images(
-            args.actual, expected, threshold=args.image_threshold,
+    actual_index = ResultTreeIndex(args.actual)
+    expected_index = ResultTreeIndex(expected)
+    with DiffReport(args.report_json, args.report_junit) as report:
+        has_diff = diff_dir(
+            actual_index, expected_index, suffixes=diff_suffixes, workers=args.jobs, incremental=incremental,
+            report=report, rules=rules, budget=budget,
         )
-        has_diff |= has_image_diff
+
+        if args.diff_plots and budget is not None and budget.stop_reason():
+            print('Image comparison skipped: {0}'.format(budget.stop_reason()))
+            has_diff = True
+        elif args.diff_plots:
+            has_image_diff = diff_dir_images(
+                actual_index, expected_index, threshold=args.image_threshold, workers=args.jobs,
+                metric=args.image_metric, report=report,
+            )
+            has_diff |= has_image_diff
 
     if has_diff:
         sys.exit(1)
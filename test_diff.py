@@ -7,16 +7,16 @@ don't cause false failures.
 Run with:
     pytest test_diff.py -v
 """
+import json
+import os
 import textwrap
+import zipfile
 from pathlib import Path
 
 import pytest
 
 import diff
 from diff import (
-    IGNORE_FILES_REGEXP,
-    IGNORE_SUFFIX,
-    WARNING_FILE_REGEXP,
     diff as diff_text,
     diff_dir,
     diff_dir_images,
@@ -42,6 +42,16 @@ def make_file(base, relpath, content=""):
     return p
 
 
+def make_zip(base, relpath, members):
+    """Create a zip archive under *base* from a ``{name: text}`` dict."""
+    p = Path(base) / relpath
+    p.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(str(p), 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, content in members.items():
+            zf.writestr(name, content)
+    return p
+
+
 def make_png(base, relpath, color='white', size=(10, 10)):
     """Create a small solid-color PNG under *base*."""
     p = Path(base) / relpath
@@ -51,6 +61,14 @@ def make_png(base, relpath, color='white', size=(10, 10)):
     return p
 
 
+@pytest.fixture(autouse=True)
+def isolated_diff_cache(tmp_path, monkeypatch):
+    """Keep the normalized-file cache out of the repository during tests."""
+    cache = diff.NormalizedCache(tmp_path / ".diffcache")
+    monkeypatch.setattr(diff, 'DIFF_CACHE', cache)
+    return cache
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 # substitute_line — normalization regex tests
 # ═══════════════════════════════════════════════════════════════════════════
@@ -143,6 +161,39 @@ class TestSubstituteLine:
         assert "2024-01-11 12:34:56" in result
 
 
+class TestLineNormalizer:
+    """Test the single-pass normalizer behind substitute_line."""
+
+    def test_sam_rules_only_for_sam_files(self):
+        line = "@HD\tVN:1.5\tSO:coordinate"
+        assert substitute_line(line, '.sam') == "@HD\tVN:1.0\tSO:unsorted"
+        assert substitute_line(line, '.txt') == line
+
+    def test_shared_rules_apply_to_every_suffix(self):
+        line = "score=0.98765 at 2025-06-15 10:30:00"
+        for suffix in ('.txt', '.html', '.sam', '.vcf'):
+            assert substitute_line(line, suffix) == "score=0.988 at 2024-01-11 12:34:56"
+
+    def test_matches_chained_substitution_order(self):
+        """Command-used lines are replaced whole, including any floats in them."""
+        line = "x=1.23456 <p><strong>Command used: CRISPResso -q 30.5</strong></p>"
+        assert substitute_line(line) == "x=1.235 <p>Command used: <command></p>"
+
+    def test_custom_rules_dispatch(self):
+        import re
+        rules = (
+            diff.NormalizationRule(re.compile(r'(a)+'), 'A', 'a', None),
+            diff.NormalizationRule(re.compile(r'b+'), lambda m: str(len(m.group(0))), 'b', ('.txt',)),
+        )
+        normalizer = diff.LineNormalizer(rules)
+        assert normalizer("xaaybbbz") == "xAy3z"
+        assert diff.LineNormalizer(rules, '.sam')("xaaybbbz") == "xAybbbz"
+
+    def test_line_without_triggers_returned_unchanged(self):
+        line = "ATCGATCG\tTrue\t42"
+        assert diff.get_line_normalizer('.txt')(line) is line
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 # diff (text file comparison)
 # ═══════════════════════════════════════════════════════════════════════════
@@ -184,6 +235,837 @@ class TestDiff:
         assert len(result) > 0
 
 
+class TestStreamDiff:
+    """Test the lockstep, memory-bounded text comparison."""
+
+    def test_equal_inputs(self):
+        lines = ["a\n", "b\n", "c\n"]
+        assert diff.stream_diff(iter(lines), iter(list(lines))) == []
+
+    def test_hunk_numbered_against_whole_file(self):
+        lines_a = ["line {0}\n".format(i) for i in range(100)]
+        lines_b = list(lines_a)
+        lines_b[50] = "changed\n"
+        result = diff.stream_diff(lines_a, lines_b)
+        assert "@@ -48,7 +48,7 @@\n" in result
+        assert "-line 50\n" in result
+        assert "+changed\n" in result
+
+    def test_matches_unified_diff_for_single_region(self):
+        from difflib import unified_diff
+        lines_a = ["line {0}\n".format(i) for i in range(30)]
+        lines_b = lines_a[:10] + ["new\n"] + lines_a[12:]
+        assert diff.stream_diff(lines_a, lines_b) == list(unified_diff(lines_a, lines_b))
+
+    def test_stops_at_first_divergence(self):
+        consumed = []
+
+        def lines(tag):
+            for i in range(100000):
+                consumed.append(tag)
+                yield "{0} {1}\n".format(tag if i == 10 else 'same', i)
+
+        result = diff.stream_diff(lines('a'), lines('b'), window=5)
+        assert len(consumed) < 50
+        assert "stopped after the first differing region at line 11" in result[-1]
+
+    def test_insertion_in_large_file_has_no_window_edge(self, tmp_path):
+        """The windows after an inserted line are one line apart; their ends must not show up as -/+."""
+        lines = ["read {0} ACGTACGTACGT\n".format(i) for i in range(60000)]
+        a = make_file(tmp_path, "a.txt", "".join(lines[:30000] + ["inserted\n"] + lines[30000:]))
+        b = make_file(tmp_path, "b.txt", "".join(lines))
+        assert os.path.getsize(a) >= diff.STREAM_DIFF_MIN_BYTES
+        result = diff_text(a, b)
+        changes = [line for line in result if line[:1] in "-+" and not line.startswith(("---", "+++"))]
+        assert changes == ["-inserted\n"]
+        assert "stopped after the first differing region at line 30001" in result[-1]
+
+    def test_window_full_of_changes_is_kept(self):
+        result = diff.stream_diff(["a\n"] * 20, ["b\n"] * 20, window=5)
+        assert result.count("-a\n") == 6 and result.count("+b\n") == 6
+
+    def test_extra_trailing_line(self):
+        result = diff.stream_diff(["a\n", "b\n"], ["a\n", "b\n", "c\n"])
+        assert "+c\n" in result
+
+    def test_diff_uses_streaming_for_large_files(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(diff, 'STREAM_DIFF_MIN_BYTES', 10)
+        a = make_file(tmp_path, "a.txt", "".join("row {0} 0.12345\n".format(i) for i in range(50)))
+        b = make_file(tmp_path, "b.txt", "".join("row {0} 0.12346\n".format(i) for i in range(50)))
+        assert diff_text(a, b) == []
+
+        c = make_file(tmp_path, "c.txt", "".join("row {0}\n".format(i if i != 20 else 'x') for i in range(50)))
+        d = make_file(tmp_path, "d.txt", "".join("row {0}\n".format(i) for i in range(50)))
+        result = diff_text(c, d)
+        assert "-row x\n" in result
+        assert "+row 20\n" in result
+
+    def test_streaming_reads_cached_expected_side(self, tmp_path, isolated_diff_cache):
+        a = make_file(tmp_path, "a.txt", "hello\n")
+        b = make_file(tmp_path, "b.txt", "world\n")
+        isolated_diff_cache.put_lines('text.txt', diff.file_digest(b), ["hello\n"])
+        assert diff_text(a, b, stream=True) == []
+
+
+class TestDigestFastPath:
+    """Test the byte-identical fast path that skips normalization."""
+
+    def test_identical_files_skip_normalization(self, tmp_path, monkeypatch):
+        make_file(tmp_path, "a.txt", "value=3.14159\n")
+        make_file(tmp_path, "b.txt", "value=3.14159\n")
+
+        def fail(suffix=None):
+            raise AssertionError("normalization should not run for identical files")
+
+        monkeypatch.setattr(diff, 'get_line_normalizer', fail)
+        assert diff_text(tmp_path / "a.txt", tmp_path / "b.txt") == []
+
+    def test_fast_path_disabled_still_normalizes(self, tmp_path):
+        make_file(tmp_path, "a.txt", "value=3.14159\n")
+        make_file(tmp_path, "b.txt", "value=3.14159\n")
+        assert diff_text(tmp_path / "a.txt", tmp_path / "b.txt", check_digest=False) == []
+
+    def test_files_identical(self, tmp_path):
+        a = make_file(tmp_path, "a.txt", "same\n")
+        b = make_file(tmp_path, "b.txt", "same\n")
+        c = make_file(tmp_path, "c.txt", "diff\n")
+        d = make_file(tmp_path, "d.txt", "longer\n")
+        assert diff.files_identical(a, b)
+        assert not diff.files_identical(a, c)
+        assert not diff.files_identical(a, d)
+
+    def test_file_digest_chunked(self, tmp_path, monkeypatch):
+        """Digest must not depend on the chunk size used to read the file."""
+        p = make_file(tmp_path, "a.txt", "x" * 1000)
+        full = diff.file_digest(p)
+        monkeypatch.setattr(diff, 'DIGEST_CHUNK_SIZE', 7)
+        assert diff.file_digest(p) == full
+
+
+class TestNormalizedCache:
+    """Test the on-disk cache of normalized expected files."""
+
+    def test_expected_side_cached_after_first_diff(self, tmp_path, isolated_diff_cache):
+        a = make_file(tmp_path, "a.txt", "value=3.14159\n")
+        b = make_file(tmp_path, "b.txt", "value=3.14160\n")
+        assert diff_text(a, b) == []
+
+        digest = diff.file_digest(b)
+        assert isolated_diff_cache.get_lines('text.txt', digest) == ["value=3.142\n"]
+
+    def test_cache_hit_skips_normalizing_expected(self, tmp_path, isolated_diff_cache):
+        a = make_file(tmp_path, "a.txt", "hello\n")
+        b = make_file(tmp_path, "b.txt", "world\n")
+        # Seed the cache with a normalized expected side that matches actual
+        isolated_diff_cache.put_lines('text.txt', diff.file_digest(b), ["hello\n"])
+        assert diff_text(a, b) == []
+
+    def test_disabled_cache(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(diff, 'DIFF_CACHE', None)
+        a = make_file(tmp_path, "a.txt", "hello\n")
+        b = make_file(tmp_path, "b.txt", "world\n")
+        assert len(diff_text(a, b)) > 0
+
+    def test_pdf_text_cached(self, tmp_path, isolated_diff_cache, monkeypatch):
+        pdf = make_file(tmp_path, "plot.pdf", "not really a pdf")
+        calls = []
+
+        def fake_extract(path):
+            calls.append(path)
+            return ["Title"]
+
+        monkeypatch.setattr(diff, 'extract_pdf_text', fake_extract)
+        assert diff.load_pdf_text(pdf) == ["Title"]
+        assert diff.load_pdf_text(pdf) == ["Title"]
+        assert len(calls) == 1
+
+    def test_lru_eviction(self, tmp_path):
+        cache = diff.NormalizedCache(tmp_path / "cache", max_bytes=25)
+        cache.put_lines('text.txt', 'old', ["0123456789\n"])
+        cache.put_lines('text.txt', 'mid', ["0123456789\n"])
+        # Touch "old" so "mid" becomes the least recently used entry
+        entry_mid = cache.directory / 'text.txt-mid.txt'
+        os.utime(entry_mid, (1, 1))
+        assert cache.get_lines('text.txt', 'old') is not None
+        cache.put_lines('text.txt', 'new', ["0123456789\n"])
+
+        assert cache.get_lines('text.txt', 'mid') is None
+        assert cache.get_lines('text.txt', 'old') is not None
+        assert cache.get_lines('text.txt', 'new') is not None
+
+    def test_concurrent_writes_keep_size_consistent(self, tmp_path):
+        from concurrent.futures import ThreadPoolExecutor
+        cache = diff.NormalizedCache(tmp_path / "cache", max_bytes=2000)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda n: cache.put_json('image.png', str(n), "x" * 40), range(400)))
+        on_disk = sum(f.stat().st_size for f in cache.directory.glob('*'))
+        assert cache._size == on_disk <= 2000
+
+    def test_pickled_for_worker_processes(self, tmp_path):
+        import pickle
+        cache = pickle.loads(pickle.dumps(diff.NormalizedCache(tmp_path / "cache")))
+        cache.put_lines('text.txt', 'abc', ["x\n"])
+        assert cache.get_lines('text.txt', 'abc') == ["x\n"]
+
+    def test_version_change_prunes_old_entries(self, tmp_path):
+        old = diff.NormalizedCache(tmp_path / "cache", version='old')
+        old.put_lines('text.txt', 'abc', ["x\n"])
+        new = diff.NormalizedCache(tmp_path / "cache", version='new')
+        assert new.get_lines('text.txt', 'abc') is None
+        new.put_lines('text.txt', 'def', ["y\n"])
+        assert not (tmp_path / "cache" / "old").exists()
+
+    def test_cache_version_tracks_rules(self, monkeypatch):
+        import re
+        before = diff.cache_version()
+        rules = diff.NORMALIZATION_RULES + (
+            diff.NormalizationRule(re.compile('x'), 'y', 'x', None),
+        )
+        monkeypatch.setattr(diff, 'NORMALIZATION_RULES', rules)
+        assert diff.cache_version() != before
+
+    @pytest.mark.parametrize("name, value", [
+        ("DEFAULT_JSON_RTOL", 1e-3),
+        ("DEFAULT_TABLE_ATOL", 1e-2),
+        ("JSON_IGNORE_PATHS", ("running_info.version",)),
+        ("ALLELE_TABLE_COUNT_COLUMNS", ("#Reads",)),
+    ])
+    def test_cache_version_tracks_comparator_settings(self, monkeypatch, name, value):
+        before = diff.cache_version()
+        monkeypatch.setattr(diff, name, value)
+        assert diff.cache_version() != before
+
+    def test_settings_change_discards_incremental_state(self, tmp_path, monkeypatch):
+        make_file(tmp_path, "a/same.txt", "same\n")
+        make_file(tmp_path, "b/same.txt", "same\n")
+        pair = (tmp_path / "a" / "same.txt", tmp_path / "b" / "same.txt")
+        state = diff.IncrementalState(tmp_path / "state.json")
+        state.record(*pair, True)
+        state.save()
+        assert diff.IncrementalState(tmp_path / "state.json").is_cached_pass(*pair)
+        monkeypatch.setattr(diff, "DEFAULT_TABLE_RTOL", 0.0)
+        assert not diff.IncrementalState(tmp_path / "state.json").is_cached_pass(*pair)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_table — tolerance-aware numeric TSV comparison
+# ═══════════════════════════════════════════════════════════════════════════
+
+@pytest.mark.skipif(not diff.NUMPY_AVAILABLE, reason="NumPy not installed")
+class TestDiffTable:
+    """Test cell-wise numeric comparison of TSV outputs."""
+
+    TABLE = "\tA\tC\nA\t0.5\t0.25\nC\t0.5\t0.75\n"
+
+    def test_identical_tables(self, tmp_path):
+        a = make_file(tmp_path, "a/Nucleotide_percentage_table.txt", self.TABLE)
+        b = make_file(tmp_path, "b/Nucleotide_percentage_table.txt", self.TABLE)
+        assert diff.diff_table(a, b) == []
+
+    def test_rounding_boundary_within_tolerance(self, tmp_path):
+        """0.0004 and 0.0006 round to different values but are within atol."""
+        a = make_file(tmp_path, "a.txt", "x\ty\nr\t0.0004\n")
+        b = make_file(tmp_path, "b.txt", "x\ty\nr\t0.0006\n")
+        assert diff.diff_table(a, b) == []
+        assert diff_text(a, b) != []
+
+    def test_numeric_difference_reported_by_cell(self, tmp_path):
+        a = make_file(tmp_path, "a.txt", self.TABLE)
+        b = make_file(tmp_path, "b.txt", self.TABLE.replace("0.75", "0.8"))
+        result = diff.diff_table(a, b)
+        assert "@@ row 3 (C), column 3 (C) @@\n" in result
+        assert "-0.75\n" in result
+        assert "+0.8\n" in result
+        assert "1 of 9 cells differ" in result[-1]
+
+    def test_custom_tolerance(self, tmp_path):
+        a = make_file(tmp_path, "a.txt", self.TABLE)
+        b = make_file(tmp_path, "b.txt", self.TABLE.replace("0.75", "0.8"))
+        assert diff.diff_table(a, b, atol=0.1) == []
+
+    def test_integer_counts_compared_exactly(self, tmp_path):
+        """rtol would let a count of a million drift by 10 reads."""
+        a = make_file(tmp_path, "a.txt", "x\tn\tf\nr\t1000000\t1000000.0\n")
+        b = make_file(tmp_path, "b.txt", "x\tn\tf\nr\t1000005\t1000005.0\n")
+        result = diff.diff_table(a, b)
+        assert "@@ row 2 (r), column 2 (n) @@\n" in result
+        assert "1 of 6 cells differ" in result[-1]
+
+    def test_label_difference_detected(self, tmp_path):
+        a = make_file(tmp_path, "a.txt", self.TABLE)
+        b = make_file(tmp_path, "b.txt", self.TABLE.replace("\tA\tC", "\tA\tG"))
+        assert len(diff.diff_table(a, b)) > 0
+
+    def test_numeric_vs_text_cell_detected(self, tmp_path):
+        a = make_file(tmp_path, "a.txt", "x\ty\nr\t1.0\n")
+        b = make_file(tmp_path, "b.txt", "x\ty\nr\tNA\n")
+        assert len(diff.diff_table(a, b)) > 0
+
+    def test_shape_mismatch_falls_back_to_text_diff(self, tmp_path):
+        a = make_file(tmp_path, "a.txt", self.TABLE)
+        b = make_file(tmp_path, "b.txt", self.TABLE + "G\t0.0\t0.0\n")
+        result = diff.diff_table(a, b)
+        assert "+G\t0.0\t0.0\n" in result
+
+    def test_diff_dir_dispatches_numeric_tables(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        make_file(actual, "Effect_vector_combined.txt", "1\t0.0004\n")
+        make_file(expected, "Effect_vector_combined.txt", "1\t0.0006\n")
+        make_file(actual, "Alleles_homology_scores.txt", "1\t0.0004\n")
+        make_file(expected, "Alleles_homology_scores.txt", "1\t0.0004\n")
+
+        assert diff_dir(str(actual), str(expected)) is False
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_allele_table — allele tables joined on their alleles
+# ═══════════════════════════════════════════════════════════════════════════
+
+ALLELE_HEADER = "Aligned_Sequence\tReference_Sequence\tUnedited\tn_deleted\tn_inserted\tn_mutated\t#Reads\t%Reads\n"
+ALLELE_ROWS = [
+    "ACGTACGT\tACGTACGT\tTrue\t0\t0\t0\t50\t50.0\n",
+    "ACG-ACGT\tACGTACGT\tFalse\t1\t0\t0\t25\t25.0\n",
+    "ACGAACGT\tACGTACGT\tFalse\t0\t0\t1\t25\t25.0\n",
+]
+
+
+class TestDiffAlleleTable:
+    """Test the keyed, order-insensitive allele table comparator."""
+
+    NAME = "Alleles_frequency_table_around_sgRNA_ACGT.txt"
+
+    def make_table(self, base, rows, name=None):
+        return make_file(base, name or self.NAME, ALLELE_HEADER + "".join(rows))
+
+    def test_tied_rows_swapped(self, tmp_path):
+        a = self.make_table(tmp_path / "a", ALLELE_ROWS)
+        b = self.make_table(tmp_path / "b", [ALLELE_ROWS[0], ALLELE_ROWS[2], ALLELE_ROWS[1]])
+        assert diff.diff_allele_table(a, b) == []
+        assert diff_text(a, b) != []
+
+    def test_count_difference_reported_by_allele(self, tmp_path):
+        a = self.make_table(tmp_path / "a", ALLELE_ROWS)
+        b = self.make_table(tmp_path / "b", [ALLELE_ROWS[0].replace("\t50\t50.0", "\t51\t50.5")] + ALLELE_ROWS[1:])
+        result = diff.diff_allele_table(a, b)
+        assert result[:2] == ["--- {0}\n".format(a), "+++ {0}\n".format(b)]
+        assert result[2:7] == [
+            "@@ row 1 (ACGTACGT) @@\n", "-#Reads: 50\n", "+#Reads: 51\n", "-%Reads: 50.0\n", "+%Reads: 50.5\n",
+        ]
+        assert result[-1] == "1 of 3 alleles differ (atol=0.001, rtol=1e-05)\n"
+
+    def test_percentages_within_tolerance(self, tmp_path):
+        a = self.make_table(tmp_path / "a", ALLELE_ROWS)
+        b = self.make_table(tmp_path / "b", [row.replace("25.0\n", "25.00000001\n") for row in ALLELE_ROWS])
+        assert diff.diff_allele_table(a, b) == []
+
+    def test_read_counts_compared_exactly(self, tmp_path):
+        rows = [row.replace("\t50\t50.0", "\t400000\t50.0") for row in ALLELE_ROWS]
+        a = self.make_table(tmp_path / "a", rows)
+        b = self.make_table(tmp_path / "b", [rows[0].replace("\t400000\t", "\t400003\t")] + rows[1:])
+        assert diff.diff_allele_table(a, b)[2:5] == ["@@ row 1 (ACGTACGT) @@\n", "-#Reads: 400000\n", "+#Reads: 400003\n"]
+
+    def test_added_and_missing_alleles(self, tmp_path):
+        a = self.make_table(tmp_path / "a", ALLELE_ROWS[:2])
+        b = self.make_table(tmp_path / "b", ALLELE_ROWS[1:])
+        body = "".join(diff.diff_allele_table(a, b))
+        assert "@@ row 1 (ACGTACGT) @@\n-" + ALLELE_ROWS[0] in body
+        assert "@@ expected row 2 (ACGAACGT) @@\n+" + ALLELE_ROWS[2] in body
+        assert body.endswith("2 of 3 alleles differ (atol=0.001, rtol=1e-05)\n")
+
+    def test_same_sequences_different_indels_are_distinct_alleles(self, tmp_path):
+        """Rows sharing Aligned/Reference_Sequence are told apart by the other columns."""
+        rows = [ALLELE_ROWS[1], ALLELE_ROWS[1].replace("\t1\t0\t0\t", "\t2\t0\t0\t")]
+        a = self.make_table(tmp_path / "a", rows)
+        b = self.make_table(tmp_path / "b", rows[::-1])
+        assert diff.diff_allele_table(a, b) == []
+
+    def test_unkeyed_table_falls_back_to_text_diff(self, tmp_path):
+        a = make_file(tmp_path / "a", self.NAME, "Reference_Sequence\t#Reads\nACGT\t1\nAGGT\t2\n")
+        b = make_file(tmp_path / "b", self.NAME, "Reference_Sequence\t#Reads\nAGGT\t2\nACGT\t1\n")
+        assert diff.diff_allele_table(a, b) == diff_text(a, b) != []
+
+    def test_zip_members_joined(self, tmp_path):
+        members_a = {"Alleles_frequency_table.txt": ALLELE_HEADER + "".join(ALLELE_ROWS)}
+        members_b = {"Alleles_frequency_table.txt": ALLELE_HEADER + "".join(ALLELE_ROWS[::-1])}
+        a = make_zip(tmp_path / "a", "Alleles_frequency_table.zip", members_a)
+        b = make_zip(tmp_path / "b", "Alleles_frequency_table.zip", members_b)
+        assert diff.diff_zip(a, b) == []
+
+    def test_diff_dir_dispatches_allele_tables(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        self.make_table(actual, ALLELE_ROWS)
+        self.make_table(expected, ALLELE_ROWS[::-1])
+        assert diff.comparator_for(actual / self.NAME) == "alleles"
+        assert diff_dir(str(actual), str(expected)) is False
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_zip — in-archive comparison
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TestDiffZip:
+    """Test member-wise comparison of zip archives."""
+
+    def test_same_members_different_archive_bytes(self, tmp_path):
+        members = {"Alleles_frequency_table.txt": "seq\t#Reads\nACGT\t10\n"}
+        a = make_zip(tmp_path / "a", "Alleles_frequency_table.zip", members)
+        b = make_zip(tmp_path / "b", "Alleles_frequency_table.zip", members)
+        # Timestamps in the local headers may differ; CRCs will not.
+        assert diff.diff_zip(a, b) == []
+
+    def test_member_content_difference(self, tmp_path):
+        a = make_zip(tmp_path / "a", "t.zip", {"t.txt": "ACGT\t10\n"})
+        b = make_zip(tmp_path / "b", "t.zip", {"t.txt": "ACGT\t11\n"})
+        result = diff.diff_zip(a, b)
+        assert result[0] == "--- {0}/t.txt\n".format(a)
+        assert "-ACGT\t10\n" in result
+        assert "+ACGT\t11\n" in result
+
+    def test_member_normalized_before_diff(self, tmp_path):
+        a = make_zip(tmp_path / "a", "t.zip", {"t.txt": "ACGT\t72.340425531\n"})
+        b = make_zip(tmp_path / "b", "t.zip", {"t.txt": "ACGT\t72.340425599\n"})
+        assert diff.diff_zip(a, b) == []
+
+    def test_added_and_missing_members(self, tmp_path):
+        a = make_zip(tmp_path / "a", "t.zip", {"one.txt": "x\n", "new.txt": "y\n"})
+        b = make_zip(tmp_path / "b", "t.zip", {"one.txt": "x\n", "gone.txt": "z\n"})
+        result = "".join(diff.diff_zip(a, b))
+        assert "New member" in result and "new.txt" in result
+        assert "Missing member" in result and "gone.txt" in result
+
+    def test_diff_dir_compares_zip_by_default(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        make_zip(actual, "Alleles_frequency_table.zip", {"Alleles_frequency_table.txt": "A\t1\n"})
+        make_zip(expected, "Alleles_frequency_table.zip", {"Alleles_frequency_table.txt": "A\t2\n"})
+
+        assert diff_dir(str(actual), str(expected)) is True
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_npz — NumPy archive comparison
+# ═══════════════════════════════════════════════════════════════════════════
+
+@pytest.mark.skipif(not diff.NUMPY_AVAILABLE, reason="numpy not installed")
+class TestDiffNpz:
+    """Test array-wise comparison of .npz archives."""
+
+    @staticmethod
+    def make_npz(path, compressed=False, **arrays):
+        import numpy as np
+        path.parent.mkdir(parents=True, exist_ok=True)
+        (np.savez_compressed if compressed else np.savez)(str(path), **arrays)
+        return path
+
+    def test_stored_member_is_memory_mapped(self, tmp_path):
+        import numpy as np
+        p = self.make_npz(tmp_path / "a.npz", arr_0=np.arange(6.0).reshape(2, 3))
+        with zipfile.ZipFile(str(p)) as zf:
+            arr = diff.load_npz_array(p, zf, zf.getinfo("arr_0.npy"))
+        assert isinstance(arr, np.memmap)
+        assert arr.tolist() == [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]]
+
+    def test_compressed_member_is_read(self, tmp_path):
+        import numpy as np
+        p = self.make_npz(tmp_path / "a.npz", compressed=True, arr_0=np.arange(4))
+        with zipfile.ZipFile(str(p)) as zf:
+            arr = diff.load_npz_array(p, zf, zf.getinfo("arr_0.npy"))
+        assert not isinstance(arr, np.memmap)
+        assert arr.tolist() == [0, 1, 2, 3]
+
+    def test_within_tolerance(self, tmp_path):
+        import numpy as np
+        a = self.make_npz(tmp_path / "a" / "x.npz", arr_0=np.array([1.0, 2.0]))
+        b = self.make_npz(tmp_path / "b" / "x.npz", arr_0=np.array([1.0, 2.0 + 1e-12]))
+        assert diff.diff_npz(a, b) == []
+
+    def test_value_difference_summary(self, tmp_path):
+        import numpy as np
+        a = self.make_npz(tmp_path / "a" / "x.npz", arr_0=np.array([1.0, 2.0, 3.0, 4.0]))
+        b = self.make_npz(tmp_path / "b" / "x.npz", arr_0=np.array([1.0, 2.5, 3.0, 6.0]))
+        result = diff.diff_npz(a, b)
+        assert result[0] == "--- {0}/arr_0.npy\n".format(a)
+        assert "2 of 4 elements differ, first at index (1,)" in result[2]
+        assert "max abs error 2" in result[2]
+
+    def test_shape_and_dtype_mismatch(self, tmp_path):
+        import numpy as np
+        a = self.make_npz(tmp_path / "a" / "x.npz", s=np.zeros(3), d=np.zeros(2))
+        b = self.make_npz(tmp_path / "b" / "x.npz", s=np.zeros(4), d=np.zeros(2, dtype=np.int64))
+        result = "".join(diff.diff_npz(a, b))
+        assert "shape (3,) != (4,)" in result
+        assert "dtype float64 != int64" in result
+
+    def test_diff_dir_compares_npz_by_default(self, tmp_path):
+        import numpy as np
+        self.make_npz(tmp_path / "actual" / "x.npz", arr_0=np.array([1.0]))
+        self.make_npz(tmp_path / "expected" / "x.npz", arr_0=np.array([2.0]))
+        assert diff_dir(str(tmp_path / "actual"), str(tmp_path / "expected")) is True
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_json — structural JSON comparison
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TestDiffJson:
+    """Test structural comparison of JSON documents."""
+
+    @staticmethod
+    def make_json(base, obj):
+        return make_file(base, "CRISPResso2_info.json", json.dumps(obj))
+
+    def test_volatile_paths_ignored(self, tmp_path):
+        a = self.make_json(tmp_path / "a", {"running_info": {
+            "version": "2.3.3",
+            "command_used": "/home/a/bin/CRISPResso -r1 x.fastq",
+            "running_time": {"value": {"days": 0, "seconds": 72}},
+            "name": "params",
+        }})
+        b = self.make_json(tmp_path / "b", {"running_info": {
+            "version": "2.2.7",
+            "command_used": "/Users/b/bin/CRISPResso -r1 x.fastq",
+            "running_time": {"value": {"days": 0, "seconds": 9}},
+            "name": "params",
+        }})
+        assert diff.diff_json(a, b) == []
+
+    def test_absolute_paths_and_float_tolerance(self, tmp_path):
+        a = self.make_json(tmp_path / "a", {
+            "file": "/home/ci/CRISPResso2_tests/cli_integration_tests/CRISPResso_on_params/a.txt",
+            "pct": 93.75000001,
+        })
+        b = self.make_json(tmp_path / "b", {
+            "file": "/Users/dev/src/CRISPResso2_tests/cli_integration_tests/CRISPResso_on_params/a.txt",
+            "pct": 93.75,
+        })
+        assert diff.diff_json(a, b) == []
+
+    def test_differences_reported_by_path(self, tmp_path):
+        a = self.make_json(tmp_path / "a", {"results": {"refs": [1, 2], "new": True}})
+        b = self.make_json(tmp_path / "b", {"results": {"refs": [1, 3, 4], "gone": "x"}})
+        result = diff.diff_json(a, b)
+        assert result[:2] == ["--- {0}\n".format(a), "+++ {0}\n".format(b)]
+        body = "".join(result[2:])
+        assert "@@ results.gone @@\n+\"x\"\n" in body
+        assert "@@ results.new @@\n-true\n" in body
+        assert "@@ results.refs.1 @@\n-2\n+3\n" in body
+        assert "@@ results.refs.2 @@\n+4\n" in body
+
+    def test_bool_is_not_a_number(self, tmp_path):
+        a = self.make_json(tmp_path / "a", {"flag": True})
+        b = self.make_json(tmp_path / "b", {"flag": 1})
+        assert diff.diff_json(a, b) != []
+
+    def test_invalid_json_falls_back_to_text_diff(self, tmp_path):
+        a = make_file(tmp_path / "a", "CRISPResso_status.json", "100.00% Analysis Complete!\n")
+        b = make_file(tmp_path / "b", "CRISPResso_status.json", "50.00% Aligning reads\n")
+        result = diff.diff_json(a, b)
+        assert result == diff_text(a, b)
+        assert "+50.0% Aligning reads\n" in result
+
+    def test_parsed_once(self, tmp_path, monkeypatch):
+        p = self.make_json(tmp_path, {"x": 1})
+        calls = []
+        real_load = json.load
+        monkeypatch.setattr(json, "load", lambda fh: calls.append(fh) or real_load(fh))
+        diff._load_json.cache_clear()
+        assert diff.load_json(p) is diff.load_json(p)
+        assert len(calls) == 1
+
+    def test_long_number_list_vectorized(self, tmp_path):
+        values = [i / 7 for i in range(40)]
+        changed = list(values)
+        changed[17] += 1
+        changed[3] += 1e-6
+        a = self.make_json(tmp_path / "a", {"y": values})
+        b = self.make_json(tmp_path / "b", {"y": changed})
+        body = "".join(diff.diff_json(a, b))
+        assert "@@ y.17 @@\n" in body
+        assert "y.3 " not in body
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_html — Plotly figures compared as data
+# ═══════════════════════════════════════════════════════════════════════════
+
+PLOTLY_REPORT = (
+    "<html><body>\n"
+    "<h1>Report</h1>\n"
+    "<div id=\"fig\"></div>\n"
+    "<script>Plotly.newPlot(\"fig\", [{{\"x\": [1, 2, 3], \"y\": [{0}, 20.5, 30]}}], "
+    "{{\"title\": {{\"text\": \"{1}\"}}}}, {{\"responsive\": true}})</script>\n"
+    "</body></html>\n"
+)
+
+
+class TestDiffHtml:
+    """Test comparison of HTML reports with embedded Plotly figures."""
+
+    def test_figures_extracted(self):
+        markup, figures = diff.extract_plotly_figures(PLOTLY_REPORT.format(10, "Reads"))
+        assert diff.PLOTLY_PLACEHOLDER.format(0) in markup
+        assert "Plotly.newPlot(\"fig\"" not in markup
+        assert figures == [("fig", {
+            "data": [{"x": [1, 2, 3], "y": [10, 20.5, 30]}],
+            "layout": {"title": {"text": "Reads"}},
+            "config": {"responsive": True},
+        })]
+
+    def test_changed_number_reported_by_path(self, tmp_path):
+        a = make_file(tmp_path / "a", "report.html", PLOTLY_REPORT.format(10, "Reads"))
+        b = make_file(tmp_path / "b", "report.html", PLOTLY_REPORT.format(11, "Reads"))
+        result = diff.diff_html(a, b)
+        assert result == [
+            "--- {0}\n".format(a), "+++ {0}\n".format(b),
+            "@@ figure 0 (fig): data.0.y.0 @@\n", "-10\n", "+11\n",
+        ]
+
+    def test_numbers_within_tolerance(self, tmp_path):
+        a = make_file(tmp_path / "a", "report.html", PLOTLY_REPORT.format(10.0000001, "Reads"))
+        b = make_file(tmp_path / "b", "report.html", PLOTLY_REPORT.format(10, "Reads"))
+        assert diff.diff_html(a, b) == []
+
+    def test_markup_and_figures_diffed_separately(self, tmp_path):
+        a = make_file(tmp_path / "a", "report.html", PLOTLY_REPORT.format(10, "Reads").replace("Report", "Old"))
+        b = make_file(tmp_path / "b", "report.html", PLOTLY_REPORT.format(10, "Aligned"))
+        body = "".join(diff.diff_html(a, b))
+        assert "-<h1>Old</h1>\n+<h1>Report</h1>\n" in body
+        assert "@@ figure 0 (fig): layout.title.text @@\n-\"Reads\"\n+\"Aligned\"\n" in body
+
+    def test_javascript_arguments_left_in_markup(self, tmp_path):
+        text = "<script>Plotly.newPlot('plot', data, layout)</script>\n"
+        assert diff.extract_plotly_figures(text) == (text, [])
+        a = make_file(tmp_path / "a", "fastp.html", text)
+        b = make_file(tmp_path / "b", "fastp.html", text.replace("layout", "layout2"))
+        result = diff.diff_html(a, b)
+        assert result == diff.diff(a, b, check_digest=False)
+        assert result != []
+
+    def test_dispatched_by_compare_files(self, tmp_path):
+        a = make_file(tmp_path / "a", "report.html", PLOTLY_REPORT.format(10, "Reads"))
+        b = make_file(tmp_path / "b", "report.html", PLOTLY_REPORT.format(12, "Reads"))
+        assert diff.comparator_for(a) == "html"
+        diff_lines, _ = diff.compare_files(a, b)
+        assert "@@ figure 0 (fig): data.0.y.0 @@\n" in diff_lines
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_alignments — SAM/BAM record comparison
+# ═══════════════════════════════════════════════════════════════════════════
+
+SAM_HEADER = (
+    "@HD\tVN:1.0\tSO:unknown\n"
+    "@SQ\tSN:Reference\tLN:86\n"
+)
+SAM_RECORD = "r1\t0\tReference\t1\t100\t8M\t*\t0\t0\tACGTACGT\tAAAAAAAA\tc2:Z:ALN_SCORES={0}\n"
+EXPECTED_BAM = Path(__file__).parent / "cli_integration_tests" / "expected_results" / "CRISPResso_on_bam-out" / "CRISPResso_output.bam"
+
+
+class TestDiffAlignments:
+    """Test the streaming SAM/BAM comparator."""
+
+    def test_sam_header_normalized(self, tmp_path):
+        a = make_file(tmp_path / "a", "x.sam", "@HD\tVN:1.6\tSO:coordinate\n" + SAM_RECORD.format("100.0"))
+        b = make_file(tmp_path / "b", "x.sam", SAM_HEADER.split("\n")[0] + "\n" + SAM_RECORD.format("100.0"))
+        assert diff.diff_alignments(a, b) == []
+
+    def test_samtools_pg_version_and_command_normalized(self, tmp_path):
+        pg = "@PG\tID:samtools\tPN:samtools\tPP:crispresso2\tVN:{0}\tCL:samtools sort -o {1}/CRISPResso_output.bam\n"
+        a = make_file(tmp_path / "a", "x.sam", SAM_HEADER + pg.format("1.20", "CRISPResso_on_bam-out-2") + SAM_RECORD.format("1.0"))
+        b = make_file(tmp_path / "b", "x.sam", SAM_HEADER + pg.format("1.2", "CRISPResso_on_bam-out") + SAM_RECORD.format("1.0"))
+        assert diff.diff_alignments(a, b) == []
+        c = make_file(tmp_path / "c", "x.sam", SAM_HEADER + pg.format("1.2", "x").replace("PP:crispresso2", "PP:bowtie2") + SAM_RECORD.format("1.0"))
+        assert diff.diff_alignments(a, c) != []
+
+    def test_sam_field_difference(self, tmp_path):
+        a = make_file(tmp_path / "a", "x.sam", SAM_HEADER + SAM_RECORD.format("100.0"))
+        b = make_file(tmp_path / "b", "x.sam", SAM_HEADER + SAM_RECORD.format("100.0").replace("\t1\t100\t", "\t2\t100\t"))
+        result = diff.diff_alignments(a, b)
+        assert "@@ record 1 (r1) @@\n" in result
+        assert "-POS: 1\n" in result and "+POS: 2\n" in result
+        assert result[-1] == "1 of 1 records differ\n"
+
+    def test_tag_floats_rounded(self, tmp_path):
+        a = make_file(tmp_path / "a", "x.sam", SAM_HEADER + SAM_RECORD.format("40.8161"))
+        b = make_file(tmp_path / "b", "x.sam", SAM_HEADER + SAM_RECORD.format("40.8159"))
+        assert diff.diff_alignments(a, b) == []
+
+    def test_extra_record(self, tmp_path):
+        a = make_file(tmp_path / "a", "x.sam", SAM_HEADER + SAM_RECORD.format("1.0") * 2)
+        b = make_file(tmp_path / "b", "x.sam", SAM_HEADER + SAM_RECORD.format("1.0"))
+        result = diff.diff_alignments(a, b)
+        assert "@@ record 2 (r1) @@\n" in result
+        assert result[-1] == "1 of 2 records differ\n"
+
+    @pytest.mark.skipif(not EXPECTED_BAM.exists(), reason="expected results not checked out")
+    def test_bam_records_decoded(self):
+        header, records = diff.read_bam(EXPECTED_BAM)
+        first = next(records)
+        records.close()
+        assert header[0].startswith("@HD")
+        assert first[:9] == ("r1_wt", "0", "Reference", "1", "100", "86M", "*", "0", "0")
+        assert first[11].startswith("c2:Z:ALN=Reference")
+
+    @pytest.mark.skipif(not EXPECTED_BAM.exists(), reason="expected results not checked out")
+    def test_recompressed_bam_matches(self, tmp_path):
+        import gzip
+        with gzip.open(str(EXPECTED_BAM), "rb") as fh:
+            data = fh.read()
+        recompressed = tmp_path / "CRISPResso_output.bam"
+        with gzip.open(str(recompressed), "wb", compresslevel=1) as fh:
+            fh.write(data)
+        assert diff.diff_alignments(recompressed, EXPECTED_BAM) == []
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_fastq / diff_gzip — compressed outputs
+# ═══════════════════════════════════════════════════════════════════════════
+
+def make_fastq_gz(base, relpath, reads, compresslevel=9):
+    """Write ``(name, seq)`` reads to a gzipped FASTQ file under *base*."""
+    import gzip
+    p = Path(base) / relpath
+    p.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(str(p), "wt", compresslevel=compresslevel) as fh:
+        for name, seq in reads:
+            fh.write("@{0}\n{1}\n+\n{2}\n".format(name, seq, "A" * len(seq)))
+    return p
+
+
+class TestDiffFastq:
+    """Test the streaming FASTQ comparator."""
+
+    READS = [("r1", "ACGT"), ("r2", "GGCC"), ("r3", "TTAA")]
+
+    def test_same_reads_different_compression(self, tmp_path):
+        a = make_fastq_gz(tmp_path / "a", "x.fastq.gz", self.READS, compresslevel=1)
+        b = make_fastq_gz(tmp_path / "b", "x.fastq.gz", self.READS)
+        assert diff.diff_fastq(a, b) == []
+
+    def test_reordered_reads(self, tmp_path):
+        a = make_fastq_gz(tmp_path / "a", "x.fastq.gz", self.READS[::-1])
+        b = make_fastq_gz(tmp_path / "b", "x.fastq.gz", self.READS)
+        assert diff.diff_fastq(a, b) == []
+        result = diff.diff_fastq(a, b, ordered=True)
+        assert result[-1] == "2 of 3 records differ by position; same reads in a different order\n"
+
+    def test_changed_read(self, tmp_path):
+        a = make_fastq_gz(tmp_path / "a", "x.fastq.gz", [("r1", "ACGT"), ("r2", "GGCA"), ("r3", "TTAA")])
+        b = make_fastq_gz(tmp_path / "b", "x.fastq.gz", self.READS)
+        result = diff.diff_fastq(a, b)
+        assert "@@ record 2 @@\n" in result
+        assert "-GGCA\n" in result and "+GGCC\n" in result
+        assert result[-1] == "1 of 3 records differ by position; read sets differ (3 vs 3 records)\n"
+
+    def test_missing_read(self, tmp_path):
+        a = make_fastq_gz(tmp_path / "a", "x.fastq.gz", self.READS[:2])
+        b = make_fastq_gz(tmp_path / "b", "x.fastq.gz", self.READS)
+        result = diff.diff_fastq(a, b)
+        assert "+@r3\n" in result
+        assert result[-1].endswith("read sets differ (2 vs 3 records)\n")
+
+    def test_empty_file(self, tmp_path):
+        a = make_file(tmp_path / "a", "x.fastq.gz", "")
+        b = make_fastq_gz(tmp_path / "b", "x.fastq.gz", [])
+        assert diff.diff_gzip(a, b) == []
+
+    def test_non_fastq_gzip(self, tmp_path):
+        import gzip
+        a = tmp_path / "a.txt.gz"
+        b = tmp_path / "b.txt.gz"
+        a.write_bytes(gzip.compress(b"hello\n", compresslevel=1))
+        b.write_bytes(gzip.compress(b"hello\n"))
+        assert diff.diff_gzip(a, b) == []
+        b.write_bytes(gzip.compress(b"world\n"))
+        assert diff.diff_gzip(a, b) == ["Decompressed contents of {0} and {1} differ\n".format(a, b)]
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# extract_pdf_text — object-aware PDF text extraction
+# ═══════════════════════════════════════════════════════════════════════════
+
+def make_pdf(base, relpath, objects, xref=True):
+    """Write a minimal PDF whose numbered *objects* are raw bodies or
+    ``(dictionary, stream bytes)`` tuples, with an xref table if *xref*."""
+    import zlib
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for number, body in objects.items():
+        offsets[number] = len(out)
+        out += "{0} 0 obj\n".format(number).encode()
+        if isinstance(body, tuple):
+            dictionary, stream = body
+            data = zlib.compress(stream)
+            out += dictionary.replace("LEN", str(len(data))).encode()
+            out += b"\nstream\n" + data + b"\nendstream\n"
+        else:
+            out += body.encode() + b"\n"
+        out += b"endobj\n"
+    if xref:
+        start = len(out)
+        size = max(objects) + 1
+        out += "xref\n0 {0}\n0000000000 65535 f \n".format(size).encode()
+        for number in range(1, size):
+            if number in offsets:
+                out += "{0:010d} 00000 n \n".format(offsets[number]).encode()
+            else:
+                out += b"0000000000 00000 f \n"
+        out += "trailer\n<< /Size {0} /Root 1 0 R >>\nstartxref\n{1}\n%%EOF\n".format(size, start).encode()
+    p = Path(base) / relpath
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_bytes(bytes(out))
+    return p
+
+
+PDF_OBJECTS = {
+    1: "<< /Type /Catalog /Pages 2 0 R >>",
+    2: "<< /Type /Pages /Kids [ 3 0 R ] /Count 1 >>",
+    3: "<< /Type /Page /Parent 2 0 R /Contents 4 0 R >>",
+    4: ("<< /Length 5 0 R /Filter /FlateDecode >>",
+        b"BT [ (\x00W) 10 (\x00orld) ] TJ ET\nBT (Hello) Tj ET\n/M0 Do\n"),
+    5: "LENGTH",
+    6: ("<< /Type /XObject /Subtype /Form /Length LEN /Filter /FlateDecode >>", b"BT (Marker) Tj ET\n"),
+    7: ("<< /Length1 10 /Length LEN /Filter /FlateDecode >>", b"/CIDInit (Glyph) Tj\n"),
+    8: ("<< /Type /XObject /Subtype /Image /Length LEN /Filter /FlateDecode >>", b"(Pixels) Tj\n"),
+}
+
+
+class TestExtractPdfText:
+    """Test the object-aware PDF extractor against the raw stream scan."""
+
+    @staticmethod
+    def _objects():
+        import zlib
+        objects = dict(PDF_OBJECTS)
+        objects[5] = str(len(zlib.compress(objects[4][1])))
+        return objects
+
+    def test_content_streams_only(self, tmp_path):
+        pdf = make_pdf(tmp_path, "plot.pdf", self._objects())
+        assert diff.extract_pdf_text(pdf) == ["World", "Hello", "Marker"]
+
+    def test_raw_scan_also_reads_other_streams(self, tmp_path):
+        pdf = make_pdf(tmp_path, "plot.pdf", self._objects())
+        # Image data that happens to look like a text operator is picked up
+        assert diff.extract_pdf_text(pdf, object_aware=False) == ["World", "Hello", "Marker", "Pixels"]
+
+    def test_falls_back_without_xref(self, tmp_path):
+        pdf = make_pdf(tmp_path, "plot.pdf", self._objects(), xref=False)
+        assert diff.pdf_content_streams(pdf.read_bytes()) is None
+        assert diff.extract_pdf_text(pdf) == diff.extract_pdf_text(pdf, object_aware=False)
+
+    def test_font_and_image_streams_not_inflated(self, tmp_path, monkeypatch):
+        import zlib
+        pdf = make_pdf(tmp_path, "plot.pdf", self._objects())
+        inflated = []
+        real_decompress = zlib.decompress
+        monkeypatch.setattr(diff.zlib, "decompress", lambda data: inflated.append(data) or real_decompress(data))
+        diff.extract_pdf_text(pdf)
+        assert len(inflated) == 2
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 # diff_dir — directory comparison (critical path)
 # ═══════════════════════════════════════════════════════════════════════════
@@ -358,8 +1240,8 @@ class TestDiffDir:
         ]
         for log_file in log_files:
             # diff_dir ignores RUNNING_LOG files on the *actual* side only when
-            # they match IGNORE_FILES_REGEXP.
-            assert IGNORE_FILES_REGEXP.match(log_file)
+            # a rule in diff_rules.toml ignores them.
+            assert diff.default_diff_rules().rule_for(log_file).severity == "ignore"
             make_file(actual, log_file, "actual\n")
             make_file(expected, log_file, "expected\n")
 
@@ -409,8 +1291,8 @@ class TestDiffDir:
             "cause diff_dir to return True"
         )
 
-    def test_ignore_suffix_only_in_expected(self, tmp_path, capsys):
-        """File matching _RUNNING_LOG.txt suffix only in expected should NOT be flagged."""
+    def test_custom_running_log_only_in_expected_is_missing(self, tmp_path, capsys):
+        """Only the ignore rules decide which missing files are skipped, as on the actual side."""
         actual = tmp_path / "actual"
         expected = tmp_path / "expected"
         make_file(actual, "data.txt", "same\n")
@@ -418,10 +1300,8 @@ class TestDiffDir:
         make_file(expected, "CustomTool_RUNNING_LOG.txt", "log content\n")
 
         result = diff_dir(str(actual), str(expected))
-        assert result is False, (
-            "Ignored suffix _RUNNING_LOG.txt only in expected should not "
-            "cause diff_dir to return True"
-        )
+        assert result is True
+        assert "Missing file CustomTool_RUNNING_LOG.txt" in capsys.readouterr().out
 
     # --- fastp_report.html ignore behavior ---
 
@@ -459,7 +1339,7 @@ class TestDiffDir:
 
         result = diff_dir(str(actual), str(expected), suffixes=('.txt', '.html'))
         assert result is False, (
-            "fastp_report.html matches WARNING_FILE_REGEXP — its absence from actual "
+            "fastp_report.html is a warn rule — its absence from actual "
             "should not cause a failure"
         )
 
@@ -619,6 +1499,443 @@ class TestDiffDir:
         assert result is False
 
 
+# ═══════════════════════════════════════════════════════════════════════════
+# ResultTreeIndex — single directory walk
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TestResultTreeIndex:
+    """Test the shared directory index."""
+
+    def test_records_relative_paths_and_stats(self, tmp_path):
+        make_file(tmp_path, "a.txt", "abc")
+        make_file(tmp_path, "sub/b.html", "x")
+        index = diff.ResultTreeIndex(tmp_path)
+
+        assert set(index.entries) == {Path("a.txt"), Path("sub/b.html")}
+        entry = index.entries[Path("a.txt")]
+        assert entry.path == tmp_path / "a.txt"
+        assert entry.suffix == ".txt"
+        assert entry.size == 3
+        assert index.files((".html",)) == {Path("sub/b.html"): tmp_path / "sub" / "b.html"}
+
+    def test_behaves_like_the_root_path(self, tmp_path):
+        index = diff.ResultTreeIndex(tmp_path)
+        assert str(index) == str(tmp_path)
+        assert Path(index) == tmp_path
+        assert os.path.join(index, "x") == os.path.join(str(tmp_path), "x")
+
+    def test_one_walk_shared_across_passes(self, tmp_path, monkeypatch, capsys):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        make_file(actual, "a.txt", "actual\n")
+        make_file(expected, "a.txt", "expected\n")
+        make_file(actual, "r.html", "same\n")
+        make_file(expected, "r.html", "same\n")
+
+        walks = []
+        real_walk = os.walk
+        monkeypatch.setattr(os, "walk", lambda top, *a, **kw: walks.append(top) or real_walk(top, *a, **kw))
+        actual_index = diff.ResultTreeIndex(actual)
+        expected_index = diff.ResultTreeIndex(expected)
+        assert diff_dir(actual_index, expected_index, suffixes=(".txt",)) is True
+        assert diff_dir(actual_index, expected_index, suffixes=(".html",)) is False
+        assert len(walks) == 2
+        assert "Comparing {0} to {1}".format(actual / "a.txt", expected / "a.txt") in capsys.readouterr().out
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_dir — incremental mode
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TestDiffDirIncremental:
+    """Test that --incremental skips pairs that passed and have not changed."""
+
+    def _make_tree(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        make_file(actual, "same.txt", "same\n")
+        make_file(expected, "same.txt", "same\n")
+        make_file(actual, "diff.txt", "actual\n")
+        make_file(expected, "diff.txt", "expected\n")
+        return actual, expected
+
+    def test_unchanged_pass_is_cached(self, tmp_path, monkeypatch, capsys):
+        actual, expected = self._make_tree(tmp_path)
+        state_file = tmp_path / "state.json"
+        assert diff_dir(str(actual), str(expected), incremental=diff.IncrementalState(state_file)) is True
+        capsys.readouterr()
+
+        compared = []
+        real_compare = diff.compare_files
+        monkeypatch.setattr(diff, "compare_files", lambda a, b, rule=None: compared.append(Path(a).name) or real_compare(a, b, rule))
+        assert diff_dir(str(actual), str(expected), incremental=diff.IncrementalState(state_file)) is True
+        out = capsys.readouterr().out
+        assert compared == ["diff.txt"]
+        assert "1 file(s) unchanged since they last passed" in out
+        assert "Comparing {0}".format(actual / "diff.txt") in out
+
+    def test_changed_file_is_rechecked(self, tmp_path, capsys):
+        actual, expected = self._make_tree(tmp_path)
+        state_file = tmp_path / "state.json"
+        diff_dir(str(actual), str(expected), incremental=diff.IncrementalState(state_file))
+        (actual / "same.txt").write_text("changed\n")
+        capsys.readouterr()
+
+        assert diff_dir(str(actual), str(expected), incremental=diff.IncrementalState(state_file)) is True
+        out = capsys.readouterr().out
+        assert "cached passes" not in out
+        assert "Comparing {0}".format(actual / "same.txt") in out
+
+    def test_state_discarded_on_version_change(self, tmp_path, monkeypatch):
+        actual, expected = self._make_tree(tmp_path)
+        state_file = tmp_path / "state.json"
+        diff_dir(str(actual), str(expected), incremental=diff.IncrementalState(state_file))
+        assert diff.IncrementalState(state_file).entries
+
+        monkeypatch.setattr(diff, "DIFF_CACHE_FORMAT", diff.DIFF_CACHE_FORMAT + 1)
+        assert diff.IncrementalState(state_file).entries == {}
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_dir — parallel comparison
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TestDiffDirParallel:
+    """Test that workers > 1 gives the same verdict and output as a serial run."""
+
+    def _make_tree(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        for i in range(6):
+            make_file(actual, "sub/same_{0}.txt".format(i), "same {0}\n".format(i))
+            make_file(expected, "sub/same_{0}.txt".format(i), "same {0}\n".format(i))
+        make_file(actual, "b_diff.txt", "actual\n")
+        make_file(expected, "b_diff.txt", "expected\n")
+        make_file(actual, "a_diff.txt", "actual\n")
+        make_file(expected, "a_diff.txt", "expected\n")
+        make_file(actual, "new.txt", "new\n")
+        make_file(expected, "gone.txt", "gone\n")
+        return actual, expected
+
+    def test_parallel_matches_serial(self, tmp_path, capsys):
+        actual, expected = self._make_tree(tmp_path)
+
+        serial = diff_dir(str(actual), str(expected))
+        serial_out = capsys.readouterr().out
+        parallel = diff_dir(str(actual), str(expected), workers=2)
+        parallel_out = capsys.readouterr().out
+
+        assert serial is True
+        assert parallel is True
+        assert parallel_out == serial_out
+
+    def test_parallel_output_in_path_order(self, tmp_path, capsys):
+        actual, expected = self._make_tree(tmp_path)
+
+        diff_dir(str(actual), str(expected), workers=2)
+        out = capsys.readouterr().out
+        assert out.index("a_diff.txt") < out.index("b_diff.txt")
+        assert out.index("b_diff.txt") < out.index("New file")
+        assert out.index("New file") < out.index("Missing file")
+
+    def test_parallel_identical_dirs_no_diff(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        for i in range(4):
+            make_file(actual, "data_{0}.txt".format(i), "score=0.123456789\n")
+            make_file(expected, "data_{0}.txt".format(i), "score=0.123400000\n")
+
+        assert diff_dir(str(actual), str(expected), workers=2) is False
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# DiffReport — machine-readable per-file verdicts
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TestDiffReport:
+    """Test the JSON Lines and JUnit reports written by diff_dir."""
+
+    def _make_tree(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        make_file(actual, "same.txt", "same\n")
+        make_file(expected, "same.txt", "same\n")
+        make_file(actual, "diff.txt", "actual\n")
+        make_file(expected, "diff.txt", "expected\n")
+        make_file(actual, "new.txt", "new\n")
+        make_file(expected, "gone.json", "{}")
+        return actual, expected
+
+    @staticmethod
+    def _read_jsonl(path):
+        return {entry["path"]: entry for entry in map(json.loads, path.read_text().splitlines())}
+
+    def test_json_verdicts(self, tmp_path):
+        actual, expected = self._make_tree(tmp_path)
+        with diff.DiffReport(json_path=tmp_path / "report.jsonl") as report:
+            diff_dir(str(actual), str(expected), suffixes=(".txt", ".json"), report=report)
+        entries = self._read_jsonl(tmp_path / "report.jsonl")
+        assert {path: entry["verdict"] for path, entry in entries.items()} == {
+            "same.txt": "pass", "diff.txt": "fail", "new.txt": "new", "gone.json": "missing",
+        }
+        assert entries["diff.txt"]["comparator"] == "text"
+        assert entries["diff.txt"]["diff_lines"] > 0
+        assert entries["same.txt"]["seconds"] >= 0
+        assert entries["gone.json"]["seconds"] is None
+        assert {entry["suite"] for entry in entries.values()} == {"actual"}
+
+    def test_new_and_missing_warn_rule_recorded_as_warning(self, tmp_path):
+        actual, expected = self._make_tree(tmp_path)
+        rules = diff.DiffRules([diff.DiffRule("new.txt", severity="warn"), diff.DiffRule("gone.json", severity="warn")])
+        with diff.DiffReport(json_path=tmp_path / "report.jsonl", junit_path=tmp_path / "report.xml") as report:
+            diff_dir(str(actual), str(expected), suffixes=(".txt", ".json"), report=report, rules=rules)
+        entries = self._read_jsonl(tmp_path / "report.jsonl")
+        assert entries["new.txt"]["verdict"] == entries["gone.json"]["verdict"] == "warning"
+        assert "failures=\"1\"" in (tmp_path / "report.xml").read_text()
+
+    def test_json_streamed_before_close(self, tmp_path):
+        actual, expected = self._make_tree(tmp_path)
+        report = diff.DiffReport(json_path=tmp_path / "report.jsonl")
+        diff_dir(str(actual), str(expected), suffixes=(".txt",), report=report)
+        assert len((tmp_path / "report.jsonl").read_text().splitlines()) == 3
+        report.close()
+
+    def test_cached_pass_recorded(self, tmp_path):
+        actual, expected = self._make_tree(tmp_path)
+        state_file = tmp_path / "state.json"
+        diff_dir(str(actual), str(expected), suffixes=(".txt",), incremental=diff.IncrementalState(state_file))
+        with diff.DiffReport(json_path=tmp_path / "report.jsonl") as report:
+            diff_dir(
+                str(actual), str(expected), suffixes=(".txt",),
+                incremental=diff.IncrementalState(state_file), report=report,
+            )
+        assert self._read_jsonl(tmp_path / "report.jsonl")["same.txt"]["verdict"] == "cached"
+
+    def test_junit(self, tmp_path):
+        import xml.etree.ElementTree as ET
+        actual, expected = self._make_tree(tmp_path)
+        with diff.DiffReport(junit_path=tmp_path / "report.xml") as report:
+            diff_dir(str(actual), str(expected), suffixes=(".txt", ".json"), report=report)
+        suite = ET.parse(str(tmp_path / "report.xml")).getroot()
+        assert suite.tag == "testsuite"
+        assert (suite.get("tests"), suite.get("failures")) == ("4", "3")
+        failed = {case.get("name") for case in suite if case.find("failure") is not None}
+        assert failed == {"diff.txt", "new.txt", "gone.json"}
+        assert not (tmp_path / "report.xml.partial").exists()
+
+    @pytest.mark.skipif(not IMAGE_DEPS_AVAILABLE, reason="Pillow and/or NumPy not installed")
+    def test_images_recorded(self, tmp_path, capsys):
+        make_png(tmp_path / "actual", "plot.png", color=(255, 255, 255))
+        make_png(tmp_path / "expected", "plot.png", color=(0, 0, 0))
+        with diff.DiffReport(json_path=tmp_path / "report.jsonl") as report:
+            diff_dir_images(str(tmp_path / "actual"), str(tmp_path / "expected"), report=report)
+        entry = self._read_jsonl(tmp_path / "report.jsonl")["plot.png"]
+        assert (entry["comparator"], entry["verdict"]) == ("image", "fail")
+        assert entry["rmse"] > 0.9
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_dir — fail-fast and time budget
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TestDiffBudget:
+    """Test that a DiffBudget stops diff_dir early and lists the unchecked files."""
+
+    def _make_tree(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        for name in ("a.txt", "b.txt", "c.txt"):
+            make_file(actual, name, "actual {0}\n".format(name))
+            make_file(expected, name, "expected {0}\n".format(name))
+        make_file(expected, "gone.txt", "gone\n")
+        return actual, expected
+
+    def test_fail_fast_stops_after_first_difference(self, tmp_path, capsys):
+        actual, expected = self._make_tree(tmp_path)
+        budget = diff.DiffBudget(max_failures=1)
+        assert diff_dir(str(actual), str(expected), budget=budget) is True
+        out = capsys.readouterr().out
+        assert "Comparing {0}".format(actual / "a.txt") in out
+        assert "Comparing {0}".format(actual / "b.txt") not in out
+        assert "Missing file gone.txt" in out
+        assert "STOPPED\033[0m stopped after 2 significant difference(s) (fail-fast); 2 file(s)" in out
+        assert "    b.txt\n    c.txt\n" in out
+        assert budget.n_unchecked == 2
+
+    def test_warnings_do_not_count(self, tmp_path, capsys):
+        actual, expected = self._make_tree(tmp_path)
+        (expected / "gone.txt").unlink()
+        rules = diff.DiffRules([diff.DiffRule("*.txt", severity="warn")])
+        budget = diff.DiffBudget(max_failures=1)
+        assert diff_dir(str(actual), str(expected), rules=rules, budget=budget) is False
+        assert "STOPPED" not in capsys.readouterr().out
+
+    def test_time_budget_leaves_comparisons_unchecked(self, tmp_path, monkeypatch, capsys):
+        """Listing new and missing files compares nothing, so they are still reported."""
+        actual, expected = self._make_tree(tmp_path)
+        compared = []
+        real_compare = diff.compare_files
+        monkeypatch.setattr(diff, "compare_files", lambda a, b, rule=None: compared.append(a) or real_compare(a, b, rule))
+        budget = diff.DiffBudget(seconds=0)
+        with diff.DiffReport(json_path=tmp_path / "report.jsonl") as report:
+            assert diff_dir(str(actual), str(expected), budget=budget, report=report) is True
+        assert compared == []
+        assert "diff time budget of 0 s used up; 3 file(s)" in capsys.readouterr().out
+        entries = [json.loads(line) for line in (tmp_path / "report.jsonl").read_text().splitlines()]
+        assert [(e["path"], e["verdict"]) for e in entries] == [
+            ("gone.txt", "missing"), ("a.txt", "unchecked"), ("b.txt", "unchecked"), ("c.txt", "unchecked"),
+        ]
+        assert entries[1]["reason"] == "diff time budget of 0 s used up"
+
+    def test_budget_shared_across_passes(self, tmp_path, capsys):
+        actual, expected = self._make_tree(tmp_path)
+        make_file(actual, "report.html", "<p>actual</p>\n")
+        make_file(expected, "report.html", "<p>expected</p>\n")
+        budget = diff.DiffBudget(max_failures=1)
+        diff_dir(str(actual), str(expected), suffixes=diff.DATA_SUFFIXES, budget=budget)
+        capsys.readouterr()
+        assert diff_dir(str(actual), str(expected), suffixes=diff.HTML_SUFFIXES, budget=budget) is True
+        out = capsys.readouterr().out
+        assert "Comparing" not in out
+        assert "1 file(s) in actual not compared" in out
+
+    def test_parallel_fail_fast(self, tmp_path, capsys):
+        actual, expected = self._make_tree(tmp_path)
+        budget = diff.DiffBudget(max_failures=2)
+        assert diff_dir(str(actual), str(expected), workers=2, budget=budget) is True
+        out = capsys.readouterr().out
+        assert "Comparing {0}".format(actual / "b.txt") in out
+        assert "Comparing {0}".format(actual / "c.txt") not in out
+        assert "Missing file gone.txt" in out
+        assert budget.n_unchecked == 1
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# DiffRules — per-file comparison rules
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TestDiffRules:
+    """Test the rules file and the path -> rule dispatch table."""
+
+    @staticmethod
+    def make_rules(tmp_path, text):
+        return diff.load_diff_rules(make_file(tmp_path, "diff_rules.toml", text))
+
+    @pytest.mark.skipif(diff.tomllib is None, reason="no TOML parser installed")
+    def test_rules_loaded_from_toml(self, tmp_path):
+        rules = self.make_rules(tmp_path, (
+            "[[rule]]\npattern = \"*.tsv\"\ncomparator = \"table\"\natol = 0.5\n"
+            "[[rule]]\npattern = \"sub/*.txt\"\nseverity = \"warn\"\n"
+        ))
+        assert rules.rule_for(Path("a/b.tsv")) == diff.DiffRule("*.tsv", "table", "fail", 0.5, None)
+        assert rules.rule_for(Path("sub/x.txt")).severity == "warn"
+        assert rules.rule_for(Path("other/sub/x.txt")).severity == "fail"
+
+    @pytest.mark.skipif(diff.tomllib is None, reason="no TOML parser installed")
+    def test_shipped_rules_file_loads(self):
+        assert isinstance(diff.load_diff_rules(diff.DIFF_RULES_FILE), diff.DiffRules)
+
+    @pytest.mark.skipif(diff.tomllib is None, reason="no TOML parser installed")
+    def test_shipped_rules_ignore_logs_and_warn_on_reports(self):
+        rules = diff.load_diff_rules(diff.DIFF_RULES_FILE)
+        assert rules.rule_for("CRISPResso_RUNNING_LOG.txt").severity == "ignore"
+        assert rules.rule_for("out/CRISPResso2_report.html") == diff.DiffRule("*CRISPResso2_report.html", "html", "warn")
+        assert rules.rule_for("CRISPResso2_info.json") == diff.DiffRule(None, "json", "fail")
+
+    def test_missing_file_gives_no_rules(self, tmp_path):
+        rules = diff.load_diff_rules(tmp_path / "missing.toml")
+        assert rules.rules == ()
+        assert rules.rule_for("CRISPResso_RUNNING_LOG.txt") == diff.DiffRule(None, "text", "fail")
+        assert rules.rule_for("out/CRISPResso2_report.html") == diff.DiffRule(None, "html", "fail")
+
+    def test_rules_file_without_toml_parser_is_an_error(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(diff, "tomllib", None)
+        with pytest.raises(ImportError, match="tomli"):
+            diff.load_diff_rules(diff.DIFF_RULES_FILE)
+
+    def test_first_match_wins_and_is_memoized(self):
+        rules = diff.DiffRules([
+            diff.DiffRule("Alleles_*.txt", severity="warn"),
+            diff.DiffRule("*.txt", severity="ignore"),
+        ])
+        rule = rules.rule_for("dir/Alleles_frequency_table.txt")
+        assert rule == diff.DiffRule("Alleles_*.txt", "alleles", "warn")
+        assert rules.rule_for("dir/Alleles_frequency_table.txt") is rule
+        assert rules.rule_for("dir/other.txt").severity == "ignore"
+
+    def test_bare_glob_does_not_reach_into_subdirectories(self):
+        rules = diff.DiffRules([
+            diff.DiffRule("Alleles*.txt", severity="ignore"),
+            diff.DiffRule("*.t[!x]v", severity="warn"),
+        ])
+        assert rules.rule_for("Alleles_out/CRISPResso_mapping_statistics.txt").severity == "fail"
+        assert rules.rule_for("Alleles_out/Alleles_frequency_table.txt").severity == "ignore"
+        assert rules.rule_for("a.tsv/b.txv").severity == "fail"
+        assert rules.rule_for("out/a.tsv").severity == "warn"
+
+    @pytest.mark.parametrize("rule", [
+        diff.DiffRule("*.txt", comparator="csv"),
+        diff.DiffRule("*.txt", severity="error"),
+        diff.DiffRule("*.txt", comparator="text", atol=0.1),
+        diff.DiffRule(""),
+    ])
+    def test_invalid_rules_rejected(self, rule):
+        with pytest.raises(ValueError):
+            diff.DiffRules([rule])
+
+    @pytest.mark.skipif(diff.tomllib is None, reason="no TOML parser installed")
+    def test_unknown_key_rejected(self, tmp_path):
+        with pytest.raises(ValueError, match="tolerance"):
+            self.make_rules(tmp_path, "[[rule]]\npattern = \"*.txt\"\ntolerance = 1\n")
+
+    def test_extra_suffixes(self):
+        rules = diff.DiffRules([
+            diff.DiffRule("*.tsv", comparator="table"),
+            diff.DiffRule("*.txt", severity="warn"),
+            diff.DiffRule("*.log", severity="ignore"),
+            diff.DiffRule("*.t[sx]v"),
+        ])
+        assert rules.extra_suffixes == (".tsv",)
+
+    @pytest.mark.skipif(not diff.NUMPY_AVAILABLE, reason="NumPy not installed")
+    def test_diff_dir_applies_severity_and_tolerances(self, tmp_path, capsys):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        make_file(actual, "warned.txt", "actual\n")
+        make_file(expected, "warned.txt", "expected\n")
+        make_file(actual, "ignored.txt", "actual\n")
+        make_file(expected, "ignored.txt", "expected\n")
+        make_file(actual, "counts.tsv", "x\ty\nr\t0.5\n")
+        make_file(expected, "counts.tsv", "x\ty\nr\t0.55\n")
+        rules = diff.DiffRules([
+            diff.DiffRule("warned.txt", severity="warn"),
+            diff.DiffRule("ignored.txt", severity="ignore"),
+            diff.DiffRule("*.tsv", comparator="table", atol=0.1),
+        ])
+        suffixes = diff.DATA_SUFFIXES + rules.extra_suffixes
+        assert diff_dir(str(actual), str(expected), suffixes=suffixes, rules=rules) is False
+        out = capsys.readouterr().out
+        assert "warned.txt" in out
+        assert "ignored.txt" not in out and "counts.tsv" not in out
+
+        tight = diff.DiffRules([diff.DiffRule("*.tsv", comparator="table", atol=0.01)])
+        assert diff_dir(str(actual), str(expected), suffixes=suffixes, rules=tight) is True
+
+    def test_rule_change_invalidates_cached_pass(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        make_file(actual, "same.txt", "same\n")
+        make_file(expected, "same.txt", "same\n")
+        state_file = tmp_path / "state.json"
+        warn = diff.DiffRules([diff.DiffRule("*.txt", severity="warn")])
+        diff_dir(str(actual), str(expected), incremental=diff.IncrementalState(state_file), rules=diff.DiffRules())
+
+        state = diff.IncrementalState(state_file)
+        pair = (actual / "same.txt", expected / "same.txt")
+        assert state.is_cached_pass(*pair, diff.DiffRules().rule_for(Path("same.txt")))
+        assert not state.is_cached_pass(*pair, warn.rule_for(Path("same.txt")))
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 # diff_dir_images — image directory comparison
 # ═══════════════════════════════════════════════════════════════════════════
@@ -731,6 +2048,223 @@ class TestDiffDirImages:
         assert result is True
 
 
+@pytest.mark.skipif(
+    not IMAGE_DEPS_AVAILABLE,
+    reason="Pillow and/or NumPy not installed",
+)
+class TestDiffDirImagesThreaded:
+    """Test that the thread-pool mode gives the same verdict and output order."""
+
+    def _make_tree(self, tmp_path):
+        actual = tmp_path / "actual"
+        expected = tmp_path / "expected"
+        for i, (color_a, color_b) in enumerate([("white", "white"), ("white", "black"), ("red", "red"), ("black", "white")]):
+            make_png(actual, "plot_{0}.png".format(i), color=color_a, size=(40, 30))
+            make_png(expected, "plot_{0}.png".format(i), color=color_b, size=(40, 30))
+        make_png(actual, "new.png")
+        return actual, expected
+
+    def test_threaded_matches_serial(self, tmp_path, capsys):
+        actual, expected = self._make_tree(tmp_path)
+
+        serial = diff_dir_images(str(actual), str(expected))
+        serial_out = capsys.readouterr().out
+        threaded = diff_dir_images(str(actual), str(expected), workers=3)
+        threaded_out = capsys.readouterr().out
+
+        assert serial is True
+        assert threaded is True
+        assert threaded_out == serial_out
+        assert threaded_out.index("plot_1.png") < threaded_out.index("plot_3.png")
+
+    def test_thumbnail_size_keeps_aspect_ratio(self):
+        assert diff._thumbnail_size((1162, 944), (256, 256)) == (256, 208)
+        assert diff._thumbnail_size((100, 50), (256, 256)) == (100, 50)
+        assert diff._thumbnail_size((5000, 10), (256, 256)) == (256, 1)
+
+
+@pytest.mark.skipif(
+    not IMAGE_DEPS_AVAILABLE,
+    reason="Pillow and/or NumPy not installed",
+)
+class TestImagePrefilter:
+    """Test the digest and perceptual-hash checks that run before RMSE."""
+
+    @staticmethod
+    def _gradient(path, compress_level=6, shift=0):
+        import numpy as np
+        path.parent.mkdir(parents=True, exist_ok=True)
+        pixels = np.tile(np.linspace(0, 255 - shift, 64, dtype=np.uint8), (48, 1)) + shift
+        Image.fromarray(pixels, 'L').convert('RGBA').save(str(path), compress_level=compress_level)
+        return path
+
+    def test_identical_bytes(self, tmp_path):
+        p = self._gradient(tmp_path / "a.png")
+        assert diff.diff_image(p, p)['prefilter'] == 'digest'
+
+    def test_reencoded_image_matches_hash(self, tmp_path):
+        a = self._gradient(tmp_path / "a.png", compress_level=1)
+        b = self._gradient(tmp_path / "b.png", compress_level=9)
+        assert a.read_bytes() != b.read_bytes()
+        result = diff.diff_image(a, b)
+        assert result['prefilter'] == 'dhash'
+        assert result['is_different'] is False
+
+    def test_brightness_shift_falls_through_to_rmse(self, tmp_path):
+        a = self._gradient(tmp_path / "a.png")
+        b = self._gradient(tmp_path / "b.png", shift=60)
+        result = diff.diff_image(a, b, threshold=0.001)
+        assert result['prefilter'] is None
+        assert result['is_different']
+
+    def test_expected_signature_cached(self, tmp_path, monkeypatch):
+        a = self._gradient(tmp_path / "a.png", compress_level=1)
+        b = self._gradient(tmp_path / "b.png", compress_level=9)
+        computed = []
+        real_signature = diff.image_signature
+        monkeypatch.setattr(diff, "image_signature", lambda p: computed.append(Path(p).name) or real_signature(p))
+        diff.diff_image(a, b)
+        diff.diff_image(a, b)
+        assert computed == ["a.png", "b.png", "a.png"]
+
+    def test_prefilter_disabled(self, tmp_path):
+        p = self._gradient(tmp_path / "a.png")
+        result = diff.diff_image(p, p, prefilter=False)
+        assert result['prefilter'] is None
+        assert result['rmse'] == 0.0
+
+
+@pytest.mark.skipif(
+    not IMAGE_DEPS_AVAILABLE,
+    reason="Pillow and/or NumPy not installed",
+)
+class TestImageSsim:
+    """Test the windowed SSIM metric and its region heatmap."""
+
+    @staticmethod
+    def _bars(path, offset=0, patch=None):
+        """A 128x128 grid of vertical bars, optionally shifted or with a dark patch."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        pixels = np.full((128, 128), 255, dtype=np.uint8)
+        for x in range(8 + offset, 120, 16):
+            pixels[:, x:x + 4] = 0
+        if patch:
+            pixels[patch] = 40
+        Image.fromarray(pixels, 'L').save(str(path))
+        return path
+
+    def test_box_filter_matches_window_means(self):
+        arr = np.arange(30, dtype=np.float64).reshape(5, 6)
+        expected = np.array([[arr[i:i + 3, j:j + 3].mean() for j in range(4)] for i in range(3)])
+        np.testing.assert_allclose(diff._box_filter(arr, 3), expected)
+
+    def test_identical_arrays(self):
+        arr = np.random.RandomState(0).uniform(0, 255, (32, 32))
+        np.testing.assert_allclose(diff.ssim_map(arr, arr), 1.0)
+
+    def test_threshold_defaults_per_metric(self, tmp_path):
+        a = self._bars(tmp_path / "a.png")
+        b = self._bars(tmp_path / "b.png", offset=1)
+        rmse = diff.diff_image(a, b, prefilter=False)
+        ssim = diff.diff_image(a, b, prefilter=False, metric='ssim')
+        assert rmse['metric'] == 'rmse' and 'ssim' not in rmse
+        assert not rmse['is_different']
+        assert ssim['ssim'] < 1 - diff.DEFAULT_SSIM_THRESHOLD
+        assert ssim['is_different']
+
+    def test_heatmap_localizes_change(self, tmp_path):
+        a = self._bars(tmp_path / "a.png")
+        b = self._bars(tmp_path / "b.png", patch=(slice(96, 128), slice(0, 32)))
+        result = diff.diff_image(a, b, prefilter=False, metric='ssim')
+        heatmap = np.asarray(result['ssim_heatmap'])
+        assert heatmap.shape == diff.SSIM_HEATMAP_GRID
+        assert np.unravel_index(heatmap.argmax(), heatmap.shape) in [(6, 0), (6, 1), (7, 0), (7, 1)]
+        assert heatmap[:4].max() == 0
+
+    def test_prefilter_hit_reports_perfect_ssim(self, tmp_path):
+        p = self._bars(tmp_path / "a.png")
+        result = diff.diff_image(p, p, metric='ssim')
+        assert result['prefilter'] == 'digest'
+        assert result['ssim'] == 1.0
+
+    def test_unknown_metric(self, tmp_path):
+        p = self._bars(tmp_path / "a.png")
+        with pytest.raises(ValueError):
+            diff.diff_image(p, p, metric='psnr')
+
+    def test_dir_summary_reports_metric(self, tmp_path, capsys):
+        self._bars(tmp_path / "actual" / "plot.png")
+        self._bars(tmp_path / "expected" / "plot.png", offset=2)
+        assert diff_dir_images(str(tmp_path / "actual"), str(tmp_path / "expected"), metric='ssim')
+        out = capsys.readouterr().out
+        assert "ssim threshold=0.1" in out
+        assert "most changed region" in out
+
+
+@pytest.mark.skipif(
+    not IMAGE_DEPS_AVAILABLE,
+    reason="Pillow and/or NumPy not installed",
+)
+class TestPlotComparisonReport:
+    """Test the plot comparison report directory."""
+
+    @pytest.fixture(autouse=True)
+    def no_browser(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(diff.subprocess, "Popen", lambda *a, **kw: None)
+        monkeypatch.setattr(diff.tempfile, "mkdtemp", lambda: str(tmp_path / "report"))
+
+    def test_links_thumbnails(self, tmp_path):
+        make_png(tmp_path / "actual", "run/plot.png", color="white", size=(2400, 1200))
+        make_png(tmp_path / "expected", "run/plot.png", color="black", size=(2400, 1200))
+        output = Path(diff.generate_plot_comparison_html(
+            str(tmp_path / "actual"), str(tmp_path / "expected"),
+        ))
+        assert output.name == "index.html"
+        html = output.read_text()
+        assert "base64" not in html
+        assert html.count('loading="lazy"') == 4
+        thumbnails = sorted(p.name for p in (output.parent / "images").iterdir())
+        assert len(thumbnails) == 2
+        for name in thumbnails:
+            # Each thumbnail is shared by its panel and the overlay
+            assert html.count('src="images/{0}"'.format(name)) == 2
+            assert max(Image.open(output.parent / "images" / name).size) <= max(diff.PLOT_REPORT_THUMBNAIL_SIZE)
+        assert (tmp_path / "actual" / "run" / "plot.png").resolve().as_uri() in html
+
+    def test_missing_plot(self, tmp_path):
+        make_png(tmp_path / "actual", "plot.png")
+        (tmp_path / "expected").mkdir()
+        output = Path(diff.generate_plot_comparison_html(
+            str(tmp_path / "actual"), str(tmp_path / "expected"),
+        ))
+        assert "Not found" in output.read_text()
+        assert len(list((output.parent / "images").iterdir())) == 1
+
+    def test_no_differences(self, tmp_path):
+        make_png(tmp_path / "actual", "plot.png")
+        make_png(tmp_path / "expected", "plot.png")
+        assert diff.generate_plot_comparison_html(
+            str(tmp_path / "actual"), str(tmp_path / "expected"),
+        ) is None
+        assert not (tmp_path / "report").exists()
+
+    @pytest.mark.skipif(not IMAGE_DEPS_AVAILABLE, reason="Pillow and/or NumPy not installed")
+    def test_thumbnail_closes_source(self, tmp_path, monkeypatch):
+        from PIL import ImageFile
+        closed = []
+        real_exit = ImageFile.ImageFile.__exit__
+        monkeypatch.setattr(ImageFile.ImageFile, "__exit__", lambda img, *args: closed.append(img) or real_exit(img, *args))
+        diff.write_plot_thumbnail(make_png(tmp_path, "plot.png", size=(2400, 1200)), tmp_path / "thumb")
+        assert len(closed) == 1
+
+    def test_thumbnail_copied_without_pillow(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(diff, "IMAGE_DEPS_AVAILABLE", False)
+        source = make_png(tmp_path, "plot.png", size=(2400, 1200))
+        dest = diff.write_plot_thumbnail(source, tmp_path / "thumb")
+        assert dest.name == "thumb.png"
+        assert dest.read_bytes() == source.read_bytes()
+
+
 class TestDiffDirImagesDepsUnavailable:
     """Test behavior when Pillow/NumPy are not available."""
 
@@ -793,11 +2327,142 @@ class TestTruncateDiffLines:
 
 
 # ═══════════════════════════════════════════════════════════════════════════
-# WARNING_FILE_REGEXP — pattern validation
+# RunningTimeHistory — running-time trends
 # ═══════════════════════════════════════════════════════════════════════════
 
-class TestWarningFileRegexp:
-    """Verify WARNING_FILE_REGEXP matches all expected report filenames."""
+class TestRunningTimeHistory:
+    """Test the SQLite running-time history and its use by diff_running_times."""
+
+    @staticmethod
+    def _write_info(directory, seconds, started):
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / "CRISPResso2_info.json").write_text(json.dumps({"running_info": {
+            "version": "2.3.0",
+            "start_time": {"value": started},
+            "running_time": {"value": {"days": 0, "seconds": seconds, "microseconds": 0}},
+        }}))
+        diff._load_json.cache_clear()
+        return directory
+
+    def _run(self, tmp_path, history, seconds, day):
+        actual = self._write_info(tmp_path / "run{0}".format(day) / "CRISPResso_on_test", seconds, "2026-01-{0:02d} 09:00:00".format(day))
+        expected = self._write_info(tmp_path / "expected" / "CRISPResso_on_test", 100, "2025-01-01 09:00:00")
+        diff.diff_running_times(actual, expected, 0.1, "CRISPResso2_info.json", history=history)
+
+    def test_record_is_idempotent(self, tmp_path):
+        with diff.RunningTimeHistory(tmp_path / "times.sqlite") as history:
+            history.record("t", 10.0, "2026-01-01 09:00:00", "abc")
+            history.record("t", 10.0, "2026-01-01 09:00:00", "abc")
+            assert history.runs("t") == [("2026-01-01 09:00:00", "abc", 10.0)]
+
+    def test_falls_back_to_expected_until_enough_runs(self, tmp_path, capsys):
+        with diff.RunningTimeHistory(tmp_path / "times.sqlite") as history:
+            self._run(tmp_path, history, 10, 1)
+        assert "Actual is 163.64% faster than Expected." in capsys.readouterr().out
+
+    def test_flags_outlier_against_median(self, tmp_path, capsys):
+        with diff.RunningTimeHistory(tmp_path / "times.sqlite") as history:
+            for day, seconds in enumerate([10, 11, 10, 12, 10, 11], 1):
+                self._run(tmp_path, history, seconds, day)
+            assert "MADs" not in capsys.readouterr().out
+            self._run(tmp_path, history, 12, 7)
+            assert capsys.readouterr().out == ""
+            self._run(tmp_path, history, 30, 8)
+            out = capsys.readouterr().out
+        assert "slower than the median of the last 7 runs (11.0 s)" in out
+
+    def test_only_earlier_runs_on_the_same_machine(self, tmp_path):
+        with diff.RunningTimeHistory(tmp_path / "times.sqlite") as history:
+            for day in range(1, 7):
+                history.record("t", 10.0, "2026-01-{0:02d}".format(day), "abc")
+                history.record("t", 99.0, "2026-01-{0:02d}".format(day), "abc", host="other", cores=64)
+            assert history.check("t", 10.0, "2026-01-03") is None
+            check = history.check("t", 10.0, "2026-01-07")
+        assert (check.n_runs, check.median, check.deviations) == (6, 10.0, 0.0)
+
+    def test_report(self, tmp_path):
+        with diff.RunningTimeHistory(tmp_path / "times.sqlite") as history:
+            for day, seconds in enumerate([10, 20, 30], 1):
+                history.record("t", seconds, "2026-01-{0:02d}".format(day), "rev{0}".format(day), host="ci", cores=4)
+            lines = history.report()
+        assert lines == [
+            "t (ci, 4 cores): \u2581\u2585\u2588 3 run(s), median 20.0 s, MAD 10.0 s,"
+            " last 30.0 s (+0.7 MAD) at rev3"
+        ]
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# print_diff / render_side_by_side — terminal output
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TestRenderSideBySide:
+    """Test the in-process side-by-side diff renderer."""
+
+    DIFF = [
+        "--- actual\n",
+        "+++ expected\n",
+        "@@ -9,4 +9,4 @@\n",
+        " same\n",
+        "-old value\n",
+        "-removed\n",
+        "+new value\n",
+        " tail\n",
+        "+added\n",
+        "2 of 10 records differ\n",
+    ]
+
+    def test_columns_and_line_numbers(self):
+        rows = diff.render_side_by_side(self.DIFF, width=60, color=False)
+        assert rows[:3] == ["--- actual\n", "+++ expected\n", "@@ -9,4 +9,4 @@\n"]
+        assert rows[3].split() == ["9", "same", "9", "same"]
+        assert rows[4].split() == ["10", "old", "value", "|", "10", "new", "value"]
+        assert rows[5].split() == ["11", "removed", "<"]
+        assert rows[6].split() == ["12", "tail", "11", "tail"]
+        assert rows[7].split() == [">", "12", "added"]
+        assert rows[8] == "2 of 10 records differ\n"
+
+    def test_long_lines_wrap_within_column(self):
+        rows = diff.render_side_by_side(["@@ record 1 (q) @@\n", "-" + "A" * 50 + "\n", "+C\n"], width=50, color=False)
+        assert len(rows) == 4
+        assert all(len(row.rstrip("\n")) <= 50 for row in rows)
+
+    def test_changed_span_highlighted(self):
+        rows = diff.render_side_by_side(["@@ -1 +1 @@\n", "-CIGAR: 10M\n", "+CIGAR: 9M1I\n"], width=60)
+        assert "\033[7;31m10M\033[0m" in rows[1]
+        assert "\033[7;32m9M1I\033[0m" in rows[1]
+
+    def test_color_reopened_after_wrap(self):
+        rows = diff._wrap_columns("\033[31m" + "A" * 25 + "\033[0m", 20)
+        assert rows[0] == ("\033[31m" + "A" * 20 + "\033[0m", 20)
+        assert rows[1] == ("\033[31m" + "A" * 5 + "\033[0m", 5)
+
+    def test_plain_output_when_not_a_terminal(self, capsys):
+        diff.print_diff(self.DIFF)
+        assert capsys.readouterr().out == "".join(self.DIFF)
+
+    def test_side_by_side_in_one_write(self, monkeypatch):
+        monkeypatch.setattr(diff, "YDIFF_INSTALLED", False)
+        writes = []
+
+        class Terminal(object):
+            def isatty(self):
+                return True
+
+            def write(self, text):
+                writes.append(text)
+
+        diff.print_diff(self.DIFF, out=Terminal())
+        assert len(writes) == 1
+        assert "\033[" in writes[0]
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# diff_rules.toml — warning-only reports
+# ═══════════════════════════════════════════════════════════════════════════
+
+@pytest.mark.skipif(diff.tomllib is None, reason="no TOML parser installed")
+class TestWarningFileRules:
+    """Verify the shipped warn rules match all expected report filenames."""
 
     @pytest.mark.parametrize("filename", [
         "CRISPResso2_report.html",
@@ -809,8 +2474,8 @@ class TestWarningFileRegexp:
         "fastp_report.html",
     ])
     def test_matches_known_warning_files(self, filename):
-        assert WARNING_FILE_REGEXP.search(filename), (
-            "{} should match WARNING_FILE_REGEXP".format(filename)
+        assert diff.default_diff_rules().rule_for(filename).severity == "warn", (
+            "{} should match a warn rule".format(filename)
         )
 
     @pytest.mark.parametrize("filename", [
@@ -821,19 +2486,20 @@ class TestWarningFileRegexp:
         "fastp_report.txt",             # Wrong extension
     ])
     def test_does_not_match_non_warning_files(self, filename):
-        assert not WARNING_FILE_REGEXP.search(filename), (
-            "{} should NOT match WARNING_FILE_REGEXP".format(filename)
+        assert diff.default_diff_rules().rule_for(filename).severity == "fail", (
+            "{} should NOT match a warn rule".format(filename)
         )
 
 
 # ═══════════════════════════════════════════════════════════════════════════
-# IGNORE_FILES_REGEXP / IGNORE_SUFFIX — constant validation
+# diff_rules.toml — ignored RUNNING_LOG files
 # ═══════════════════════════════════════════════════════════════════════════
 
 class TestIgnoreConstants:
     """Validate ignore patterns for RUNNING_LOG files."""
 
-    def test_running_logs_match_ignore_files_regexp(self):
+    @pytest.mark.skipif(diff.tomllib is None, reason="no TOML parser installed")
+    def test_running_logs_match_ignore_rule(self):
         expected_logs = [
             'CRISPResso_RUNNING_LOG.txt',
             'CRISPRessoBatch_RUNNING_LOG.txt',
@@ -842,12 +2508,10 @@ class TestIgnoreConstants:
             'CRISPRessoCompare_RUNNING_LOG.txt',
         ]
         for log in expected_logs:
-            assert IGNORE_FILES_REGEXP.match(log), (
-                "{} should match IGNORE_FILES_REGEXP".format(log)
+            assert diff.default_diff_rules().rule_for(log).severity == 'ignore', (
+                "{} should match the ignore rule".format(log)
             )
 
-    def test_non_crispresso_running_log_does_not_match_regexp(self):
-        assert not IGNORE_FILES_REGEXP.match('CustomTool_RUNNING_LOG.txt')
-
-    def test_ignore_suffix(self):
-        assert IGNORE_SUFFIX == '_RUNNING_LOG.txt'
+    @pytest.mark.skipif(diff.tomllib is None, reason="no TOML parser installed")
+    def test_non_crispresso_running_log_does_not_match_ignore_rule(self):
+        assert diff.default_diff_rules().rule_for('CustomTool_RUNNING_LOG.txt').severity == 'fail'
@@ -5,7 +5,10 @@ import os
 import re
 from shutil import copyfile, copytree
 
-from diff import diff_dir, generate_plot_comparison_html, TEXT_SUFFIXES, DATA_SUFFIXES, HTML_SUFFIXES, PDF_SUFFIXES
+from diff import (
+    diff_dir, default_diff_rules, generate_plot_comparison_html, ResultTreeIndex,
+    TEXT_SUFFIXES, DATA_SUFFIXES, HTML_SUFFIXES, PDF_SUFFIXES,
+)
 
 
 COMMON_FLAGS = {'--place_report_in_output_folder', '--halt_on_plot_fail', '--debug'}
@@ -244,14 +247,16 @@ def update_test(args):
     if args.html_only:
         suffixes = HTML_SUFFIXES
     elif args.skip_html:
-        suffixes = DATA_SUFFIXES + PDF_SUFFIXES
+        suffixes = DATA_SUFFIXES + PDF_SUFFIXES + default_diff_rules().extra_suffixes
     else:
-        suffixes = TEXT_SUFFIXES + PDF_SUFFIXES
+        suffixes = TEXT_SUFFIXES + PDF_SUFFIXES + default_diff_rules().extra_suffixes
 
+    actual_index = ResultTreeIndex(args.actual)
+    expected_index = ResultTreeIndex(args.expected)
     if args.diff_plots and not args.html_only:
-        generate_plot_comparison_html(args.actual, args.expected)
+        generate_plot_comparison_html(actual_index, expected_index)
     has_changes = diff_dir(
-        args.actual, args.expected,
+        actual_index, expected_index,
         suffixes=suffixes,
         prompt_to_update=True,
     )